@@ -1,14 +1,32 @@
 from json import JSONDecodeError
-from typing import Type, NewType, List, Any
+from typing import Type, NewType, List, Any, Literal, Callable
+import asyncio
 import json
+import time
 
-from openai import OpenAI
 from colorama import Fore, Style
-from pydantic import BaseModel, ValidationError, Field, ConfigDict
+from openai.types import CompletionUsage
+from pydantic import BaseModel, ValidationError, Field, ConfigDict, PrivateAttr, model_validator, field_validator, \
+    field_serializer
 
 from output_formats import OutputFormatModel
-from message import Message, AgentMessage
+from output_repair import parse_json_object
+from message import Message, AgentMessage, MessageLog, MessageView, MessageType
 from data_collection import save
+from token_counting import count_message_tokens, TOKENS_PER_PROMPT
+from completion_cache import CompletionCache, default_completion_cache
+from llm_clients import default_client_registry
+from rate_limiter import RateLimitScheduler, Priority, default_rate_limiter
+from metrics import MetricsRegistry, default_metrics
+import tracing
+
+
+COMPLETION_TOKENS_ESTIMATE = 150
+"""The number of tokens a completion is expected to use, counted against the tokens per minute before it is sent."""
+
+
+class PromptTooLargeError(ValueError):
+    """Raised when a prompt doesn't fit in the token budget of an agent, even after compacting the history."""
 
 
 class BaseAgentInterface(BaseModel):
@@ -16,6 +34,7 @@ class BaseAgentInterface(BaseModel):
     The interface that agents use to receive info from and interact with the game.
     This is the base class and should not be used directly.
     """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
 
     agent_id: str
     """The id of the agent."""
@@ -24,19 +43,114 @@ class BaseAgentInterface(BaseModel):
 
     log_messages: bool = True
     """Whether to log messages or not."""
-    messages: List[Message] = []
-    """The message history of the agent."""
+    messages: MessageView = Field(default_factory=MessageView)
+    """The message history of the agent, a view of the messages in the game's log that the agent can see."""
     is_human: bool = False
     """Whether the agent is human or not."""
+    format_retries: int = Field(0, exclude=True)
+    """The number of times the agent has been asked to fix a response that didn't match the format."""
+    structured_output: bool = False
+    """Whether to ask for formatted responses in a single call, instead of a response followed by a reformat."""
+    round_starts: List[int] = []
+    """The index in the message history at which each round starts."""
+    round_summaries: List[str] = []
+    """A compact summary of each finished round."""
+    metrics: MetricsRegistry = Field(default_factory=default_metrics, exclude=True)
+    """Where the latency, token usage and validation failures of the agent's responses are recorded."""
+
+    # The phase of the game the agent is responding to, LLM calls are measured under it
+    _phase: str = PrivateAttr("response")
+
+    @field_validator("messages", mode="before")
+    @classmethod
+    def messages_from_list(cls, value):
+        """Accepts a list of messages, which become a history of their own."""
+        if isinstance(value, MessageView):
+            return value
+        view = MessageView()
+        for message in value:
+            view.append(Message.model_validate(message))
+        return view
+
+    @field_serializer("messages")
+    def serialize_messages(self, messages: MessageView) -> List[dict]:
+        return [message.model_dump() for message in messages]
 
     @property
     def is_ai(self):
         return not self.is_human
 
+    def join_log(self, log: MessageLog, can_receive: Callable[[MessageType], bool] = None):
+        """Makes the message history a view of a game's message log, keeping any messages it already has."""
+        view = MessageView(log, self.agent_id, can_receive)
+        for message in self.messages:
+            view.append(message)
+        self.messages = view
+        self._listen_to(view)
+
+    def model_post_init(self, __context: Any):
+        self._listen_to(self.messages)
+
+    def _listen_to(self, view: MessageView):
+        """Interfaces that react to messages as they arrive are told about them, the others only read their history."""
+        if type(self).on_message is not BaseAgentInterface.on_message:
+            log = view.log
+            log.listeners.append(lambda index: view.is_visible(index) and self.on_message(log.entries[index][0]))
+
     def add_message(self, message: Message):
         """Adds a message to the message history, without generating a response."""
         self.messages.append(message)
 
+    def on_message(self, message: Message):
+        """Called with each message added to the history, e.g. to display it."""
+
+    def on_partial_message(self, message: Message):
+        """
+        Called with a message that is still being generated each time it grows, e.g. another player's description.
+        Its content is everything generated so far, the complete message follows through on_message.
+        """
+
+    @property
+    def shows_partial_messages(self) -> bool:
+        """Whether the interface reacts to messages while they are being generated."""
+        return type(self).on_partial_message is not BaseAgentInterface.on_partial_message
+
+    def start_round(self, previous_round_summary: str = None):
+        """Marks the start of a round in the message history, along with a summary of the round that just ended."""
+        if previous_round_summary:
+            self.round_summaries.append(previous_round_summary)
+        self.round_starts.append(len(self.messages))
+
+    def compact_messages(self, keep_rounds: int = 1, max_summaries: int = None) -> List[Message]:
+        """
+        Returns the message history with all but the latest rounds collapsed into their summaries.
+        Messages from before the first round, like the rules, are always kept.
+        If max_summaries is given, only the summaries of the most recent compacted rounds are kept.
+        """
+        compacted_rounds = self.compacted_rounds(keep_rounds)
+        if compacted_rounds <= 0:
+            return list(self.messages)
+
+        preamble = self.messages[:self.round_starts[0]]
+        summary = self.summary_message(compacted_rounds, max_summaries)
+        recent_rounds = self.messages[self.round_starts[compacted_rounds]:]
+
+        return preamble + ([summary] if summary else []) + recent_rounds
+
+    def compacted_rounds(self, keep_rounds: int = 1) -> int:
+        """Returns the number of rounds that are collapsed into summaries when keeping the latest rounds."""
+        return max(min(len(self.round_starts) - keep_rounds, len(self.round_summaries)), 0)
+
+    def summary_message(self, compacted_rounds: int, max_summaries: int = None) -> Message | None:
+        """Returns a message summarizing the compacted rounds, or None if there is nothing to summarize."""
+        summaries = self.round_summaries[:compacted_rounds]
+        if max_summaries is not None:
+            summaries = summaries[len(summaries) - max_summaries:] if max_summaries else []
+
+        if not summaries:
+            return None
+        return Message(type="info", content="Summary of the previous rounds:\n\n" + "\n\n".join(summaries))
+
     # Respond To methods - These take a message as input and generate a response
 
     def respond_to(self, message: Message) -> Message:
@@ -57,29 +171,65 @@ class BaseAgentInterface(BaseModel):
         output = self.generate_formatted_response(output_format, additional_fields, **kwargs)
         return output
 
+    async def arespond_to(self, message: Message) -> Message:
+        """Async version of respond_to."""
+        self.add_message(message)
+        save(AgentMessage.from_message(message, [self.agent_id], self.game_id))
+        response = await self.agenerate_response()
+        return response
+
+    async def arespond_to_formatted(
+            self, message: Message,
+            output_format: Type[OutputFormatModel],
+            additional_fields: dict = None,
+            **kwargs
+    ) -> OutputFormatModel:
+        """Async version of respond_to_formatted."""
+        self.add_message(message)
+        output = await self.agenerate_formatted_response(output_format, additional_fields, **kwargs)
+        return output
+
     # Generate response methods - These do not take a message as input and only use the current message history
 
-    def generate_response(self) -> Message | None:
-        """Generates a response based on the current messages in the history."""
-        content = self._generate()
-        if content:
-            response = Message(type="agent", content=content)
-            self.add_message(response)
-            save(AgentMessage.from_message(response, [self.agent_id], self.game_id))
-            return response
-        else:
-            return None
+    def generate_response(self, on_content: Callable[[str], Any] = None) -> Message | None:
+        """
+        Generates a response based on the current messages in the history.
+        If on_content is given, it is called with the content generated so far while the response is generated.
+        """
+        content = self._generate_streamed(on_content) if on_content else self._generate()
+        return self._add_response(content)
+
+    async def agenerate_response(self, on_content: Callable[[str], Any] = None) -> Message | None:
+        """Async version of generate_response."""
+        content = await (self._agenerate_streamed(on_content) if on_content else self._agenerate())
+        return self._add_response(content)
 
     def generate_formatted_response(
             self,
             output_format: Type[OutputFormatModel],
             additional_fields: dict = None,
             max_retries=3,
+            on_partial_output: Callable[[str], Any] = None
     ) -> OutputFormatModel:
-        """Generates a response matching the provided format."""
-        initial_response = self.generate_response()
+        """
+        Generates a response matching the provided format.
+        If on_partial_output is given, it is called with the format's streamed field as far as it has been generated,
+        e.g. to show it to the other players. It may start over if a response doesn't match the format, only the
+        output returned has been validated.
+        """
+        self._phase = output_format.phase
+        if self.structured_output:
+            on_content = self._structured_streamer(output_format, on_partial_output)
+            response = self.respond_to_structured(output_format, on_content)
+            output = self._try_structured_response(response, output_format, additional_fields)
+            if output:
+                return output
+
+        # Two step path - a free form response, followed by a request to reformat it
+        initial_response = self.generate_response(on_partial_output if output_format.streamed_field else None)
 
         reformat_message = Message(type="format", content=output_format.get_format_instructions())
+        self._phase = "format"
 
         output = None
         retries = 0
@@ -87,64 +237,556 @@ class BaseAgentInterface(BaseModel):
         while not output:
             try:
                 formatted_response = self.respond_to(reformat_message)
+                output = self._parse_formatted_response(formatted_response, output_format, additional_fields)
 
-                fields = json.loads(formatted_response.content)
-                if additional_fields:
-                    fields.update(additional_fields)
-
-                output = output_format.model_validate(fields)
-
-            except ValidationError as e:
+            except (ValidationError, JSONDecodeError) as e:
+                self._record_validation_failure(output_format, e)
                 # If the response doesn't match the format, we ask the agent to try again
                 if retries > max_retries:
                     raise e
 
-                retry_message = Message(type="retry", content=f"Error formatting response: {e} \n\n Please try again.")
-                reformat_message = retry_message
-
+                reformat_message = self._retry_message(e)
+                self._phase = "retry"
                 retries += 1
+                self.format_retries += 1
 
-            except JSONDecodeError as e:
-                # Occasionally models will output json as a code block, which will cause a JSONDecodeError
+        return output
+
+    async def agenerate_formatted_response(
+            self,
+            output_format: Type[OutputFormatModel],
+            additional_fields: dict = None,
+            max_retries=3,
+            on_partial_output: Callable[[str], Any] = None
+    ) -> OutputFormatModel:
+        """Async version of generate_formatted_response."""
+        self._phase = output_format.phase
+        if self.structured_output:
+            on_content = self._structured_streamer(output_format, on_partial_output)
+            response = await self.arespond_to_structured(output_format, on_content)
+            output = self._try_structured_response(response, output_format, additional_fields)
+            if output:
+                return output
+
+        initial_response = await self.agenerate_response(on_partial_output if output_format.streamed_field else None)
+
+        reformat_message = Message(type="format", content=output_format.get_format_instructions())
+        self._phase = "format"
+
+        output = None
+        retries = 0
+
+        while not output:
+            try:
+                formatted_response = await self.arespond_to(reformat_message)
+                output = self._parse_formatted_response(formatted_response, output_format, additional_fields)
+
+            except (ValidationError, JSONDecodeError) as e:
+                self._record_validation_failure(output_format, e)
                 if retries > max_retries:
                     raise e
 
-                retry_message = Message(type="retry",
-                                        content="There was an Error with your JSON format. Make sure you are not using code blocks."
-                                                "i.e. your response should be:\n{...}\n"
-                                                "Instead of:\n```json\n{...}\n```\n\n Please try again.")
-                reformat_message = retry_message
-
+                reformat_message = self._retry_message(e)
+                self._phase = "retry"
                 retries += 1
+                self.format_retries += 1
 
         return output
 
+    def respond_to_structured(
+            self, output_format: Type[OutputFormatModel], on_content: Callable[[str], Any] = None
+    ) -> Message | None:
+        """
+        Asks for a response directly in the output format, using the structured output of the model if it has one.
+        If on_content is given, it is called with the content generated so far while the response is generated.
+        """
+        structured_message = Message(type="format", content=output_format.get_response_instructions())
+        self.add_message(structured_message)
+        save(AgentMessage.from_message(structured_message, [self.agent_id], self.game_id))
+        content = self._generate_structured(output_format, on_content)
+        return self._add_response(content)
+
+    async def arespond_to_structured(
+            self, output_format: Type[OutputFormatModel], on_content: Callable[[str], Any] = None
+    ) -> Message | None:
+        """Async version of respond_to_structured."""
+        structured_message = Message(type="format", content=output_format.get_response_instructions())
+        self.add_message(structured_message)
+        save(AgentMessage.from_message(structured_message, [self.agent_id], self.game_id))
+        content = await self._agenerate_structured(output_format, on_content)
+        return self._add_response(content)
+
+    @staticmethod
+    def _structured_streamer(
+            output_format: Type[OutputFormatModel], on_partial_output: Callable[[str], Any] | None
+    ) -> Callable[[str], Any] | None:
+        """Returns the callback passing on the streamed field of a structured response, None if nothing is streamed."""
+        if not on_partial_output or not output_format.streamed_field:
+            return None
+
+        last_output = None
+
+        def on_content(content: str):
+            nonlocal last_output
+            partial_output = output_format.partial_output(content)
+            # Chunks after the end of the field, e.g. the closing brace, don't change it
+            if partial_output and partial_output != last_output:
+                last_output = partial_output
+                on_partial_output(partial_output)
+
+        return on_content
+
+    def _try_structured_response(
+            self,
+            response: Message | None,
+            output_format: Type[OutputFormatModel],
+            additional_fields: dict = None
+    ) -> OutputFormatModel | None:
+        """Parses a structured response, if it doesn't match the format the agent is told why and None is returned."""
+        if not response:
+            return None
+
+        try:
+            return self._parse_formatted_response(response, output_format, additional_fields)
+        except (ValidationError, JSONDecodeError) as e:
+            self._record_validation_failure(output_format, e)
+            # The agent gets to fix its response through the two step path
+            retry_message = self._retry_message(e)
+            self.add_message(retry_message)
+            save(AgentMessage.from_message(retry_message, [self.agent_id], self.game_id))
+            self._phase = "retry"
+            self.format_retries += 1
+            return None
+
+    def _record_validation_failure(
+            self, output_format: Type[OutputFormatModel], error: ValidationError | JSONDecodeError
+    ):
+        """Counts a response that didn't match its output format."""
+        error_type = "json" if isinstance(error, JSONDecodeError) else "validation"
+        self.metrics.validation_failures.inc(format=output_format.__name__, error=error_type)
+
+    def _add_response(self, content: str | None) -> Message | None:
+        """Adds generated content to the message history as a response."""
+        if content:
+            response = Message(type="agent", content=content)
+            self.add_message(response)
+            save(AgentMessage.from_message(response, [self.agent_id], self.game_id))
+            return response
+        else:
+            return None
+
+    def _parse_formatted_response(
+            self,
+            response: Message,
+            output_format: Type[OutputFormatModel],
+            additional_fields: dict = None
+    ) -> OutputFormatModel:
+        """Parses a formatted response, raises a JSONDecodeError or ValidationError if it doesn't match the format."""
+        with tracing.span(self.game_id, "validation", "validation", format=output_format.__name__):
+            # Trivial mistakes are repaired locally, rather than asking the agent to try again
+            fields = parse_json_object(response.content)
+            if additional_fields:
+                fields.update(additional_fields)
+            fields = output_format.repair_fields(fields)
+
+            return output_format.model_validate(fields)
+
+    @staticmethod
+    def _retry_message(error: ValidationError | JSONDecodeError) -> Message:
+        """Returns the message asking the agent to fix a response that didn't match the format."""
+        if isinstance(error, JSONDecodeError):
+            # Occasionally models will output json as a code block, which will cause a JSONDecodeError
+            return Message(type="retry",
+                           content="There was an Error with your JSON format. Make sure you are not using code blocks."
+                                   "i.e. your response should be:\n{...}\n"
+                                   "Instead of:\n```json\n{...}\n```\n\n Please try again.")
+        else:
+            return Message(type="retry", content=f"Error formatting response: {error} \n\n Please try again.")
+
     def _generate(self) -> str:
         """Generates a response from the Agent."""
         # This is the BaseAgent class, and thus has no response logic
         # Subclasses should implement this method to generate a response using the message history
         raise NotImplementedError
 
+    async def _agenerate(self) -> str:
+        """Async version of _generate, by default it runs _generate in a separate thread."""
+        # Subclasses with a native async client should override this method
+        return await asyncio.to_thread(self._generate)
+
+    def _generate_streamed(self, on_content: Callable[[str], Any]) -> str:
+        """
+        Generates a response, calling on_content with the content generated so far while it's generated.
+        By default, the content is passed on once it's complete.
+        """
+        content = self._generate()
+        if content:
+            on_content(content)
+        return content
+
+    async def _agenerate_streamed(self, on_content: Callable[[str], Any]) -> str:
+        """Async version of _generate_streamed."""
+        return await asyncio.to_thread(self._generate_streamed, on_content)
+
+    def _generate_structured(
+            self, output_format: Type[OutputFormatModel], on_content: Callable[[str], Any] = None
+    ) -> str:
+        """Generates a response that should match the output format, by default relying on the instructions alone."""
+        return self._generate_streamed(on_content) if on_content else self._generate()
+
+    async def _agenerate_structured(
+            self, output_format: Type[OutputFormatModel], on_content: Callable[[str], Any] = None
+    ) -> str:
+        """Async version of _generate_structured."""
+        return await asyncio.to_thread(self._generate_structured, output_format, on_content)
+
 
 class OpenAIAgentInterface(BaseAgentInterface):
     """An interface that uses the OpenAI API (or compatible 3rd parties) to generate responses."""
-    model_config = ConfigDict(protected_namespaces=())
+    model_config = ConfigDict(protected_namespaces=(), arbitrary_types_allowed=True)
 
     model_name: str = "gpt-3.5-turbo"
     """The name of the model to use for generating responses."""
-    client: Any = Field(default_factory=OpenAI, exclude=True)
-    """The OpenAI client used to generate responses."""
+    base_url: str | None = None
+    """The base url of the API, None means the OPENAI_BASE_URL environment variable or OpenAI's API."""
+    api_key: str | None = Field(None, exclude=True)
+    """The API key, None means the OPENAI_API_KEY environment variable."""
+    client: Any = Field(None, exclude=True)
+    """The OpenAI client used to generate responses, by default borrowed from the shared client registry."""
+    rate_limiter: RateLimitScheduler | None = Field(default_factory=default_rate_limiter, exclude=True)
+    """Schedules requests within the provider's rate limits and retries them, None means they are sent right away."""
+    priority: Priority = "normal"
+    """How urgently requests are sent when they are rate limited, e.g. interactive games go before simulations."""
+    completion_cache: CompletionCache | None = Field(default_factory=default_completion_cache, exclude=True)
+    """The cache completions are recorded to and replayed from, None means every completion is generated."""
+    structured_output: bool = True
+    """Whether to ask for formatted responses in a single call, instead of a response followed by a reformat."""
+    structured_output_method: Literal["json_mode", "tools"] = "json_mode"
+    """How structured output is requested, either JSON mode or by forcing a call to a function with the format's schema."""
+    token_budget: int | None = None
+    """The maximum number of tokens in a prompt, older rounds are summarized to stay within it. None means no limit."""
+    keep_rounds: int = 1
+    """The number of most recent rounds kept verbatim when the history is compacted."""
+    prompt_tokens: int = Field(0, exclude=True)
+    """The number of prompt tokens sent, as reported by the API."""
+    cached_prompt_tokens: int = Field(0, exclude=True)
+    """The number of prompt tokens that were served from the provider's prompt cache, as reported by the API."""
+    stream: bool = True
+    """Whether responses shown while they are generated are streamed, otherwise they are shown once complete."""
+
+    # The history is append-only, so it is converted to the OpenAI format incrementally
+    _openai_messages: List[dict] = PrivateAttr(default_factory=list)
+    _message_tokens: List[int] = PrivateAttr(default_factory=list)
+    _converted_history: List[Message] | None = PrivateAttr(None)
+    # The summaries kept while compacting, reused for the whole round so the prefix is identical between calls
+    _compaction: tuple[int, int] | None = PrivateAttr(None)
+    # The clients without their own retries, used when the rate limiter retries instead
+    _scheduled_clients: dict[int, tuple[Any, Any]] = PrivateAttr(default_factory=dict)
+
+    @model_validator(mode="after")
+    def borrow_client(self):
+        """Borrows a client from the shared registry, unless one was given."""
+        if self.client is None:
+            self.client = default_client_registry().get(self.model_name, self.base_url, self.api_key)
+        return self
+
+    @property
+    def prompt_cache_hit_rate(self) -> float | None:
+        """The fraction of prompt tokens served from the provider's prompt cache."""
+        return self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else None
 
     def _generate(self) -> str:
         """Generates a response using the message history"""
-        open_ai_messages = [message.to_openai() for message in self.messages]
+        return self._cached_completion(self._completion_request())
+
+    def _generate_streamed(self, on_content: Callable[[str], Any]) -> str:
+        """Generates a response using the message history, passing on its content as it is streamed."""
+        return self._cached_completion(self._completion_request(), on_content)
+
+    def _generate_structured(
+            self, output_format: Type[OutputFormatModel], on_content: Callable[[str], Any] = None
+    ) -> str:
+        """Generates a response using the message history, constrained to the output format."""
+        return self._cached_completion(self._completion_request(output_format), on_content)
+
+    def _cached_completion(self, request: dict, on_content: Callable[[str], Any] = None) -> str:
+        """
+        Returns the content of a completion, from the completion cache if there is one.
+        If on_content is given, the completion is streamed to it, cached completions are passed on all at once.
+        """
+        streamed = False
+
+        def create() -> str:
+            nonlocal streamed
+            start = time.perf_counter()
+            if on_content and self.stream:
+                streamed = True
+                content = self._streamed_content(self._send_completion(self._streaming_request(request)), on_content)
+            else:
+                content = self._completion_content(self._send_completion(request))
+            self._record_latency(start)
+            return content
+
+        with tracing.span(self.game_id, "llm call", "llm", model=self.model_name, phase=self._phase):
+            if self.completion_cache is None:
+                content = create()
+            else:
+                content = self.completion_cache.get_or_create(request, create)
+        if on_content and not streamed and content:
+            on_content(content)
+        return content
+
+    def _send_completion(self, request: dict):
+        """Sends a completion request, once the rate limiter allows it if there is one."""
+        if self.rate_limiter is None:
+            return self._sync_client().chat.completions.create(**request)
+
+        client = self.scheduled_client(self._sync_client())
+        return self.rate_limiter.call(
+            lambda: client.chat.completions.create(**request), self.estimated_tokens(), self.priority
+        )
 
-        completion = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=open_ai_messages
+    def _sync_client(self):
+        """Returns the client used by the sync methods."""
+        return self.client
+
+    def scheduled_client(self, client=None):
+        """Returns a client (by default client) without its own retries, so that the rate limiter coordinates them."""
+        client = client or self.client
+        original, scheduled = self._scheduled_clients.get(id(client), (None, None))
+        if original is not client:
+            scheduled = client.with_options(max_retries=0)
+            self._scheduled_clients[id(client)] = (client, scheduled)
+        return scheduled
+
+    def estimated_tokens(self) -> int:
+        """Returns an upper estimate of the tokens the next completion uses, prompt and completion included."""
+        prompt_tokens = TOKENS_PER_PROMPT + sum(self._message_tokens)
+        if self.token_budget is not None:
+            prompt_tokens = min(prompt_tokens, self.token_budget)
+        return prompt_tokens + COMPLETION_TOKENS_ESTIMATE
+
+    def _completion_request(self, output_format: Type[OutputFormatModel] = None) -> dict:
+        """Returns the arguments of the chat completion request for the current message history."""
+        open_ai_messages = self.prompt_messages()
+
+        request = {"model": self.model_name, "messages": open_ai_messages}
+
+        if output_format and self.structured_output_method == "tools":
+            function_name = output_format.__name__
+            request["tools"] = [{
+                "type": "function",
+                "function": {"name": function_name, "parameters": output_format.get_json_schema()}
+            }]
+            request["tool_choice"] = {"type": "function", "function": {"name": function_name}}
+        elif output_format:
+            request["response_format"] = {"type": "json_object"}
+
+        return request
+
+    def openai_messages(self) -> List[dict]:
+        """Returns the whole message history in the OpenAI format, only messages added since the last call are converted."""
+        if self._converted_history is not self.messages or len(self._openai_messages) > len(self.messages):
+            # The history has been replaced, so start over
+            self._openai_messages = []
+            self._message_tokens = []
+            self._converted_history = self.messages
+
+        for message in self.messages[len(self._openai_messages):]:
+            open_ai_message = message.to_openai()
+            self._openai_messages.append(open_ai_message)
+            self._message_tokens.append(count_message_tokens([open_ai_message], self.model_name) - TOKENS_PER_PROMPT)
+
+        return self._openai_messages
+
+    def prompt_messages(self) -> List[dict]:
+        """
+        Returns the message history in the OpenAI format, compacted if it exceeds the token budget.
+        Older rounds are summarized first, then the oldest summaries are dropped until the prompt fits.
+        Raises a PromptTooLargeError if it still exceeds the budget, rather than sending it.
+
+        The prompt always starts with the same messages (rules, summaries and then the current round in order),
+        so that consecutive prompts share as long a prefix as possible for the provider's prompt cache.
+        """
+        open_ai_messages = self.openai_messages()
+        if self.token_budget is None or TOKENS_PER_PROMPT + sum(self._message_tokens) <= self.token_budget:
+            return list(open_ai_messages)
+
+        compacted_rounds = self.compacted_rounds(self.keep_rounds)
+        preamble_end = self.round_starts[0] if self.round_starts else 0
+        recent_start = self.round_starts[compacted_rounds] if compacted_rounds else preamble_end
+        tokens = TOKENS_PER_PROMPT + sum(self._message_tokens[:preamble_end]) + sum(self._message_tokens[recent_start:])
+
+        # Within a round, keep as many summaries as before so the prefix doesn't change, unless the prompt has outgrown it
+        max_summaries = compacted_rounds
+        if self._compaction and self._compaction[0] == compacted_rounds:
+            max_summaries = self._compaction[1]
+
+        for summary_count in range(max_summaries, -1, -1):
+            summary = self.summary_message(compacted_rounds, summary_count)
+            summary_messages = [summary.to_openai()] if summary else []
+            summary_tokens = count_message_tokens(summary_messages, self.model_name) - TOKENS_PER_PROMPT
+            if tokens + summary_tokens <= self.token_budget:
+                self._compaction = (compacted_rounds, summary_count)
+                return open_ai_messages[:preamble_end] + summary_messages + open_ai_messages[recent_start:]
+
+        raise PromptTooLargeError(
+            f"The prompt of {self.agent_id} is {tokens} tokens after compaction, "
+            f"which exceeds its budget of {self.token_budget} tokens."
         )
 
-        return completion.choices[0].message.content
+    @staticmethod
+    def _streaming_request(request: dict) -> dict:
+        """Returns a request streaming the completion, with the usage reported by the last chunk."""
+        # The cache key is the request as it would be sent without streaming, so both share recorded completions
+        # stream_options isn't an argument of every version of the client, so it is added to the body directly
+        return {**request, "stream": True, "extra_body": {"stream_options": {"include_usage": True}}}
+
+    def _streamed_content(self, stream, on_content: Callable[[str], Any]) -> str:
+        """Returns the content of a streamed completion, passing on the content so far after each chunk."""
+        chunks = []
+        for chunk in stream:
+            self._add_chunk(chunk, chunks, on_content)
+        return "".join(chunks)
+
+    def _add_chunk(self, chunk, chunks: List[str], on_content: Callable[[str], Any]):
+        """Adds the content of a streamed chunk, for function calls the arguments. The last chunk only has the usage."""
+        self._record_usage(chunk)
+        if not chunk.choices:
+            return
+
+        delta = chunk.choices[0].delta
+        content = delta.tool_calls[0].function.arguments if delta.tool_calls else delta.content
+        if content:
+            chunks.append(content)
+            on_content("".join(chunks))
+
+    def _completion_content(self, completion) -> str:
+        """Returns the content of a completion, for function calls these are the arguments."""
+        self._record_usage(completion)
+
+        message = completion.choices[0].message
+        if message.tool_calls:
+            return message.tool_calls[0].function.arguments
+        return message.content
+
+    def _record_latency(self, start: float):
+        """Records the latency of a completion that was sent at start, including the time it was rate limited."""
+        self.metrics.llm_call_seconds.observe(time.perf_counter() - start, model=self.model_name, phase=self._phase)
+
+    def _record_usage(self, completion):
+        """Records the tokens of a completion, and how many of the prompt tokens were cached by the provider."""
+        usage = getattr(completion, "usage", None)
+        if not usage:
+            return
+        if isinstance(usage, dict):
+            # Versions of the client that predate usage in streamed chunks leave it as a plain dict
+            usage = CompletionUsage.model_validate(usage)
+
+        self.prompt_tokens += usage.prompt_tokens or 0
+
+        # Only some providers and versions of the client report cached tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached_tokens = details.get("cached_tokens") or 0
+        else:
+            cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        self.cached_prompt_tokens += cached_tokens
+
+        labels = {"model": self.model_name, "phase": self._phase}
+        self.metrics.prompt_tokens.inc(usage.prompt_tokens or 0, **labels)
+        self.metrics.cached_prompt_tokens.inc(cached_tokens, **labels)
+        self.metrics.completion_tokens.inc(usage.completion_tokens or 0, **labels)
+
+
+class AsyncOpenAIAgentInterface(OpenAIAgentInterface):
+    """
+    An interface that uses the async OpenAI client, so it doesn't block the event loop.
+    Sync callers (e.g. run_game or a GameHost) are served by a sync client with the same settings.
+    """
+
+    sync_client: Any = Field(None, exclude=True)
+    """The client used by the sync methods, by default borrowed from the shared client registry when first needed."""
+
+    @model_validator(mode="after")
+    def borrow_client(self):
+        """
+        Async clients are bound to the event loop they are used in, so unless a client was given, one is borrowed from
+        the shared registry for each request (see _async_client).
+        """
+        return self
+
+    def _async_client(self):
+        """Returns the client that was given, or otherwise the registry's client for the running event loop."""
+        if self.client is not None:
+            return self.client
+        return default_client_registry().get(self.model_name, self.base_url, self.api_key, asynchronous=True)
+
+    def _sync_client(self):
+        if self.sync_client is None:
+            base_url, api_key = self.base_url, self.api_key
+            if self.client is not None:
+                base_url, api_key = base_url or str(self.client.base_url), api_key or self.client.api_key
+            self.sync_client = default_client_registry().get(self.model_name, base_url, api_key)
+        return self.sync_client
+
+    async def _agenerate(self) -> str:
+        """Generates a response using the message history, without blocking the event loop."""
+        return await self._acached_completion(self._completion_request())
+
+    async def _agenerate_streamed(self, on_content: Callable[[str], Any]) -> str:
+        """Generates a response using the message history, passing on its content as it is streamed."""
+        return await self._acached_completion(self._completion_request(), on_content)
+
+    async def _agenerate_structured(
+            self, output_format: Type[OutputFormatModel], on_content: Callable[[str], Any] = None
+    ) -> str:
+        """Generates a response constrained to the output format, without blocking the event loop."""
+        return await self._acached_completion(self._completion_request(output_format), on_content)
+
+    async def _acached_completion(self, request: dict, on_content: Callable[[str], Any] = None) -> str:
+        """Async version of _cached_completion."""
+        streamed = False
+
+        async def create() -> str:
+            nonlocal streamed
+            start = time.perf_counter()
+            if on_content and self.stream:
+                streamed = True
+                content = await self._astreamed_content(
+                    await self._asend_completion(self._streaming_request(request)), on_content
+                )
+            else:
+                content = self._completion_content(await self._asend_completion(request))
+            self._record_latency(start)
+            return content
+
+        with tracing.span(self.game_id, "llm call", "llm", model=self.model_name, phase=self._phase):
+            if self.completion_cache is None:
+                content = await create()
+            else:
+                content = await self.completion_cache.aget_or_create(request, create)
+        if on_content and not streamed and content:
+            on_content(content)
+        return content
+
+    async def _astreamed_content(self, stream, on_content: Callable[[str], Any]) -> str:
+        """Async version of _streamed_content."""
+        chunks = []
+        async for chunk in stream:
+            self._add_chunk(chunk, chunks, on_content)
+        return "".join(chunks)
+
+    async def _asend_completion(self, request: dict):
+        """Async version of _send_completion."""
+        client = self._async_client()
+        if self.rate_limiter is None:
+            return await client.chat.completions.create(**request)
+
+        client = self.scheduled_client(client)
+        return await self.rate_limiter.acall(
+            lambda: client.chat.completions.create(**request), self.estimated_tokens(), self.priority
+        )
 
 
 class HumanAgentInterface(BaseAgentInterface):
@@ -154,9 +796,13 @@ class HumanAgentInterface(BaseAgentInterface):
             self,
             output_format: Type[OutputFormatModel],
             additional_fields: dict = None,
-            max_retries: int = 3
+            max_retries: int = 3,
+            on_partial_output: Callable[[str], Any] = None
     ) -> OutputFormatModel | None:
-        """For Human agents, we can trust them enough to format their own responses... for now"""
+        """
+        For Human agents, we can trust them enough to format their own responses... for now
+        Their responses are entered all at once, so nothing is passed on to on_partial_output.
+        """
         response = self.generate_response()
 
         if response:
@@ -165,11 +811,14 @@ class HumanAgentInterface(BaseAgentInterface):
                 fields = {output_format.model_fields.copy().popitem()[0]: response.content}
                 if additional_fields:
                     fields.update(additional_fields)
+                fields = output_format.repair_fields(fields)
                 output = output_format.model_validate(fields)
 
             except ValidationError as e:
+                self._record_validation_failure(output_format, e)
                 retry_message = Message(type="retry", content=f"Error formatting response: {e} \n\n Please try again.")
                 self.add_message(retry_message)
+                self.format_retries += 1
                 output = None
 
         else:
@@ -177,11 +826,45 @@ class HumanAgentInterface(BaseAgentInterface):
 
         return output
 
+    async def agenerate_formatted_response(
+            self,
+            output_format: Type[OutputFormatModel],
+            additional_fields: dict = None,
+            max_retries: int = 3,
+            on_partial_output: Callable[[str], Any] = None
+    ) -> OutputFormatModel | None:
+        """Human input is blocking, so it is collected in a separate thread."""
+        return await asyncio.to_thread(self.generate_formatted_response, output_format, additional_fields, max_retries)
+
+
+class QuietObserverInterface(HumanAgentInterface):
+    """An interface that discards every message, used to observe headless games without printing or storing them."""
+    def add_message(self, message: Message):
+        pass
+
 
 class HumanAgentCLI(HumanAgentInterface):
     """A Human agent that uses the command line interface to generate responses."""
-    def add_message(self, message: Message):
-        super().add_message(message)
+
+    # The message being generated, as far as it has been printed
+    _partial_content: str = PrivateAttr("")
+
+    def on_partial_message(self, message: Message):
+        if message.content.startswith(self._partial_content):
+            print(message.content[len(self._partial_content):], end="", flush=True)
+        else:
+            # Generation started over, e.g. after a response that didn't match the format
+            print("\n" + message.content, end="", flush=True)
+        self._partial_content = message.content
+
+    def on_message(self, message: Message):
+        if self._partial_content:
+            partial_content, self._partial_content = self._partial_content, ""
+            print()
+            # The complete message is only printed again if it differs from what was streamed, e.g. once repaired
+            if message.content == partial_content:
+                return
+
         if message.type == "verbose":
             print(Fore.GREEN + message.content + Style.RESET_ALL)
         elif message.type == "debug":
@@ -1,38 +1,87 @@
-from typing import Type
+import os
+import queue
+from typing import Type, Sequence
 
 import streamlit as st
 from streamlit import session_state
 
 from game_chameleon import ChameleonGame
+from game_host import GameHost, HostAtCapacityError, Subscription
 from agent_interfaces import HumanAgentInterface
-from message import Message
+from message import Message, PartialMessage
 from prompts import fetch_prompt
 
+# Execution modes:
+# - background: games are run by a GameHost shared by every session, and the page shows their messages as they come
+# - inline: each page run steps the game itself, and shows nothing new until the game needs the human again
+APP_EXECUTION_MODE = os.environ.get("APP_EXECUTION_MODE", "background").lower()
+APP_POLL_INTERVAL = float(os.environ.get("APP_POLL_INTERVAL", 0.25))
+
 st.set_page_config(layout="wide", page_title="Chameleon")
 
 
-def display_message(message: Message):
+def message_markdown(message: Message) -> str | None:
+    """Returns how a message is shown on the page, None if it isn't shown."""
     if message.type == "verbose":
-        messages_container.markdown(f":green[{message.content}]")
+        return f":green[{message.content}]"
     elif message.type == "debug":
-        messages_container.markdown(f":orange[DEBUG: {message.content}]")
+        return f":orange[DEBUG: {message.content}]"
     elif message.type == "system":
         # Don't display system message as it is displayed in the "How to Play" expander
-        pass
+        return None
     else:
-        messages_container.markdown(f"{message.content}")
+        return f"{message.content}"
+
+
+def display_messages(messages: Sequence[Message]):
+    """
+    Shows messages that haven't been shown before, and adds them to the transcript.
+    Earlier messages are shown from the transcript, so each page run only renders the messages that are new to it.
+    """
+    global partial_message
+    if messages and partial_message is not None:
+        # The message being generated is complete, it is shown with the others
+        partial_message.empty()
+        partial_message = None
+
+    markdown = "\n\n".join(filter(None, (message_markdown(message) for message in messages)))
+    if markdown:
+        messages_container.markdown(markdown)
+        session_state.transcript += markdown + "\n\n"
+
+
+partial_message = None
+"""The placeholder showing the message being generated, replaced once the complete message arrives."""
+
+
+def display_partial_message(message: PartialMessage):
+    """Shows a message while it is being generated, it isn't added to the transcript."""
+    global partial_message
+    markdown = message_markdown(message)
+    if markdown:
+        if partial_message is None:
+            partial_message = messages_container.empty()
+        partial_message.markdown(markdown)
+
+
+def display_transcript():
+    """Shows the messages from earlier page runs, as a single element rather than one per message."""
+    if session_state.transcript:
+        messages_container.markdown(session_state.transcript)
 
 
-if "messages" not in session_state:
-    session_state.messages = []
+if "user_input" not in session_state:
     session_state.user_input = None
+if "transcript" not in session_state:
+    session_state.transcript = ""
 
 
 class StreamlitInterface(HumanAgentInterface):
-    def add_message(self, message: Message):
-        super().add_message(message)
-        session_state.messages.append(message)
-        display_message(message)
+    def on_message(self, message: Message):
+        display_messages([message])
+
+    def on_partial_message(self, message: PartialMessage):
+        display_partial_message(message)
 
     def _generate(self) -> str:
         response = session_state.user_input
@@ -40,6 +89,123 @@ class StreamlitInterface(HumanAgentInterface):
         return response
 
 
+@st.cache_resource
+def game_host() -> GameHost:
+    """Returns the host running the games of every session in this process."""
+    host = GameHost()
+    host.start()
+    return host
+
+
+# Inline mode
+
+def resume_game():
+    """
+    Reloads the game in the url from its latest checkpoint, so any worker process can serve any session.
+    Does nothing if checkpointing is disabled.
+    """
+    game_id = st.query_params.get("game_id")
+    if not game_id:
+        return
+
+    game = ChameleonGame.resume(game_id, human_interface=StreamlitInterface)
+    if game:
+        session_state.game = game
+        session_state.transcript = ""
+        display_messages(human_messages())
+
+
+def human_messages() -> Sequence[Message]:
+    """Returns the message history of the human player, which is what the page shows."""
+    if "game" not in session_state:
+        return []
+    human = next(player for player in session_state.game.players if player.interface.is_human)
+    return human.interface.messages
+
+
+def run_inline(user_input: str | None):
+    if user_input:
+        if "game" not in st.session_state:
+            st.session_state.game = ChameleonGame.from_human_name(user_input, StreamlitInterface)
+            st.query_params["game_id"] = st.session_state.game.game_id
+        else:
+            session_state.user_input = user_input
+
+        st.session_state.game.run_game()
+
+
+# Background mode
+
+def attach_game():
+    """
+    Follows the game in the url if the session isn't following one yet, e.g. after a page reload.
+    Games hosted by another process are resumed from their latest checkpoint, if checkpointing is enabled.
+    """
+    game_id = st.query_params.get("game_id")
+    if not game_id or "game_id" in session_state:
+        return
+
+    host = game_host()
+    if not host.has_game(game_id) and host.resume_game(game_id) is None:
+        return
+
+    session_state.game_id = game_id
+    session_state.subscription = host.subscribe(game_id)
+
+
+def run_in_background(user_input: str | None):
+    host = game_host()
+
+    if user_input:
+        if "game_id" not in session_state:
+            try:
+                session_state.game_id = host.create_game(user_input)
+            except HostAtCapacityError:
+                st.error("Too many games are being played right now, please try again in a few minutes.")
+                return
+            session_state.subscription = host.subscribe(session_state.game_id)
+            st.query_params["game_id"] = session_state.game_id
+        elif host.has_game(session_state.game_id):
+            # Input sent before the game asks for it is used the next time it does
+            try:
+                host.submit_input(session_state.game_id, user_input)
+            except ValueError:
+                # The game is already over
+                pass
+
+    if "game_id" in session_state:
+        follow_game(host, session_state.game_id, session_state.subscription)
+
+
+def follow_game(host: GameHost, game_id: str, subscription: Subscription):
+    """
+    Shows the game's messages as the host sends them, until the game needs the human's input or ends.
+    The chat input stays usable meanwhile, since it is rendered before this runs.
+    """
+    while True:
+        # Everything that has arrived is shown at once
+        messages = []
+        try:
+            while (message := subscription.get(timeout=0 if messages else APP_POLL_INTERVAL)) is not None:
+                if isinstance(message, PartialMessage):
+                    display_messages(messages)
+                    messages = []
+                    display_partial_message(message)
+                else:
+                    messages.append(message)
+            game_over = True
+        except queue.Empty:
+            game_over = False
+        display_messages(messages)
+
+        if game_over:
+            if host.has_game(game_id):
+                host.remove_game(game_id)
+            return
+        if not messages and host.status(game_id) == "awaiting_input":
+            return
+
+
 # Streamlit App
 
 margin_size = 1
@@ -65,17 +231,7 @@ with center:
 
     user_input = st.chat_input("Your response:")
 
-    if st.session_state.messages:
-        for message in st.session_state.messages:
-            display_message(message)
-
-if user_input:
-    if "game" not in st.session_state:
-        st.session_state.game = ChameleonGame.from_human_name(user_input, StreamlitInterface)
-    else:
-        session_state.user_input = user_input
-
-    st.session_state.game.run_game()
+    display_transcript()
 
 st.markdown("#")
 
@@ -95,4 +251,13 @@ text-align: center;
 <small>Your responses may be collected for research purposes</small>
 </div>
 """
-st.markdown(footer, unsafe_allow_html=True)
\ No newline at end of file
+st.markdown(footer, unsafe_allow_html=True)
+
+# Runs last, so the rest of the page is shown while the game is being played
+if APP_EXECUTION_MODE == "inline":
+    if "game" not in session_state:
+        resume_game()
+    run_inline(user_input)
+else:
+    attach_game()
+    run_in_background(user_input)
@@ -0,0 +1,207 @@
+"""
+Stores snapshots of games in progress, so that a game can be resumed in another process after a crash or restart.
+
+Stores (set with CHECKPOINT_MODE):
+- none: games are not checkpointed
+- sqlite: snapshots are stored in a SQLite database at CHECKPOINT_PATH, which can be shared by several processes
+- files: snapshots are stored as gzipped JSON files in the CHECKPOINT_PATH directory
+
+The message log of a game only grows, so it isn't part of each snapshot: the records added since the previous
+checkpoint are stored along with it, by their position in the log, and load puts the log back in the snapshot.
+Snapshots record the length of the log (message_count), so records stored past it by an interrupted save are ignored.
+"""
+import gzip
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import List, Iterator, Sequence
+
+CHECKPOINT_MODE = os.environ.get("CHECKPOINT_MODE", "none").lower()
+_default_path = {"sqlite": "checkpoints.sqlite", "files": "checkpoints"}.get(CHECKPOINT_MODE, "checkpoints")
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH", pathlib.Path(__file__).parent.parent / "data" / _default_path)
+
+
+class SQLiteCheckpointStore:
+    """Keeps the latest snapshot of each game in a SQLite database, compressed with zlib."""
+
+    def __init__(self, path: str | os.PathLike = CHECKPOINT_PATH):
+        self.path = pathlib.Path(path)
+        """The path of the database."""
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            # Write-ahead logging lets other processes read while a snapshot is being written
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints "
+                "(game_id TEXT PRIMARY KEY, game_state TEXT, updated_at REAL, snapshot BLOB)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_messages "
+                "(game_id TEXT, position INTEGER, record TEXT, PRIMARY KEY (game_id, position))"
+            )
+
+    def save(self, game_id: str, snapshot: dict, log_records: Sequence[dict] = (), log_start: int = 0):
+        """
+        Stores the snapshot of a game, replacing the previous one, along with the records of its message log from
+        position log_start on.
+        """
+        data = zlib.compress(json.dumps(snapshot).encode())
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO checkpoint_messages VALUES (?, ?, ?)",
+                [(game_id, log_start + i, json.dumps(record)) for i, record in enumerate(log_records)]
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+                (game_id, snapshot.get("game_state"), time.time(), data)
+            )
+
+    def load(self, game_id: str) -> dict | None:
+        """Returns the latest snapshot of a game with its message log, or None if there isn't one."""
+        with self._connect() as connection:
+            row = connection.execute("SELECT snapshot FROM checkpoints WHERE game_id = ?", (game_id,)).fetchone()
+            if not row:
+                return None
+            snapshot = json.loads(zlib.decompress(row[0]))
+            if "message_log" not in snapshot:
+                rows = connection.execute(
+                    "SELECT record FROM checkpoint_messages WHERE game_id = ? AND position < ? ORDER BY position",
+                    (game_id, snapshot.get("message_count", 0))
+                )
+                snapshot["message_log"] = [json.loads(record) for record, in rows]
+        return snapshot
+
+    def delete(self, game_id: str):
+        """Removes the snapshot of a game."""
+        with self._connect() as connection:
+            connection.execute("DELETE FROM checkpoints WHERE game_id = ?", (game_id,))
+            connection.execute("DELETE FROM checkpoint_messages WHERE game_id = ?", (game_id,))
+
+    def game_ids(self, unfinished: bool = False) -> List[str]:
+        """Returns the ids of the checkpointed games, optionally only those that haven't finished."""
+        query = "SELECT game_id FROM checkpoints"
+        if unfinished:
+            query += " WHERE game_state != 'game_end'"
+        with self._connect() as connection:
+            return [row[0] for row in connection.execute(query + " ORDER BY updated_at")]
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per operation, so the store can be used from any thread or forked process
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+class FileCheckpointStore:
+    """
+    Keeps the latest snapshot of each game as a gzipped JSON file, and its message log in a JSONL file that each save
+    appends to.
+    """
+
+    def __init__(self, directory: str | os.PathLike = CHECKPOINT_PATH):
+        self.directory = pathlib.Path(directory)
+        """The directory the snapshots are stored in."""
+
+    def save(self, game_id: str, snapshot: dict, log_records: Sequence[dict] = (), log_start: int = 0):
+        """
+        Stores the snapshot of a game, replacing the previous one, along with the records of its message log from
+        position log_start on.
+        """
+        path = self._path(game_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Appended before the snapshot is replaced, so the snapshot never refers to records that haven't been stored
+        if log_records:
+            data = "".join(
+                json.dumps({"position": log_start + i, **record}) + "\n" for i, record in enumerate(log_records)
+            )
+            with open(self._log_path(game_id), "a+b") as f:
+                # A line left incomplete by a crash is ended first, so it's skipped without losing the records after it
+                if f.seek(0, os.SEEK_END):
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+                f.write(data.encode())
+
+        # Written to a temporary file first, so that a crash never leaves a partial snapshot behind
+        temporary_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with gzip.open(temporary_path, "wt") as f:
+            json.dump(snapshot, f)
+        os.replace(temporary_path, path)
+
+    def load(self, game_id: str) -> dict | None:
+        """Returns the latest snapshot of a game with its message log, or None if there isn't one."""
+        try:
+            with gzip.open(self._path(game_id), "rt") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if "message_log" not in snapshot:
+            # A record stored again after a resume replaces the earlier one at the same position
+            records = {}
+            message_count = snapshot.get("message_count", 0)
+            try:
+                with open(self._log_path(game_id)) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        position = record.pop("position")
+                        if position < message_count:
+                            records[position] = record
+            except FileNotFoundError:
+                pass
+            snapshot["message_log"] = [records[position] for position in sorted(records)]
+        return snapshot
+
+    def delete(self, game_id: str):
+        """Removes the snapshot of a game."""
+        self._path(game_id).unlink(missing_ok=True)
+        self._log_path(game_id).unlink(missing_ok=True)
+
+    def game_ids(self, unfinished: bool = False) -> List[str]:
+        """Returns the ids of the checkpointed games, optionally only those that haven't finished."""
+        paths = sorted(self.directory.glob("*.json.gz"), key=lambda path: path.stat().st_mtime)
+        game_ids = [path.name.removesuffix(".json.gz") for path in paths]
+        if unfinished:
+            game_ids = [game_id for game_id in game_ids if self.load(game_id)["game_state"] != "game_end"]
+        return game_ids
+
+    def _path(self, game_id: str) -> pathlib.Path:
+        return self.directory / f"{game_id}.json.gz"
+
+    def _log_path(self, game_id: str) -> pathlib.Path:
+        return self.directory / f"{game_id}.messages.jsonl"
+
+
+CheckpointStore = SQLiteCheckpointStore | FileCheckpointStore
+
+_default_store: CheckpointStore | None = None
+_default_store_lock = threading.Lock()
+
+
+def default_checkpoint_store() -> CheckpointStore | None:
+    """Returns the process-wide store configured by the environment, or None if checkpointing is disabled."""
+    global _default_store
+    if CHECKPOINT_MODE not in ["sqlite", "files"]:
+        return None
+
+    with _default_store_lock:
+        if _default_store is None:
+            if CHECKPOINT_MODE == "sqlite":
+                _default_store = SQLiteCheckpointStore(CHECKPOINT_PATH)
+            else:
+                _default_store = FileCheckpointStore(CHECKPOINT_PATH)
+        return _default_store
@@ -0,0 +1,231 @@
+"""
+A persistent cache of completions, so that games can be replayed deterministically without paying for the same
+completions twice.
+
+Modes (set with COMPLETION_CACHE_MODE):
+- passthrough: the cache is not used
+- record: completions are served from the cache when possible, otherwise generated and stored
+- replay: completions are only served from the cache, a miss raises a CompletionCacheMiss
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import pathlib
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Awaitable, Literal
+
+CacheMode = Literal["passthrough", "record", "replay"]
+
+COMPLETION_CACHE_MODE = os.environ.get("COMPLETION_CACHE_MODE", "passthrough").lower()
+COMPLETION_CACHE_DIR = os.environ.get(
+    "COMPLETION_CACHE_DIR", pathlib.Path(__file__).parent.parent / "data" / "completion_cache"
+)
+COMPLETION_CACHE_MAX_BYTES = int(os.environ.get("COMPLETION_CACHE_MAX_BYTES", 1024 ** 3))
+
+
+class CompletionCacheMiss(LookupError):
+    """Raised in replay mode when a completion is not in the cache."""
+
+
+class CompletionCache:
+    """An on-disk cache of completions keyed by model and payload, evicting the least recently used entries by size."""
+
+    def __init__(
+            self,
+            directory: str | os.PathLike = COMPLETION_CACHE_DIR,
+            mode: CacheMode = "record",
+            max_bytes: int = COMPLETION_CACHE_MAX_BYTES
+    ):
+        self.directory = pathlib.Path(directory)
+        """The directory the completions are stored in."""
+        self.mode = mode
+        """Whether the cache records new completions, only replays stored ones, or is bypassed."""
+        self.max_bytes = max_bytes
+        """The maximum total size of the stored completions, least recently used ones are evicted beyond it."""
+
+        self.hits = 0
+        """The number of completions served from the cache."""
+        self.misses = 0
+        """The number of completions that were not in the cache."""
+
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, Future] = {}
+        self._async_in_flight: dict[str, asyncio.Future] = {}
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._total_bytes = 0
+        self._load_index()
+
+    @staticmethod
+    def key(request: dict) -> str:
+        """Returns the key of a completion request, made of the model name and a hash of the rest of the payload."""
+        payload = {name: value for name, value in request.items() if name != "model"}
+        payload_hash = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        model = re.sub(r"[^\w.-]", "_", request.get("model", "default"))
+        return f"{model}/{payload_hash}"
+
+    def get(self, key: str) -> str | None:
+        """Returns a stored completion, or None if it isn't in the cache."""
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                content = json.load(f)["content"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        # The modification time records the last use, so the LRU order survives restarts
+        # Another process may have evicted the entry since it was read, which doesn't make it any less of a hit
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return content
+
+    def put(self, key: str, content: str):
+        """Stores a completion, evicting the least recently used ones if the cache is full."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps({"key": key, "content": content})
+
+        # Written to a temporary file first, so that readers never see a partial entry
+        temporary_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary_path, "w") as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            evicted = self._evict()
+
+        for evicted_key in evicted:
+            self._path(evicted_key).unlink(missing_ok=True)
+
+    def get_or_create(self, request: dict, create: Callable[[], str]) -> str:
+        """Returns the completion of a request from the cache, or from create depending on the mode."""
+        if self.mode == "passthrough":
+            return create()
+
+        key = self.key(request)
+        content = self.get(key)
+        if content is not None:
+            self.hits += 1
+            return content
+
+        self.misses += 1
+        if self.mode == "replay":
+            raise CompletionCacheMiss(f"No completion for {key} in {self.directory}")
+
+        # Identical requests made at the same time share a single call
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            # An identical request may have finished between the lookup and taking ownership
+            content = self.get(key)
+            if content is None:
+                content = create()
+                if content is not None:
+                    self.put(key, content)
+            future.set_result(content)
+            return content
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    async def aget_or_create(self, request: dict, create: Callable[[], Awaitable[str]]) -> str:
+        """Async version of get_or_create."""
+        if self.mode == "passthrough":
+            return await create()
+
+        key = self.key(request)
+        content = self.get(key)
+        if content is not None:
+            self.hits += 1
+            return content
+
+        self.misses += 1
+        if self.mode == "replay":
+            raise CompletionCacheMiss(f"No completion for {key} in {self.directory}")
+
+        future = self._async_in_flight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._async_in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            content = await create()
+            if content is not None:
+                self.put(key, content)
+            future.set_result(content)
+            return content
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting on the future, which would log a warning about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._async_in_flight[key]
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.json"
+
+    def _load_index(self):
+        """Indexes the stored completions, least recently used first."""
+        if not self.directory.exists():
+            return
+
+        paths = sorted(self.directory.glob("*/*.json"), key=lambda path: path.stat().st_mtime)
+        for path in paths:
+            key = f"{path.parent.name}/{path.stem}"
+            size = path.stat().st_size
+            self._entries[key] = size
+            self._total_bytes += size
+
+        with self._lock:
+            evicted = self._evict()
+        for evicted_key in evicted:
+            self._path(evicted_key).unlink(missing_ok=True)
+
+    def _evict(self) -> list[str]:
+        """Removes the least recently used entries from the index until it fits, returns their keys."""
+        evicted = []
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append(key)
+        return evicted
+
+
+_default_cache: CompletionCache | None = None
+_default_cache_lock = threading.Lock()
+
+
+def default_completion_cache() -> CompletionCache | None:
+    """Returns the process-wide cache configured by the environment, or None in passthrough mode."""
+    global _default_cache
+    if COMPLETION_CACHE_MODE == "passthrough":
+        return None
+
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = CompletionCache(COMPLETION_CACHE_DIR, COMPLETION_CACHE_MODE, COMPLETION_CACHE_MAX_BYTES)
+        return _default_cache
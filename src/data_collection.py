@@ -1,13 +1,21 @@
+import atexit
+import logging
 import os
 import pathlib
-from typing import NewType
+import queue
+import threading
+import time
+from typing import NewType, List, Any
 
 import pydantic
 
 import player
 import message
+from segmented_log import get_segmented_log
+import tracing
 
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from pydantic import BaseModel
 
 
@@ -15,24 +23,191 @@ DATA_COLLECTION_MODE = os.environ.get("DATA_COLLECTION_MODE", "JSONL")
 
 MONGODB_CONNECTION_STRING = os.environ.get("MONGODB_CONNECTION_STRING")
 DB_NAME = os.environ.get("MONGODB_NAME")
+MONGODB_MAX_POOL_SIZE = int(os.environ.get("MONGODB_MAX_POOL_SIZE", 10))
+DUPLICATE_KEY_ERROR = 11000
+
+# Buffered mode queues log objects in memory and writes them from a background thread
+# It is on by default for MongoDB, so that slow or failing inserts never block the game
+_buffered_default = "true" if DATA_COLLECTION_MODE.upper() == "MONGODB" else "false"
+DATA_COLLECTION_BUFFERED = os.environ.get("DATA_COLLECTION_BUFFERED", _buffered_default).lower() == "true"
+DATA_COLLECTION_BATCH_SIZE = int(os.environ.get("DATA_COLLECTION_BATCH_SIZE", 100))
+DATA_COLLECTION_FLUSH_INTERVAL = float(os.environ.get("DATA_COLLECTION_FLUSH_INTERVAL", 1.0))
+DATA_COLLECTION_MAX_RETRIES = int(os.environ.get("DATA_COLLECTION_MAX_RETRIES", 3))
+DATA_COLLECTION_RETRY_BACKOFF = float(os.environ.get("DATA_COLLECTION_RETRY_BACKOFF", 0.5))
+# How long the end of a game waits for its records to be written, the writer keeps retrying in the background after
+DATA_COLLECTION_FLUSH_TIMEOUT = float(os.environ.get("DATA_COLLECTION_FLUSH_TIMEOUT", 1.0))
+
+DATA_DIR = pathlib.Path(__file__).parent.parent / "data"
 
 Model = NewType("Model", BaseModel)
 
+logger = logging.getLogger(__name__)
+
 
 def save(log_object: Model):
     collection = get_collection(log_object)
+    with tracing.span(getattr(log_object, "game_id", None), "save", "save", collection=collection):
+        # Serialize now, the log object may still be changed by the game after it has been saved
+        record = serialize(log_object)
+
+        if DATA_COLLECTION_BUFFERED:
+            get_writer().put(collection, record)
+        else:
+            write_records(collection, [record])
+
+
+def flush(timeout: float = None) -> bool:
+    """
+    Blocks until every log object saved so far has been written, or until the timeout has passed.
+    Returns whether they have all been written. Only has an effect in buffered mode.
+    """
+    if _writer is not None and _writer.is_alive():
+        return _writer.flush(timeout)
+    return True
 
-    if DATA_COLLECTION_MODE.upper() == "JSONL":
-        data_dir = pathlib.Path(__file__).parent.parent / "data"
-        log_file = os.path.join(data_dir, f"{collection}.jsonl")
 
-        with open(log_file, "a+") as f:
-            f.write(log_object.model_dump_json() + "\n")
+def serialize(log_object: Model) -> Any:
+    """Converts a log object into the record format used by the current data collection mode."""
+    if DATA_COLLECTION_MODE.upper() == "MONGODB":
+        return log_object.model_dump()
+    else:
+        return log_object.model_dump_json()
+
+
+def write_records(collection: str, records: List[Any]):
+    """Writes a batch of serialized records to a collection."""
+    if DATA_COLLECTION_MODE.upper() == "JSONL":
+        # Rotated into compressed segments as it grows, see segmented_log
+        get_segmented_log(DATA_DIR, collection).append("".join(record + "\n" for record in records))
 
     if DATA_COLLECTION_MODE.upper() == "MONGODB":
-        client = MongoClient(MONGODB_CONNECTION_STRING)
-        db = client[DB_NAME]
-        db[collection].insert_one(log_object.model_dump())
+        db = get_mongo_client()[DB_NAME]
+        try:
+            db[collection].insert_many(records, ordered=False)
+        except BulkWriteError as e:
+            # When retrying a partially written batch, the records that made it the first time are duplicates
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+
+
+_mongo_client: MongoClient | None = None
+_mongo_client_pid: int | None = None
+_mongo_client_lock = threading.Lock()
+
+
+def get_mongo_client() -> MongoClient:
+    """Returns the MongoDB client of the current process, its connection pool is shared by every save."""
+    global _mongo_client, _mongo_client_pid
+    with _mongo_client_lock:
+        # MongoClient is not fork-safe, so each process gets its own
+        if _mongo_client is None or _mongo_client_pid != os.getpid():
+            _mongo_client = MongoClient(MONGODB_CONNECTION_STRING, maxPoolSize=MONGODB_MAX_POOL_SIZE)
+            _mongo_client_pid = os.getpid()
+        return _mongo_client
+
+
+class BufferedWriter:
+    """Queues records in memory and writes them from a background thread, in batches by size or time."""
+
+    def __init__(
+            self,
+            batch_size: int = DATA_COLLECTION_BATCH_SIZE,
+            flush_interval: float = DATA_COLLECTION_FLUSH_INTERVAL,
+            max_retries: int = DATA_COLLECTION_MAX_RETRIES,
+            retry_backoff: float = DATA_COLLECTION_RETRY_BACKOFF
+    ):
+        self.batch_size = batch_size
+        """The number of records that triggers a write."""
+        self.flush_interval = flush_interval
+        """The maximum number of seconds a record waits in the buffer before being written."""
+        self.max_retries = max_retries
+        """The number of times a failed write is retried before its records are dropped."""
+        self.retry_backoff = retry_backoff
+        """The number of seconds to wait before the first retry, doubled after each failed attempt."""
+        self.pid = os.getpid()
+        """The process that owns the writer, background threads do not survive a fork."""
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="data-collection-writer", daemon=True)
+        self._thread.start()
+
+    def is_alive(self) -> bool:
+        """Returns True if the background thread is running in the current process."""
+        return self.pid == os.getpid() and self._thread.is_alive()
+
+    def put(self, collection: str, record: Any):
+        """Adds a record to the buffer."""
+        self._queue.put((collection, record))
+
+    def flush(self, timeout: float = None) -> bool:
+        """Blocks until every record added so far has been written or the timeout has passed, returns which it was."""
+        flushed = threading.Event()
+        self._queue.put((None, flushed))
+        return flushed.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = []
+            flush_events = []
+
+            # Wait for the first record, then gather more until the batch is full or the interval has passed
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+
+            while True:
+                collection, record = item
+                if collection is None:
+                    flush_events.append(record)
+                    break
+
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+            self._write_batch(batch)
+
+            for event in flush_events:
+                event.set()
+
+    def _write_batch(self, batch: List[tuple[str, Any]]):
+        """Groups a batch by collection and writes each group at once."""
+        collections = {}
+        for collection, record in batch:
+            collections.setdefault(collection, []).append(record)
+
+        for collection, records in collections.items():
+            # Retrying here only holds up the writer thread, the game keeps adding records to the queue
+            for attempt in range(self.max_retries + 1):
+                try:
+                    write_records(collection, records)
+                    break
+                except Exception:
+                    if attempt == self.max_retries:
+                        logger.exception(f"Failed to write {len(records)} records to {collection}, dropping them")
+                    else:
+                        logger.warning(f"Failed to write {len(records)} records to {collection}, retrying...")
+                        time.sleep(self.retry_backoff * 2 ** attempt)
+
+
+_writer: BufferedWriter | None = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> BufferedWriter:
+    """Returns the buffered writer of the current process, starting it if needed."""
+    global _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = BufferedWriter()
+        return _writer
+
+
+atexit.register(flush)
 
 
 def get_collection(log_object: Model) -> str:
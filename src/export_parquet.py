@@ -0,0 +1,200 @@
+"""
+Exports the JSONL logs written by data_collection.save to Parquet datasets, so analysis jobs read typed columns
+instead of parsing JSON.
+
+Each collection (messages, players, games) becomes a dataset partitioned by date and game, e.g.
+messages/date=2024-03-01/game_id=abcd1234/part-0-0-0.parquet. Records don't carry a timestamp, so the date is the day
+they were exported. A watermark of how far each log has been exported, across the segments it has been rotated into,
+is kept next to the datasets, so each run only converts the records appended since the last one.
+
+Usage: python src/export_parquet.py [--data-dir DIR] [--output-dir DIR]
+"""
+import argparse
+import datetime
+import json
+import os
+import pathlib
+from typing import Iterator, List
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import player  # data_collection has to be imported after player, which it imports itself
+from data_collection import DATA_DIR
+from segmented_log import LogPosition, get_segmented_log
+
+PARQUET_EXPORT_DIR = os.environ.get("PARQUET_EXPORT_DIR", DATA_DIR / "parquet")
+PARQUET_EXPORT_BATCH_SIZE = int(os.environ.get("PARQUET_EXPORT_BATCH_SIZE", 100_000))
+
+WATERMARK_FILE = "_watermark.json"
+
+# Low cardinality strings are dictionary encoded, which is how pandas reads them back as categoricals
+CATEGORY = pa.dictionary(pa.int8(), pa.string())
+
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.date32()), ("game_id", pa.string())]), flavor="hive")
+
+SCHEMAS = {
+    "messages": pa.schema([
+        ("message_number", pa.int64()),
+        ("type", CATEGORY),
+        ("content", pa.string()),
+        ("agent_ids", pa.list_(pa.string())),
+        ("game_id", pa.string()),
+        ("date", pa.date32()),
+    ]),
+    "players": pa.schema([
+        ("player_id", pa.string()),
+        ("name", pa.string()),
+        ("message_level", CATEGORY),
+        ("points", pa.int32()),
+        ("roles", pa.list_(CATEGORY)),
+        ("game_id", pa.string()),
+        ("date", pa.date32()),
+    ]),
+    "games": pa.schema([
+        ("winner_id", pa.string()),
+        ("winning_score", pa.int32()),
+        ("observer", pa.struct([
+            ("name", pa.string()),
+            ("player_id", pa.string()),
+            ("game_id", pa.string()),
+            ("message_level", pa.string()),
+        ])),
+        ("chameleon_ids", pa.list_(pa.string())),
+        ("herd_animals", pa.list_(pa.string())),
+        ("all_animal_descriptions", pa.list_(pa.list_(pa.struct([
+            ("player_id", pa.string()),
+            ("description", pa.string()),
+        ])))),
+        ("chameleon_guesses", pa.list_(pa.string())),
+        ("herd_vote_tallies", pa.list_(pa.list_(pa.struct([
+            ("voter_id", pa.string()),
+            ("voted_for_id", pa.string()),
+        ])))),
+        ("game_id", pa.string()),
+        ("date", pa.date32()),
+    ]),
+}
+"""The columns of each dataset, fields of the records that aren't listed are not exported."""
+
+
+class ParquetExporter:
+    """Converts the records appended to the JSONL logs into partitioned Parquet datasets."""
+
+    def __init__(
+            self,
+            data_dir: str | os.PathLike = DATA_DIR,
+            output_dir: str | os.PathLike = PARQUET_EXPORT_DIR,
+            batch_size: int = PARQUET_EXPORT_BATCH_SIZE
+    ):
+        self.data_dir = pathlib.Path(data_dir)
+        """The directory containing the JSONL files."""
+        self.output_dir = pathlib.Path(output_dir)
+        """The directory the datasets are written to, one subdirectory per collection."""
+        self.batch_size = batch_size
+        """The maximum number of records converted at once, which bounds the memory used by a run."""
+
+    @property
+    def watermark_path(self) -> pathlib.Path:
+        return self.output_dir / WATERMARK_FILE
+
+    def load_watermark(self) -> dict[str, LogPosition]:
+        """Returns the position in each log up to which records have been exported."""
+        try:
+            with open(self.watermark_path) as f:
+                watermark = json.load(f)
+        except FileNotFoundError:
+            return {}
+
+        # Watermarks from before logs were segmented are byte offsets into what is now the first segment
+        return {
+            collection: LogPosition(0, position) if isinstance(position, int) else LogPosition(*position)
+            for collection, position in watermark.items()
+        }
+
+    def save_watermark(self, watermark: dict[str, LogPosition]):
+        # Replaced atomically, so a crash leaves either the old or the new watermark
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        temporary_path = self.watermark_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(watermark, f)
+        os.replace(temporary_path, self.watermark_path)
+
+    def run(self) -> dict[str, int]:
+        """Exports the records appended since the last run, and returns the number exported from each collection."""
+        watermark = self.load_watermark()
+        exported = {}
+
+        for collection in SCHEMAS:
+            exported[collection] = 0
+            for records, start, end in self._read_batches(collection, watermark.get(collection, LogPosition(0, 0))):
+                self._write_batch(collection, records, start)
+                # Only moved on once the batch is written, a crash in between exports the batch again next run
+                watermark[collection] = end
+                self.save_watermark(watermark)
+                exported[collection] += len(records)
+
+        return exported
+
+    def _read_batches(
+            self, collection: str, position: LogPosition
+    ) -> Iterator[tuple[List[dict], LogPosition, LogPosition]]:
+        """Yields batches of complete records after the position, along with the positions they were read between."""
+        start, records = position, []
+        # A line still being written isn't read, it will be exported by the next run
+        for position, line in get_segmented_log(self.data_dir, collection).iter_lines(position):
+            if not records:
+                start = position
+            records.append(json.loads(line))
+            position = LogPosition(position.segment, position.offset + len(line))
+
+            if len(records) >= self.batch_size:
+                yield records, start, position
+                records = []
+
+        if records:
+            yield records, start, position
+
+    def _write_batch(self, collection: str, records: List[dict], start: LogPosition):
+        schema = SCHEMAS[collection]
+        today = datetime.date.today()
+        for record in records:
+            record["date"] = today
+
+        table = pa.Table.from_pylist(records, schema=schema)
+        ds.write_dataset(
+            table,
+            self.output_dir / collection,
+            format="parquet",
+            partitioning=PARTITIONING,
+            # Named after where the batch starts, so exporting the same batch again overwrites it instead of adding to it
+            basename_template=f"part-{start.segment}-{start.offset}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore"
+        )
+
+    def dataset(self, collection: str) -> ds.Dataset:
+        """
+        Returns an exported dataset, filters on date and game_id only read the matching partitions.
+        E.g. exporter.dataset("messages").to_table(filter=ds.field("game_id") == game_id).to_pandas()
+        """
+        return ds.dataset(
+            self.output_dir / collection,
+            schema=SCHEMAS[collection],
+            format="parquet",
+            partitioning=PARTITIONING
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the JSONL game logs to Parquet.")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="The directory containing the JSONL files.")
+    parser.add_argument("--output-dir", default=PARQUET_EXPORT_DIR, help="The directory to write the datasets to.")
+    args = parser.parse_args()
+
+    exported = ParquetExporter(args.data_dir, args.output_dir).run()
+    for collection, count in exported.items():
+        print(f"Exported {count} {collection}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,49 @@
-from typing import Optional, Type, List, ClassVar
+import logging
+import time
+from typing import Optional, Type, List, ClassVar, Any, Callable, ContextManager
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ConfigDict, PrivateAttr
+from pydantic_core import to_jsonable_python
 
 from game_utils import *
-from message import Message, MessageType, AgentMessage
-from agent_interfaces import HumanAgentCLI, OpenAIAgentInterface, HumanAgentInterface
+import message
+from message import Message, MessageType, AgentMessage, MessageLog, PartialMessage
+from agent_interfaces import HumanAgentCLI, OpenAIAgentInterface, HumanAgentInterface, BaseAgentInterface
 from player import Player
-from data_collection import save
+from data_collection import save, flush, DATA_COLLECTION_FLUSH_TIMEOUT
+from checkpoint import CheckpointStore, default_checkpoint_store
+from metrics import MetricsRegistry, default_metrics
+import tracing
+from tracing import Tracer, start_tracing
+
+logger = logging.getLogger(__name__)
+
+
+class StepResult(BaseModel):
+    """What a game is waiting on after a step."""
+
+    game_state: str
+    """The state of the game after the step."""
+    player_id: str | None = None
+    """The id of the player whose turn is next, None if the next step doesn't wait on a player."""
+    awaiting_input: bool = False
+    """Whether the game can't go on until a human player responds."""
+
+    @property
+    def is_finished(self) -> bool:
+        """Whether the game has ended."""
+        return self.game_state == "game_end"
+
+    @property
+    def can_step(self) -> bool:
+        """Whether the game can be stepped again right away."""
+        return not self.awaiting_input and not self.is_finished
+
 
 # Abstracting the Game Class is a WIP so that future games can be added
 class Game(BaseModel):
     """Base class for all games."""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
 
     # Required
 
@@ -29,6 +62,16 @@ class Game(BaseModel):
     """Keeps track of the current state of the game."""
     awaiting_input: bool = Field(False, exclude=True)
     """Whether the game is currently awaiting input from a player."""
+    checkpoint_store: Any = Field(default_factory=default_checkpoint_store, exclude=True)
+    """Where snapshots of the game are stored so it can be resumed, None means the game isn't checkpointed."""
+    message_log: MessageLog = Field(default_factory=MessageLog, exclude=True)
+    """Every message sent during the game, the message history of each player is a view of it."""
+    started_at: float | None = Field(None, exclude=True)
+    """When the game started as a Unix timestamp, so its duration is known even if it's resumed. None until it has."""
+    metrics: MetricsRegistry = Field(default_factory=default_metrics, exclude=True)
+    """Where the durations of the game and its rounds are recorded, exported when the game ends."""
+    tracer: Tracer | None = Field(None, exclude=True)
+    """Records the spans of the game, exported when it ends or waits on a human. None means it isn't traced."""
 
     # Class Variables
 
@@ -37,49 +80,123 @@ class Game(BaseModel):
     player_class: ClassVar[Type[Player]] = Player
     """The class of the player used in the game."""
 
+    # Private
+
+    _players_by_id: dict[str, Player] = PrivateAttr(default_factory=dict)
+    _players_by_name: dict[str, Player] = PrivateAttr(default_factory=dict)
+    # The number of messages of the log already in the checkpoint store, the next checkpoint only stores those after
+    _checkpointed_messages: int = PrivateAttr(0)
+
+    def model_post_init(self, __context: Any):
+        """
+        Makes the message history of every player a view of the game's message log, and indexes the players.
+        Starts tracing the game if tracing is enabled.
+        """
+        for player in self.players + ([self.observer] if self.observer else []):
+            player.interface.join_log(self.message_log, player.can_receive_message)
+        self.index_players()
+        if self.tracer is None:
+            self.tracer = start_tracing(self.game_id)
+            if self.tracer is not None and self.started_at is not None:
+                # A resumed game, its trace picks up where the checkpoint left off
+                self.tracer.begin("game", f"game {self.game_id}", resumed=True)
+                self.tracer.begin("phase", self.game_state)
+
+    def index_players(self):
+        """Indexes the players by id and name, must be called again if players join or leave the game."""
+        self._players_by_id = {player.player_id: player for player in self.players}
+        self._players_by_name = {player.name: player for player in self.players}
+
+    @property
+    def kind(self) -> str:
+        """Whether a human is playing (interactive) or only AI players (background), like the rate limiter priorities."""
+        return "interactive" if any(player.interface.is_human for player in self.players) else "background"
+
     def player_from_id(self, player_id: str) -> Player:
         """Returns a player from their ID."""
-        return next((player for player in self.players if player.player_id == player_id), None)
+        return self._players_by_id.get(player_id)
 
     def player_from_name(self, name: str) -> Player:
         """Returns a player from their name."""
-        return next((player for player in self.players if player.name == name), None)
+        return self._players_by_name.get(name)
 
     def game_message(
             self,
             content: str,
             recipient: Player | List[Player] | None = None,  # If None, message is broadcast to all players
-            exclude: bool = False,  # If True, the message is broadcast to all players except the chosen player
+            exclude: bool = False,  # If True, the message is broadcast to all players except the chosen players
             message_type: MessageType = "info"
     ):
         """
         Sends a message to a player or all players.
         If no recipient is specified, the message is broadcast to all players.
-        If exclude is True, the message is broadcast to all players except the recipient.
+        If exclude is True, the message is broadcast to all players except the recipient (or recipients).
         Some message types are only available to player with access (e.g. verbose, debug).
         """
+        message = Message(type=message_type, content=content)
+        recipients = self.recipients(recipient, exclude)
+
         if exclude or not recipient:
-            # These are public messages, exclude is used to exclude the sender from the recipient list.
-            recipients = [player for player in self.players if player != recipient]
-            if self.observer:
-                recipients.append(self.observer)
+            # The message is logged once, and each player's history decides whether they can see it
+            everyone = self.players + ([self.observer] if self.observer else [])
+            receiving_ids = {player.player_id for player in recipients}
+            excluded_ids = [player.player_id for player in everyone if player.player_id not in receiving_ids]
+            self.message_log.append(message, excluded_ids=excluded_ids)
         else:
-            if isinstance(recipient, Player):
-                recipients = [recipient]
-            else:
-                recipients = recipient
-
-        message = Message(type=message_type, content=content)
-        recipient_ids = []
+            self.message_log.append(message, [player.player_id for player in recipients])
 
-        for player in recipients:
-            if player.can_receive_message(message_type):
-                player.interface.add_message(message)
-                recipient_ids.append(player.player_id)
+        recipient_ids = [player.player_id for player in recipients if player.can_receive_message(message_type)]
 
         agent_message = AgentMessage.from_message(message, recipient_ids, self.game_id)
         save(agent_message)
 
+    def recipients(self, recipient: Player | List[Player] | None = None, exclude: bool = False) -> List[Player]:
+        """Returns the players a message is sent to, the observer included for public messages. See game_message."""
+        if exclude or not recipient:
+            # These are public messages, exclude is used to exclude the sender (or senders) from the recipient list.
+            excluded = [recipient] if isinstance(recipient, Player) else recipient or []
+            excluded_ids = {player.player_id for player in excluded}
+            recipients = [player for player in self.players if player.player_id not in excluded_ids]
+            if self.observer:
+                recipients.append(self.observer)
+            return recipients
+        elif isinstance(recipient, Player):
+            return [recipient]
+        else:
+            return recipient
+
+    def stream_message(
+            self,
+            content: str,
+            recipient: Player | List[Player] | None = None,
+            exclude: bool = False,
+            message_type: MessageType = "info"
+    ):
+        """
+        Shows a message that is still being generated to the players game_message would send it to, if their interface
+        shows partial messages. It isn't logged or saved, the complete message is sent with game_message once it's done.
+        """
+        message = PartialMessage(type=message_type, content=content)
+        for player in self.recipients(recipient, exclude):
+            if player.interface.shows_partial_messages and player.can_receive_message(message_type):
+                player.interface.on_partial_message(message)
+
+    def message_streamer(
+            self,
+            prefix: str,
+            recipient: Player | List[Player] | None = None,
+            exclude: bool = False,
+            message_type: MessageType = "info"
+    ) -> Callable[[str], Any] | None:
+        """
+        Returns a callback streaming the content generated so far, after the prefix, to the recipients.
+        Returns None if none of them show partial messages, so that nothing is streamed for no one.
+        """
+        recipients = self.recipients(recipient, exclude)
+        if not any(player.interface.shows_partial_messages for player in recipients):
+            return None
+        return lambda content: self.stream_message(prefix + content, recipient, exclude, message_type)
+
 
     def verbose_message(self, content: str, **kwargs):
         """
@@ -99,9 +216,80 @@ class Game(BaseModel):
         """
         self.game_message(content, **kwargs, message_type="debug")
 
-    def run_game(self):
-        """Runs the game."""
-        raise NotImplementedError("The run_game method must be implemented by the subclass.")
+    def turn_span(self, player: Player, action: str) -> ContextManager:
+        """Returns a context manager recording a player's turn in the game's trace, e.g. Abby's vote."""
+        return tracing.span(self.game_id, f"{player.name}'s {action}", "turn", player_id=player.player_id)
+
+    def set_game_state(self, game_state: str):
+        """Moves the game to a new state, and checkpoints it. Each state is a phase of the game in its trace."""
+        tracing.end(self.game_id, "phase")
+        self.game_state = game_state
+        if game_state != "game_end":
+            tracing.begin(self.game_id, "phase", game_state)
+        self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Stores a snapshot of the game, if it has a checkpoint store.
+        Only the messages logged since the previous checkpoint are stored with it, rather than the whole log.
+        """
+        if self.checkpoint_store is not None:
+            with tracing.span(self.game_id, "checkpoint", "save"):
+                start = self._checkpointed_messages
+                log_records = self.message_log.to_records(start)
+                self.checkpoint_store.save(self.game_id, self.snapshot(include_log=False), log_records, start)
+                self._checkpointed_messages = start + len(log_records)
+
+    def snapshot(self, include_log: bool = True) -> dict:
+        """
+        Returns the full state of the game as JSON data, including the players and their message histories.
+        Without include_log the message log is left out, only its length is recorded (see checkpoint).
+        """
+        fields = {
+            name: getattr(self, name) for name in self.model_fields
+            if name not in ["players", "observer", "checkpoint_store", "message_log", "metrics", "tracer"]
+        }
+        fields["players"] = [self.player_snapshot(player) for player in self.players]
+        fields["observer"] = self.player_snapshot(self.observer) if self.observer else None
+        # The message histories of the players are rebuilt from the log
+        fields["message_count"] = len(self.message_log.entries)
+        if include_log:
+            fields["message_log"] = self.message_log.to_records()
+        # Messages numbers are counted per process, so a resumed game has to carry on from here
+        fields["next_message_number"] = message.message_number
+
+        return to_jsonable_python(fields)
+
+    @staticmethod
+    def player_snapshot(player: Player) -> dict:
+        """Returns the state of a player, including the settings of their interface."""
+        return {**player.model_dump(), "interface": player.interface.model_dump(exclude={"messages"})}
+
+    def step(self) -> StepResult:
+        """Runs the next unit of work in the game, and returns what the game is waiting on."""
+        raise NotImplementedError("The step method must be implemented by the subclass.")
+
+    async def astep(self) -> StepResult:
+        """Async version of step."""
+        raise NotImplementedError("The astep method must be implemented by the subclass.")
+
+    def run_game(self) -> StepResult:
+        """
+        Runs the game until it ends, or until it is awaiting input from a human player.
+        Runs under cProfile if profiling is enabled, see tracing.profiled.
+        """
+        with tracing.profiled(self.game_id):
+            result = self.step()
+            while result.can_step:
+                result = self.step()
+        return result
+
+    async def arun_game(self) -> StepResult:
+        """Async version of run_game."""
+        result = await self.astep()
+        while result.can_step:
+            result = await self.astep()
+        return result
 
     def end_game(self):
         """Ends the game and declares a winner."""
@@ -109,12 +297,66 @@ class Game(BaseModel):
             save(player)
 
         save(self)
+        # Give the whole game a chance to be written before anything else happens, without holding up the game thread
+        # while a failing database is retried. The writer carries on in the background, and is flushed on exit
+        if not flush(timeout=DATA_COLLECTION_FLUSH_TIMEOUT):
+            logger.warning(f"Game {self.game_id} wasn't fully written after {DATA_COLLECTION_FLUSH_TIMEOUT}s")
+
+        if self.started_at is not None:
+            self.metrics.game_seconds.observe(time.time() - self.started_at, kind=self.kind)
+        self.metrics.export()
+
+        if self.tracer is not None:
+            self.tracer.end("game")
+            self.tracer.export()
+
+    @classmethod
+    def from_snapshot(
+            cls, snapshot: dict,
+            human_interface: Type[HumanAgentInterface] = HumanAgentCLI,
+            ai_interface: Type[BaseAgentInterface] = OpenAIAgentInterface,
+            **kwargs
+    ):
+        """
+        Recreates a game from a snapshot, e.g. to resume it in a new process.
+        Interfaces are recreated with the same settings and message history, human players and the observer with
+        human_interface, and AI players with ai_interface.
+        """
+        fields = dict(snapshot)
+        message.skip_message_numbers(fields.pop("next_message_number", 0))
+        fields.pop("message_count", None)
+        fields["message_log"] = MessageLog.from_records(fields["message_log"])
+
+        def restore_player(player_class: Type[Player], player_fields: dict) -> Player:
+            interface_fields = player_fields.pop("interface")
+            interface_type = human_interface if interface_fields["is_human"] else ai_interface
+            return player_class(**player_fields, interface=interface_type(**interface_fields))
+
+        fields["players"] = [restore_player(cls.player_class, player) for player in fields["players"]]
+        if fields["observer"]:
+            fields["observer"] = restore_player(Player, fields["observer"])
+
+        return cls(**fields, **kwargs)
+
+    @classmethod
+    def resume(cls, game_id: str, checkpoint_store: CheckpointStore = None, **kwargs):
+        """Recreates a game from its latest snapshot, returns None if it hasn't been checkpointed."""
+        checkpoint_store = checkpoint_store or default_checkpoint_store()
+        snapshot = checkpoint_store.load(game_id) if checkpoint_store else None
+        if snapshot is None:
+            return None
+
+        game = cls.from_snapshot(snapshot, checkpoint_store=checkpoint_store, **kwargs)
+        # The store already has the log, so the next checkpoint carries on after it
+        game._checkpointed_messages = len(game.message_log.entries)
+        return game
 
     @classmethod
     def from_human_name(
             cls, human_name: str = None,
             human_interface: Type[HumanAgentInterface] = HumanAgentCLI,
-            human_message_level: str = "verbose"
+            human_message_level: str = "verbose",
+            ai_interface: Type[BaseAgentInterface] = OpenAIAgentInterface
     ):
         """
         Instantiates a game with a human player if a name is provided.
@@ -144,8 +386,10 @@ class Game(BaseModel):
             else:
                 player_dict["name"] = ai_names.pop()
                 player_id = f"{game_id}-{player_dict['name']}"
-                # all AI players use the OpenAI interface for now - this can be changed in the future
-                player_dict["interface"] = OpenAIAgentInterface(agent_id=player_id, game_id=game_id)
+                # all AI players use the same interface, by default the OpenAI interface
+                # Games with a human waiting on them get their completions first when requests are rate limited
+                priority = "interactive" if human_name else "background"
+                player_dict["interface"] = ai_interface(agent_id=player_id, game_id=game_id, priority=priority)
                 player_dict["message_level"] = "info"
 
             player_dict["player_id"] = player_id
@@ -1,12 +1,20 @@
+import asyncio
+import os
+import time
 from collections import Counter
-from typing import ClassVar
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import ClassVar, Callable, Any
+
+from pydantic import computed_field
 
 from game_utils import random_index
 from output_formats import *
 from player import ChameleonPlayer, Player
 from prompts import fetch_prompt, format_prompt
 
-from game import Game
+from game import Game, StepResult
+import tracing
 
 # Default Values
 NUMBER_OF_PLAYERS = 6
@@ -16,6 +24,29 @@ AVAILABLE_ANIMALS = ["Dog", "Cat", "Mouse", "Hamster", "Monkey", "Rabbit", "Fox"
                      "Squid", "Hedgehog", "Elephant", "Rhinoceros", "Zebra", "Crocodile", "Whale", "Dolphin", "Camel",
                      "Giraffe", "Deer", "Gorilla", "Goat", "Llama", "Horse", "Unicorn", "Flamingo", "Skunk", "Shark"]
 
+# The Chameleon's guess and the Herd's votes only depend on the descriptions, so AI players can make them all at once
+CHAMELEON_PARALLEL_DECISIONS = os.environ.get("CHAMELEON_PARALLEL_DECISIONS", "false").lower() == "true"
+
+
+@dataclass(slots=True)
+class RoundRecord:
+    """What happened in a round. Slotted, since a long game or a host full of games keeps a lot of them."""
+
+    herd_animal: str
+    """The secret animal of the round."""
+    chameleon_id: str
+    """The id of the player who was the Chameleon."""
+    herd_ids: frozenset[str]
+    """The ids of the players in the Herd."""
+    animal_descriptions: dict[str, str] = field(default_factory=dict)
+    """The description given by each player by their id, in the order they were given."""
+    chameleon_guess: str | None = None
+    """The animal the Chameleon guessed, None until they have guessed."""
+    herd_votes: dict[str, str] = field(default_factory=dict)
+    """The id of the player each member of the Herd voted for by the voter's id, in the order they voted."""
+    started_at: float | None = None
+    """When the round was set up as a Unix timestamp, None for rounds checkpointed before it was recorded."""
+
 
 class ChameleonGame(Game):
     """The main game class, handles the game logic and player interactions."""
@@ -26,16 +57,10 @@ class ChameleonGame(Game):
     """The Number of points required to win the game."""
     available_animals: List[str] = Field(AVAILABLE_ANIMALS, exclude=True)
     """The list of animals that can be chosen as the secret animal."""
-    chameleon_ids: List[str] = []
-    """Record of which player was the chameleon for each round."""
-    herd_animals: List[str] = []
-    """Record of what animal was the herd animal for each round."""
-    all_animal_descriptions: List[List[dict]] = []
-    """Record of the animal descriptions each player has given for each round."""
-    chameleon_guesses: List[str] = []
-    """Record of what animal the chameleon guessed for each round."""
-    herd_vote_tallies: List[List[dict]] = []
-    """Record of the votes of each herd member for the chameleon for each round."""
+    rounds: List[RoundRecord] = Field([], exclude=True)
+    """Record of each round, serialized as the per round lists below."""
+    parallel_decisions: bool = Field(CHAMELEON_PARALLEL_DECISIONS, exclude=True)
+    """Whether the AI players guess and vote concurrently once the descriptions are in, instead of one at a time."""
 
     # Class Variables
 
@@ -44,118 +69,215 @@ class ChameleonGame(Game):
     player_class: ClassVar[Type[Player]] = ChameleonPlayer
     """The class of the player used in the game."""
 
+    # Records in the shape they have always been logged in
+
+    @computed_field
+    @property
+    def chameleon_ids(self) -> List[str]:
+        """Record of which player was the chameleon for each round."""
+        return [round_record.chameleon_id for round_record in self.rounds]
+
+    @computed_field
+    @property
+    def herd_animals(self) -> List[str]:
+        """Record of what animal was the herd animal for each round."""
+        return [round_record.herd_animal for round_record in self.rounds]
+
+    @computed_field
+    @property
+    def all_animal_descriptions(self) -> List[List[dict]]:
+        """Record of the animal descriptions each player has given for each round."""
+        return [
+            [
+                {"player_id": player_id, "description": description}
+                for player_id, description in round_record.animal_descriptions.items()
+            ]
+            for round_record in self.rounds
+        ]
+
+    @computed_field
+    @property
+    def chameleon_guesses(self) -> List[str]:
+        """Record of what animal the chameleon guessed for each round."""
+        return [round_record.chameleon_guess for round_record in self.rounds if round_record.chameleon_guess is not None]
+
+    @computed_field
+    @property
+    def herd_vote_tallies(self) -> List[List[dict]]:
+        """Record of the votes of each herd member for the chameleon for each round."""
+        return [
+            [
+                {"voter_id": voter_id, "voted_for_id": voted_for_id}
+                for voter_id, voted_for_id in round_record.herd_votes.items()
+            ]
+            for round_record in self.rounds
+        ]
+
+    @property
+    def current_round(self) -> RoundRecord:
+        """Returns the record of the current round."""
+        return self.rounds[-1]
+
     @property
     def chameleon(self) -> ChameleonPlayer:
         """Returns the current chameleon."""
-        return self.player_from_id(self.chameleon_ids[-1])
+        return self.player_from_id(self.current_round.chameleon_id)
 
     @property
     def chameleon_id(self) -> str:
         """Returns the current chameleon's id."""
-        return self.chameleon_ids[-1]
+        return self.current_round.chameleon_id
 
     @property
     def herd_animal(self) -> str:
         """Returns the current herd animal."""
-        return self.herd_animals[-1]
-
-    @property
-    def round_animal_descriptions(self) -> List[dict]:
-        """Returns the current animal descriptions."""
-        return self.all_animal_descriptions[-1]
+        return self.current_round.herd_animal
 
     @property
     def chameleon_guess(self) -> str:
         """Returns the current chameleon guess."""
-        return self.chameleon_guesses[-1]
+        return self.current_round.chameleon_guess
 
     @property
-    def herd_vote_tally(self) -> List[dict]:
-        """Returns the current herd vote tally."""
-        return self.herd_vote_tallies[-1]
-
-    def run_game(self):
-        """Starts the game."""
-
-        # Check if the game has not been won
-        if self.game_state != "game_end":
-            if self.game_state == "game_start":
-                self.game_message(fetch_prompt("game_rules"), message_type="system")
-                self.game_state = "setup_round"
-            if self.game_state == "setup_round":
-                self.setup_round()
-                self.game_state = "animal_description"
-            if self.game_state in ["animal_description", "chameleon_guess", "herd_vote"]:
-                self.run_round()
-            if self.game_state == "resolve_round":
-                self.resolve_round()
-
-                points = [player.points for player in self.players]
-
-                if max(points) >= self.winning_score:
-                    self.game_state = "game_end"
-                    self.winner_id = self.players[points.index(max(points))].player_id
-                    winner = self.player_from_id(self.winner_id)
-                    self.game_message(f"The game is over {winner.name} has won!")
-                    self.end_game()
-
-                else:
-                    self.game_state = "setup_round"
-                    # Go back to start
-                    self.game_message(f"No player has won yet, the game will end when a player reaches {self.winning_score} points.")
-                    self.game_message(f"Starting a new round...")
-                    random.shuffle(self.players)
-                    self.run_game()
-
-    def run_round(self):
-        """Starts the round."""
-
-        # Phase I: Collect Player Animal Descriptions
+    def current_player(self) -> ChameleonPlayer | None:
+        """Returns the player whose turn it is, or None outside of the player turns."""
         if self.game_state == "animal_description":
-            for current_player in self.players:
-                if current_player.player_id not in [animal_description['player_id'] for animal_description in
-                                                    self.round_animal_descriptions]:
+            described = self.current_round.animal_descriptions
+            return next((player for player in self.players if player.player_id not in described), None)
+        elif self.game_state == "chameleon_guess":
+            return self.chameleon
+        elif self.game_state == "herd_vote":
+            herd_ids, voted = self.current_round.herd_ids, self.current_round.herd_votes
+            return next(
+                (player for player in self.players if player.player_id in herd_ids and player.player_id not in voted),
+                None
+            )
+        else:
+            return None
+
+    def step(self) -> StepResult:
+        """
+        Runs the next unit of work in the game and returns what the game is waiting on.
+        A unit of work is setting up a round, a single player turn, or resolving a round.
+        """
+        if self.game_state == "game_start":
+            self.started_at = time.time()
+            tracing.begin(self.game_id, "game", f"game {self.game_id}")
+            self.game_message(fetch_prompt("game_rules"), message_type="system")
+            self.set_game_state("setup_round")
+
+        elif self.game_state == "setup_round":
+            self.setup_round()
+            self.set_game_state("animal_description")
+
+        elif self.game_state == "animal_description":
+            self.player_turn_animal_description(self.current_player)
+
+        elif self.game_state == "chameleon_guess":
+            if self.parallel_decisions and not self.awaiting_input:
+                self.decision_phase()
+            else:
+                self.player_turn_chameleon_guess(self.chameleon)
+
+        elif self.game_state == "herd_vote":
+            self.announce_herd_vote()
+            self.player_turn_herd_vote(self.current_player)
 
-                    response = self.player_turn_animal_description(current_player)
+        elif self.game_state == "resolve_round":
+            self.resolve_round()
+            self.end_round()
 
-                    if not response:
-                        break
+        return self.end_step()
 
-            if len(self.round_animal_descriptions) == len(self.players):
-                self.game_state = "chameleon_guess"
+    async def astep(self) -> StepResult:
+        """Async version of step, AI players wait on the event loop instead of blocking it."""
+        if self.game_state == "animal_description":
+            await self.aplayer_turn_animal_description(self.current_player)
 
-        # Phase II: Chameleon Guesses the Animal
-        if self.game_state == "chameleon_guess":
-            self.player_turn_chameleon_guess(self.chameleon)
+        elif self.game_state == "chameleon_guess":
+            if self.parallel_decisions and not self.awaiting_input:
+                await self.adecision_phase()
+            else:
+                await self.aplayer_turn_chameleon_guess(self.chameleon)
 
-        # Phase III: The Herd Votes for who they think the Chameleon is
-        if self.game_state == "herd_vote":
-            if not self.awaiting_input:
-                self.verbose_message("The Herd is voting...")
-            for current_player in self.players:
-                if current_player.role == "herd" and current_player.player_id not in [vote['voter_id'] for vote in
-                                                                                      self.herd_vote_tally]:
+        elif self.game_state == "herd_vote":
+            self.announce_herd_vote()
+            await self.aplayer_turn_herd_vote(self.current_player)
 
-                    response = self.player_turn_herd_vote(current_player)
+        else:
+            # The other steps don't wait on any player
+            return self.step()
+
+        return self.end_step()
+
+    def end_step(self) -> StepResult:
+        """Moves on to the next phase once every player has taken their turn, and returns what the game is waiting on."""
+        if self.game_state == "animal_description" and self.current_player is None:
+            self.set_game_state("chameleon_guess")
+        elif self.game_state == "herd_vote" and self.current_player is None:
+            self.set_game_state("resolve_round")
+
+        if self.awaiting_input:
+            # Nothing else happens until the human responds, possibly in another process
+            self.checkpoint()
+            if self.tracer is not None:
+                self.tracer.export()
+
+        current_player = self.current_player
+        return StepResult(
+            game_state=self.game_state,
+            player_id=current_player.player_id if current_player else None,
+            awaiting_input=self.awaiting_input
+        )
+
+    def end_round(self):
+        """Ends the game if a player has won, otherwise prepares the next round."""
+        if self.current_round.started_at is not None:
+            self.metrics.round_seconds.observe(time.time() - self.current_round.started_at, kind=self.kind)
+        tracing.end(self.game_id, "round")
+
+        points = [player.points for player in self.players]
+
+        if max(points) >= self.winning_score:
+            self.winner_id = self.players[points.index(max(points))].player_id
+            winner = self.player_from_id(self.winner_id)
+            self.game_message(f"The game is over {winner.name} has won!")
+            self.set_game_state("game_end")
+            self.end_game()
 
-                    if not response:
-                        break
+        else:
+            # Go back to start
+            self.game_message(f"No player has won yet, the game will end when a player reaches {self.winning_score} points.")
+            self.game_message(f"Starting a new round...")
+            random.shuffle(self.players)
+            self.set_game_state("setup_round")
 
-            if len(self.herd_vote_tally) == len(self.players) - 1:
-                self.game_state = "resolve_round"
+    def announce_herd_vote(self):
+        """Lets the observers know the vote has started, before the first vote."""
+        if not self.awaiting_input and not self.current_round.herd_votes:
+            self.verbose_message("The Herd is voting...")
 
     def setup_round(self):
         """Sets up the round. This includes assigning roles and gathering player names."""
+        tracing.begin(self.game_id, "round", f"round {len(self.rounds) + 1}")
+        # Mark the start of the round in every history, so agents can compact the rounds before it
+        previous_round_summary = self.round_summary(len(self.rounds) - 1) if self.rounds else None
+        for player in self.players:
+            player.interface.start_round(previous_round_summary)
+
         # Choose Animal
         herd_animal = self.random_animal()
-        self.herd_animals.append(herd_animal)
         self.debug_message(f"The secret animal is {herd_animal}.")
 
         # Assign Roles
         chameleon_index = random_index(len(self.players))
         chameleon = self.players[chameleon_index]
 
-        self.chameleon_ids.append(chameleon.player_id)
+        # Start the round's record, with empty animal descriptions and votes
+        herd_ids = frozenset(player.player_id for player in self.players if player != chameleon)
+        self.rounds.append(RoundRecord(
+            herd_animal=herd_animal, chameleon_id=chameleon.player_id, herd_ids=herd_ids, started_at=time.time()
+        ))
 
         self.game_message(fetch_prompt("assign_chameleon"), chameleon)
 
@@ -177,25 +299,43 @@ class ChameleonGame(Game):
             else:
                 player.assign_role("herd")
 
-        # Empty Animal Descriptions
-        self.all_animal_descriptions.append([])
-
-        # Empty Tally for Votes
-        self.herd_vote_tallies.append([])
-
         self.game_message(f"Each player will now take turns describing themselves:")
 
+    # Player turns are split in two halves around the blocking response, so that the sync and async versions share them
+
     def player_turn_animal_description(self, player: Player):
         """Handles a player's turn to describe themselves."""
+        with self.turn_span(player, "description"):
+            self.prompt_animal_description(player)
+            response = player.interface.generate_formatted_response(
+                AnimalDescriptionFormat, on_partial_output=self.description_streamer(player)
+            )
+            return self.record_animal_description(player, response)
+
+    async def aplayer_turn_animal_description(self, player: Player):
+        """Async version of player_turn_animal_description."""
+        with self.turn_span(player, "description"):
+            self.prompt_animal_description(player)
+            response = await player.interface.agenerate_formatted_response(
+                AnimalDescriptionFormat, on_partial_output=self.description_streamer(player)
+            )
+            return self.record_animal_description(player, response)
+
+    def description_streamer(self, player: Player) -> Callable[[str], Any] | None:
+        """Returns the callback showing a player's description to the others as it's generated, if any of them can."""
+        # Shown the way record_animal_description sends the validated description, which replaces it
+        return self.message_streamer(f"{player.name}: ", player, exclude=True)
+
+    def prompt_animal_description(self, player: Player):
+        """Asks a player to describe themselves, unless they have already been asked."""
         if not self.awaiting_input:
             self.verbose_message(f"{player.name} is thinking...", recipient=player, exclude=True)
             self.game_message(fetch_prompt("player_describe_animal"), player)
 
-        # Get Player Animal Description
-        response = player.interface.generate_formatted_response(AnimalDescriptionFormat)
-
+    def record_animal_description(self, player: Player, response: AnimalDescriptionFormat | None):
+        """Records a player's animal description, or waits for input if there is no response yet."""
         if response:
-            self.round_animal_descriptions.append({"player_id": player.player_id, "description": response.description})
+            self.current_round.animal_descriptions[player.player_id] = response.description
             self.game_message(f"{player.name}: {response.description}", player, exclude=True)
             self.awaiting_input = False
         else:
@@ -205,6 +345,26 @@ class ChameleonGame(Game):
 
     def player_turn_chameleon_guess(self, chameleon: Player):
         """Handles the Chameleon's turn to guess the secret animal."""
+        with self.turn_span(chameleon, "guess"):
+            self.prompt_chameleon_guess(chameleon)
+            additional_fields = {"animal_names": AVAILABLE_ANIMALS}
+            response = chameleon.interface.generate_formatted_response(
+                ChameleonGuessFormat, additional_fields=additional_fields
+            )
+            return self.record_chameleon_guess(response)
+
+    async def aplayer_turn_chameleon_guess(self, chameleon: Player):
+        """Async version of player_turn_chameleon_guess."""
+        with self.turn_span(chameleon, "guess"):
+            self.prompt_chameleon_guess(chameleon)
+            additional_fields = {"animal_names": AVAILABLE_ANIMALS}
+            response = await chameleon.interface.agenerate_formatted_response(
+                ChameleonGuessFormat, additional_fields=additional_fields
+            )
+            return self.record_chameleon_guess(response)
+
+    def prompt_chameleon_guess(self, chameleon: Player):
+        """Asks the Chameleon to guess the secret animal, unless they have already been asked."""
         if not self.awaiting_input:
             self.game_message("All players have spoken. The Chameleon will now guess the secret animal...")
             self.verbose_message("The Chameleon is guessing...", recipient=chameleon, exclude=True)
@@ -212,51 +372,164 @@ class ChameleonGame(Game):
             self.game_message(format_prompt("chameleon_guess_animal", player_responses=player_responses),
                               self.chameleon)
 
-        response = chameleon.interface.generate_formatted_response(ChameleonGuessFormat)
-
+    def record_chameleon_guess(self, response: ChameleonGuessFormat | None):
+        """Records the Chameleon's guess and moves on to the vote, or waits for input if there is no response yet."""
         if response:
-            self.chameleon_guesses.append(response.animal)
+            self.current_round.chameleon_guess = response.animal
             self.game_message(
                 "The Chameleon has guessed the animal. Now the Herd will vote on who they think the chameleon is.")
             self.awaiting_input = False
-            self.game_state = "herd_vote"
+            self.set_game_state("herd_vote")
         else:
             # Await input and do not proceed to the next phase
             self.awaiting_input = True
 
+        return response
+
     def player_turn_herd_vote(self, player: Player):
         """Handles a player's turn to vote for the Chameleon."""
+        with self.turn_span(player, "vote"):
+            additional_fields = self.prompt_herd_vote(player)
+            response = player.interface.generate_formatted_response(HerdVoteFormat, additional_fields=additional_fields)
+            return self.record_herd_vote(player, response)
+
+    async def aplayer_turn_herd_vote(self, player: Player):
+        """Async version of player_turn_herd_vote."""
+        with self.turn_span(player, "vote"):
+            additional_fields = self.prompt_herd_vote(player)
+            response = await player.interface.agenerate_formatted_response(
+                HerdVoteFormat, additional_fields=additional_fields
+            )
+            return self.record_herd_vote(player, response)
+
+    def prompt_herd_vote(self, player: Player) -> dict:
+        """Asks a player to vote, unless they have already been asked. Returns the additional fields of the vote."""
         if not self.awaiting_input:
             player_responses = self.format_animal_descriptions(exclude=player)
             self.game_message(format_prompt("vote", player_responses=player_responses), player)
 
-        # Get Player Vote
-        additional_fields = {"player_names": [p.name for p in self.players if p != player]}
-        response = player.interface.generate_formatted_response(HerdVoteFormat, additional_fields=additional_fields)
+        return self.herd_vote_fields(player)
 
+    def herd_vote_fields(self, player: Player) -> dict:
+        """Returns the additional fields of a player's vote."""
+        return {"player_names": [p.name for p in self.players if p != player]}
+
+    def record_herd_vote(self, player: Player, response: HerdVoteFormat | None):
+        """Records a player's vote, or waits for input if there is no response yet."""
         if response:
             self.debug_message(f"{player.name} voted for {response.vote}", recipient=player, exclude=True)
 
             voted_for_player = self.player_from_name(response.vote)
 
-            player_vote = {"voter_id": player.player_id, "voted_for_id": voted_for_player.player_id}
-
-            self.herd_vote_tally.append(player_vote)
+            self.current_round.herd_votes[player.player_id] = voted_for_player.player_id
             self.awaiting_input = False
         else:
             self.awaiting_input = True
 
         return response
 
+    # Parallel decisions - the guess and the votes are made at once, and recorded in the order of the sequential game
+
+    def decision_phase(self):
+        """
+        Prompts the Chameleon and the Herd at once, and has the AI players decide concurrently on a thread pool.
+        Their decisions are recorded in a fixed order, the guess first and then the votes in player order, so the
+        game plays out the same whichever finishes first. Human players decide after, without being prompted again.
+        """
+        deciding_players = self.prompt_decisions()
+        ai_players = [player for player in deciding_players if player.interface.is_ai]
+
+        with ThreadPoolExecutor(max_workers=max(len(ai_players), 1), thread_name_prefix="decisions") as executor:
+            futures = [executor.submit(self.decide, player) for player in ai_players]
+        # Every decision has finished by now, a failure is raised once the others are done with the game
+        self.record_decisions(ai_players, [future.result() for future in futures])
+
+        for player in deciding_players:
+            if player.interface.is_human:
+                self.awaiting_input = True
+                if not self.player_turn_decision(player):
+                    break
+
+    async def adecision_phase(self):
+        """Async version of decision_phase, the AI players decide concurrently on the event loop."""
+        deciding_players = self.prompt_decisions()
+        ai_players = [player for player in deciding_players if player.interface.is_ai]
+
+        responses = await asyncio.gather(
+            *(self.adecide(player) for player in ai_players),
+            return_exceptions=True
+        )
+        for response in responses:
+            if isinstance(response, BaseException):
+                raise response
+        self.record_decisions(ai_players, responses)
+
+        for player in deciding_players:
+            if player.interface.is_human:
+                self.awaiting_input = True
+                if not await self.aplayer_turn_decision(player):
+                    break
+
+    def decide(self, player: Player) -> ChameleonGuessFormat | HerdVoteFormat | None:
+        """Has an AI player make their decision, on a track of their own in the trace as they decide at once."""
+        output_format, additional_fields = self.decision_format(player)
+        with tracing.track(player.name), self.turn_span(player, output_format.phase):
+            return player.interface.generate_formatted_response(output_format, additional_fields)
+
+    async def adecide(self, player: Player) -> ChameleonGuessFormat | HerdVoteFormat | None:
+        """Async version of decide."""
+        output_format, additional_fields = self.decision_format(player)
+        with tracing.track(player.name), self.turn_span(player, output_format.phase):
+            return await player.interface.agenerate_formatted_response(output_format, additional_fields)
+
+    def prompt_decisions(self) -> List[Player]:
+        """Asks the Chameleon to guess and the Herd to vote, and returns the players deciding, the Chameleon first."""
+        chameleon = self.chameleon
+        herd = [player for player in self.players if player.player_id in self.current_round.herd_ids]
+
+        self.prompt_chameleon_guess(chameleon)
+        self.announce_herd_vote()
+        for player in herd:
+            self.prompt_herd_vote(player)
+
+        return [chameleon] + herd
+
+    def decision_format(self, player: Player) -> tuple[Type[OutputFormatModel], dict]:
+        """Returns the output format of a player's decision and its additional fields, a guess or a vote."""
+        if player.player_id == self.chameleon_id:
+            return ChameleonGuessFormat, {"animal_names": AVAILABLE_ANIMALS}
+        return HerdVoteFormat, self.herd_vote_fields(player)
+
+    def record_decisions(self, players: List[Player], responses: List[ChameleonGuessFormat | HerdVoteFormat | None]):
+        """Records the decisions of the players in order, the Chameleon's guess first."""
+        for player, response in zip(players, responses):
+            if player.player_id == self.chameleon_id:
+                self.record_chameleon_guess(response)
+            else:
+                self.record_herd_vote(player, response)
+
+    def player_turn_decision(self, player: Player):
+        """Handles a player's turn in the decision phase, the Chameleon guesses and the Herd votes."""
+        if player.player_id == self.chameleon_id:
+            return self.player_turn_chameleon_guess(player)
+        return self.player_turn_herd_vote(player)
+
+    async def aplayer_turn_decision(self, player: Player):
+        """Async version of player_turn_decision."""
+        if player.player_id == self.chameleon_id:
+            return await self.aplayer_turn_chameleon_guess(player)
+        return await self.aplayer_turn_herd_vote(player)
+
     def resolve_round(self):
         """Resolves the round, assigns points, and prints the results."""
         self.game_message("All players have voted!")
-        for vote in self.herd_vote_tally:
-            voter = self.player_from_id(vote["voter_id"])
-            voted_for = self.player_from_id(vote["voted_for_id"])
+        herd_votes = self.current_round.herd_votes
+        for voter_id, voted_for_id in herd_votes.items():
+            voter = self.player_from_id(voter_id)
+            voted_for = self.player_from_id(voted_for_id)
             self.game_message(f"{voter.name} voted for {voted_for.name}")
 
-        accused_player_id = self.count_chameleon_votes(self.herd_vote_tally)
+        accused_player_id = self.count_chameleon_votes(herd_votes)
 
         self.game_message(f"The round is over. Calculating results...")
         self.game_message(
@@ -276,13 +549,12 @@ class ChameleonGame(Game):
 
         # If the Chameleon guesses the incorrect animal  =   +1 Point to each Herd player
         else:
-            for player in self.players:
-                if player.role == "herd":
-                    player.points += 1
+            for player_id in self.current_round.herd_ids:
+                self.player_from_id(player_id).points += 1
         # If a Herd player votes for the Chameleon       =   +1 Point to that player
-        for vote in self.herd_vote_tally:
-            if vote["voted_for_id"] == self.chameleon.player_id:
-                self.player_from_id(vote['voter_id']).points += 1
+        for voter_id, voted_for_id in herd_votes.items():
+            if voted_for_id == self.chameleon_id:
+                self.player_from_id(voter_id).points += 1
 
         # If the Herd fails to accuse the Chameleon      =   +1 Point to the Chameleon
         if not accused_player_id or accused_player_id != self.chameleon.player_id:
@@ -292,6 +564,29 @@ class ChameleonGame(Game):
         player_points = "\n".join([f"{player.name}: {player.points}" for player in self.players])
         self.game_message(f"Current Game Score:\n{player_points}")
 
+    def round_summary(self, round_index: int) -> str:
+        """Returns a compact summary of a finished round, including the scores at the end of the round."""
+        round_record = self.rounds[round_index]
+        chameleon = self.player_from_id(round_record.chameleon_id)
+
+        descriptions = "\n".join(
+            f" - {self.player_from_id(player_id).name}: {description}"
+            for player_id, description in round_record.animal_descriptions.items()
+        )
+        votes = ", ".join(
+            f"{self.player_from_id(voter_id).name} -> {self.player_from_id(voted_for_id).name}"
+            for voter_id, voted_for_id in round_record.herd_votes.items()
+        )
+        scores = ", ".join(f"{player.name}: {player.points}" for player in self.players)
+
+        return (
+            f"Round {round_index + 1}: The secret animal was {round_record.herd_animal} "
+            f"and the Chameleon was {chameleon.name}, who guessed {round_record.chameleon_guess}.\n"
+            f"Descriptions:\n{descriptions}\n"
+            f"Votes: {votes}\n"
+            f"Scores: {scores}"
+        )
+
     def random_animal(self) -> str:
         """Returns a random animal from the list of available animals, and removes it from the list."""
         animal = random.choice(self.available_animals)
@@ -299,15 +594,13 @@ class ChameleonGame(Game):
         return animal
 
     @staticmethod
-    def count_chameleon_votes(player_votes: list[dict]) -> str | None:
-        """Counts the votes for each player."""
-        votes = [vote['voted_for_id'] for vote in player_votes]
-
-        freq = Counter(votes)
+    def count_chameleon_votes(herd_votes: dict[str, str]) -> str | None:
+        """Counts the votes for each player, given the id of the player each voter voted for by the voter's id."""
+        freq = Counter(herd_votes.values())
         most_voted_player, number_of_votes = freq.most_common()[0]
 
         # If one player has more than 50% of the votes, the herd accuses them of being the chameleon
-        if number_of_votes / len(player_votes) >= 0.5:
+        if number_of_votes / len(herd_votes) >= 0.5:
             return most_voted_player
         else:
             return None
@@ -315,10 +608,10 @@ class ChameleonGame(Game):
     def format_animal_descriptions(self, exclude: Player = None) -> str:
         """Formats the animal description responses of the players into a single string."""
         formatted_responses = ""
-        for response in self.round_animal_descriptions:
+        for player_id, description in self.current_round.animal_descriptions.items():
             # Used to exclude the player who is currently responding, so they don't vote for themselves like a fool
-            if response["player_id"] != exclude.player_id:
-                player = self.player_from_id(response["player_id"])
-                formatted_responses += f" - {player.name}: {response['description']}\n"
+            if player_id != exclude.player_id:
+                player = self.player_from_id(player_id)
+                formatted_responses += f" - {player.name}: {description}\n"
 
         return formatted_responses
\ No newline at end of file
@@ -0,0 +1,386 @@
+"""
+Hosts many live games in one process, so front ends (Streamlit, CLI, HTTP) don't each have to run their own.
+
+Games are advanced one step at a time by a pool of worker threads, taking turns in round-robin order so that no
+game can starve the others. Front ends submit human input and subscribe to the messages of a game by its id.
+When the host is full, new games are queued until a running game ends, and rejected once the queue is full too.
+Games that are over are kept for their late subscribers until the front end removes them, or for at most
+GAME_HOST_FINISHED_TTL seconds.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import List, Any, Type, Callable, Literal
+
+from pydantic import Field
+
+from game_chameleon import ChameleonGame
+from game import Game
+from agent_interfaces import HumanAgentInterface, BaseAgentInterface, OpenAIAgentInterface
+from message import Message, PartialMessage
+
+logger = logging.getLogger(__name__)
+
+GAME_HOST_MAX_GAMES = int(os.environ.get("GAME_HOST_MAX_GAMES", 100))
+GAME_HOST_MAX_QUEUED = int(os.environ.get("GAME_HOST_MAX_QUEUED", 100))
+GAME_HOST_WORKERS = int(os.environ.get("GAME_HOST_WORKERS", 16))
+# How long a game that is over is kept if the front end doesn't remove it, e.g. when its page was closed
+GAME_HOST_FINISHED_TTL = float(os.environ.get("GAME_HOST_FINISHED_TTL", 3600))
+
+GameStatus = Literal["queued", "running", "awaiting_input", "finished", "failed"]
+
+
+class HostAtCapacityError(RuntimeError):
+    """Raised when a game is created while the host and its queue are both full."""
+
+
+class HostedHumanInterface(HumanAgentInterface):
+    """A human interface fed by a GameHost: input is submitted to it, and its messages are passed on to listeners."""
+
+    pending_inputs: List[str] = Field([], exclude=True)
+    """Input submitted by the human that hasn't been used yet."""
+    listeners: List[Callable[[Message], Any]] = Field([], exclude=True)
+    """Called with each message the human receives."""
+    partial_listeners: List[Callable[[PartialMessage], Any]] = Field([], exclude=True)
+    """Called with each message shown to the human while it is being generated."""
+
+    def on_message(self, message: Message):
+        for listener in self.listeners:
+            listener(message)
+
+    def on_partial_message(self, message: PartialMessage):
+        for listener in self.partial_listeners:
+            listener(message)
+
+    def _generate(self) -> str | None:
+        # None makes the game wait for input instead of blocking a worker
+        return self.pending_inputs.pop(0) if self.pending_inputs else None
+
+
+class Subscription:
+    """The messages of a game as seen by its human player (or observer), in order."""
+
+    def __init__(self, host: "GameHost", game_id: str):
+        self.host = host
+        self.game_id = game_id
+        self.messages: queue.Queue[Message | None] = queue.Queue()
+        """
+        The messages received so far, followed by None once the game is over.
+        Messages being generated arrive as PartialMessages as they grow, followed by the complete message.
+        """
+
+    def get(self, timeout: float = None) -> Message | None:
+        """Returns the next message, or None when the game is over. Raises queue.Empty after the timeout."""
+        return self.messages.get(timeout=timeout)
+
+    def __iter__(self):
+        while (message := self.get()) is not None:
+            yield message
+
+    def close(self):
+        """Stops receiving messages."""
+        self.host.unsubscribe(self)
+
+
+class HostedGame:
+    """A game owned by the host, along with its scheduling state."""
+
+    def __init__(self, game: Game):
+        self.game = game
+        self.status: GameStatus = "queued"
+        self.scheduled = False
+        """Whether the game is waiting in the run queue or being stepped by a worker."""
+        self.subscriptions: List[Subscription] = []
+        self.error: BaseException | None = None
+        self.over_at: float | None = None
+        """The monotonic time the game ended or failed at."""
+
+        self.human = next(
+            (player for player in game.players if isinstance(player.interface, HostedHumanInterface)), game.observer
+        )
+        """The player whose view of the game is sent to subscribers, the human player or otherwise the observer."""
+
+    @property
+    def interface(self) -> HostedHumanInterface:
+        return self.human.interface
+
+    @property
+    def is_over(self) -> bool:
+        return self.status in ["finished", "failed"]
+
+    @property
+    def error_message(self) -> Message:
+        """The message sent to subscribers when the game has failed."""
+        return Message(type="error", content=f"The game has failed: {self.error}")
+
+
+class GameHost:
+    """Runs many games at once on a shared pool of worker threads."""
+
+    def __init__(
+            self,
+            max_games: int = GAME_HOST_MAX_GAMES,
+            max_queued: int = GAME_HOST_MAX_QUEUED,
+            workers: int = GAME_HOST_WORKERS,
+            game_class: Type[Game] = ChameleonGame,
+            ai_interface: Type[BaseAgentInterface] = OpenAIAgentInterface,
+            finished_ttl: float = GAME_HOST_FINISHED_TTL
+    ):
+        self.max_games = max_games
+        """The maximum number of games running at once."""
+        self.max_queued = max_queued
+        """The maximum number of games waiting for a running game to end, beyond it new games are rejected."""
+        self.workers = workers
+        """The number of worker threads stepping games."""
+        self.game_class = game_class
+        """The type of game hosted."""
+        self.ai_interface = ai_interface
+        """The interface used by AI players."""
+        self.finished_ttl = finished_ttl
+        """The number of seconds a game that is over is kept before it is removed, if it hasn't been already."""
+
+        self.steps = 0
+        """The number of steps run across all games."""
+        self.rejected_games = 0
+        """The number of games rejected because the host was full."""
+
+        self._games: dict[str, HostedGame] = {}
+        self._admission_queue: deque[str] = deque()
+        self._run_queue: deque[str] = deque()
+        # The games that are over, in the order they ended in, to be removed once they have expired
+        self._over_queue: deque[str] = deque()
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Starts the worker threads."""
+        self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"game-host-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stops the worker threads, after the steps in progress have finished."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    # Front end API
+
+    def create_game(self, human_name: str = None, **kwargs) -> str:
+        """
+        Creates a game with a human player if a name is provided, otherwise an AI only game with an observer.
+        The game starts right away if the host has room, otherwise it is queued.
+        Raises a HostAtCapacityError if the queue is full as well.
+        """
+        game = self.game_class.from_human_name(
+            human_name, human_interface=HostedHumanInterface, ai_interface=self.ai_interface, **kwargs
+        )
+        return self.add_game(game)
+
+    def resume_game(self, game_id: str) -> str | None:
+        """Resumes a checkpointed game, e.g. one started by another process. Returns None if there is no checkpoint."""
+        game = self.game_class.resume(game_id, human_interface=HostedHumanInterface, ai_interface=self.ai_interface)
+        return self.add_game(game) if game else None
+
+    def add_game(self, game: Game) -> str:
+        """
+        Hosts a game that has already been created, its human player (if any) must use a HostedHumanInterface.
+        Subscribers receive the messages the human (or observer) has already been sent first.
+        Raises a HostAtCapacityError if the host and its queue are full.
+        """
+        hosted_game = HostedGame(game)
+        hosted_game.interface.listeners.append(lambda message: self._publish(hosted_game, message))
+        hosted_game.interface.partial_listeners.append(lambda message: self._publish_partial(hosted_game, message))
+
+        with self._condition:
+            self._remove_expired_games()
+            if self._running_games() >= self.max_games and len(self._admission_queue) >= self.max_queued:
+                self.rejected_games += 1
+                raise HostAtCapacityError(
+                    f"The host is running {self.max_games} games and has {self.max_queued} more queued."
+                )
+
+            self._games[game.game_id] = hosted_game
+
+            self._admission_queue.append(game.game_id)
+            self._admit_games()
+
+        return game.game_id
+
+    def submit_input(self, game_id: str, content: str):
+        """Submits the human player's input to a game, it is used the next time the game is waiting on them."""
+        with self._condition:
+            hosted_game = self._games[game_id]
+            if hosted_game.is_over:
+                raise ValueError(f"Game {game_id} is {hosted_game.status}.")
+
+            hosted_game.interface.pending_inputs.append(content)
+            if hosted_game.status == "awaiting_input":
+                hosted_game.status = "running"
+                self._schedule(hosted_game)
+
+    def subscribe(self, game_id: str) -> Subscription:
+        """Subscribes to the messages of a game, starting with those already sent."""
+        with self._condition:
+            hosted_game = self._games[game_id]
+
+        # The messages sent so far are replayed from the human's (or observer's) history. Holding the log's lock keeps
+        # the game from sending another between the replay and the subscription, it is taken before the host's lock
+        # like when a message is published
+        with hosted_game.interface.messages.log.lock, self._condition:
+            subscription = Subscription(self, game_id)
+            for message in hosted_game.interface.messages:
+                subscription.messages.put(message)
+            if hosted_game.status == "failed":
+                subscription.messages.put(hosted_game.error_message)
+            if hosted_game.is_over:
+                subscription.messages.put(None)
+            else:
+                hosted_game.subscriptions.append(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Stops sending messages to a subscription."""
+        with self._condition:
+            hosted_game = self._games.get(subscription.game_id)
+            if hosted_game and subscription in hosted_game.subscriptions:
+                hosted_game.subscriptions.remove(subscription)
+
+    def has_game(self, game_id: str) -> bool:
+        """Whether a game is hosted, including games that are over but haven't been removed or expired."""
+        with self._condition:
+            return game_id in self._games
+
+    def status(self, game_id: str) -> GameStatus:
+        """Returns the status of a game."""
+        with self._condition:
+            return self._games[game_id].status
+
+    def game(self, game_id: str) -> Game:
+        """Returns a hosted game. It should only be read, as it may be being stepped by a worker."""
+        return self._games[game_id].game
+
+    def remove_game(self, game_id: str):
+        """
+        Forgets a game that is over, once the front end is done with it. Games that are never removed, e.g. when their
+        page was closed, are removed finished_ttl seconds after they end.
+        """
+        with self._condition:
+            hosted_game = self._games.get(game_id)
+            if hosted_game is None:
+                # Already removed, or expired
+                return
+            if not hosted_game.is_over:
+                raise ValueError(f"Game {game_id} is still {hosted_game.status}.")
+            del self._games[game_id]
+
+    def stats(self) -> dict:
+        """Returns the number of games in each status, along with the host's counters."""
+        with self._condition:
+            statuses = [hosted_game.status for hosted_game in self._games.values()]
+            return {
+                **{status: statuses.count(status) for status in GameStatus.__args__},
+                "ready_to_step": len(self._run_queue),
+                "steps": self.steps,
+                "rejected_games": self.rejected_games,
+            }
+
+    # Scheduling
+
+    def _remove_expired_games(self):
+        """Removes the games that have been over for longer than finished_ttl. Must be called with the lock held."""
+        expiry = time.monotonic() - self.finished_ttl
+        while self._over_queue:
+            hosted_game = self._games.get(self._over_queue[0])
+            if hosted_game is not None and hosted_game.over_at > expiry:
+                break
+            self._over_queue.popleft()
+            if hosted_game is not None:
+                del self._games[hosted_game.game.game_id]
+
+    def _running_games(self) -> int:
+        return sum(hosted_game.status in ["running", "awaiting_input"] for hosted_game in self._games.values())
+
+    def _admit_games(self):
+        """Starts queued games while there is room. Must be called with the lock held."""
+        while self._admission_queue and self._running_games() < self.max_games:
+            hosted_game = self._games[self._admission_queue.popleft()]
+            hosted_game.status = "running"
+            self._schedule(hosted_game)
+
+    def _schedule(self, hosted_game: HostedGame):
+        """Adds a game to the back of the run queue. Must be called with the lock held."""
+        if not hosted_game.scheduled:
+            hosted_game.scheduled = True
+            self._run_queue.append(hosted_game.game.game_id)
+            self._condition.notify()
+
+    def _work(self):
+        """Steps games from the front of the run queue, putting them back at the end if they can go on."""
+        while True:
+            with self._condition:
+                while not self._run_queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                hosted_game = self._games[self._run_queue.popleft()]
+
+            # Only this worker has the game until it is scheduled again
+            try:
+                result = hosted_game.game.step()
+                error = None
+            except Exception as e:
+                logger.exception(f"Game {hosted_game.game.game_id} failed")
+                result, error = None, e
+
+            with self._condition:
+                self.steps += 1
+                hosted_game.scheduled = False
+
+                if error:
+                    hosted_game.status = "failed"
+                    hosted_game.error = error
+                    for subscription in hosted_game.subscriptions:
+                        subscription.messages.put(hosted_game.error_message)
+                elif result.is_finished:
+                    hosted_game.status = "finished"
+                elif result.awaiting_input and not hosted_game.interface.pending_inputs:
+                    hosted_game.status = "awaiting_input"
+                else:
+                    self._schedule(hosted_game)
+
+                if hosted_game.is_over:
+                    for subscription in hosted_game.subscriptions:
+                        subscription.messages.put(None)
+                    hosted_game.subscriptions = []
+                    hosted_game.over_at = time.monotonic()
+                    self._over_queue.append(hosted_game.game.game_id)
+                    self._remove_expired_games()
+                    self._admit_games()
+
+    def _publish(self, hosted_game: HostedGame, message: Message):
+        with self._condition:
+            for subscription in hosted_game.subscriptions:
+                subscription.messages.put(message)
+
+    def _publish_partial(self, hosted_game: HostedGame, message: PartialMessage):
+        # Not in the human's history, later subscribers only get the complete message
+        with self._condition:
+            for subscription in hosted_game.subscriptions:
+                subscription.messages.put(message)
@@ -0,0 +1,262 @@
+"""
+A registry of OpenAI clients shared by every agent in the process, so that games don't each open their own connection
+pools and TLS sessions.
+
+Clients are keyed by base url, API key and model, and every request they make is counted to report their health.
+Async clients are also kept apart by event loop, since their connections can only be used by the loop that opened
+them, e.g. each asyncio.run gets clients of its own.
+Connection limits and keep-alive are set with OPENAI_MAX_CONNECTIONS, OPENAI_MAX_KEEPALIVE_CONNECTIONS and
+OPENAI_KEEPALIVE_EXPIRY, and apply to each client.
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import NamedTuple
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 100))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 30.0))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 600.0))
+UNHEALTHY_AFTER_FAILURES = 5
+"""The number of failed requests in a row after which a client is reported as unhealthy."""
+
+
+class ClientKey(NamedTuple):
+    base_url: str | None
+    api_key: str | None
+    model: str | None
+    asynchronous: bool
+
+
+class ClientStats:
+    """Counts the requests made by a client, to report its usage and health."""
+
+    def __init__(self):
+        self.requests = 0
+        """The number of requests sent."""
+        self.in_flight = 0
+        """The number of requests waiting for a response."""
+        self.responses_by_status: dict[int, int] = {}
+        """The number of responses received for each status code."""
+        self.transport_errors = 0
+        """The number of requests that failed without a response, e.g. timeouts or refused connections."""
+        self.total_latency = 0.0
+        """The total time spent waiting for responses, in seconds."""
+        self.consecutive_failures = 0
+        """The number of requests that failed in a row, reset by a successful response."""
+        self.last_error: str | None = None
+        """A description of the last failure."""
+        self.last_success_at: float | None = None
+        """When the last successful response was received, as a unix timestamp."""
+
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+
+    def finish(self, latency: float, status_code: int = None, error: Exception = None):
+        with self._lock:
+            self.in_flight -= 1
+            self.total_latency += latency
+            if status_code is not None:
+                self.responses_by_status[status_code] = self.responses_by_status.get(status_code, 0) + 1
+
+            if status_code is not None and status_code < 400:
+                self.consecutive_failures = 0
+                self.last_success_at = time.time()
+            else:
+                self.consecutive_failures += 1
+                self.last_error = f"HTTP {status_code}" if status_code is not None else repr(error)
+                if error is not None:
+                    self.transport_errors += 1
+
+    @property
+    def is_healthy(self) -> bool:
+        """Whether the client's recent requests have been succeeding."""
+        return self.consecutive_failures < UNHEALTHY_AFTER_FAILURES
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            completed = sum(self.responses_by_status.values()) + self.transport_errors
+            return {
+                "healthy": self.is_healthy,
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "responses_by_status": dict(self.responses_by_status),
+                "transport_errors": self.transport_errors,
+                "mean_latency": self.total_latency / completed if completed else None,
+                "consecutive_failures": self.consecutive_failures,
+                "last_error": self.last_error,
+                "last_success_at": self.last_success_at,
+            }
+
+
+class _MeteredTransport(httpx.BaseTransport):
+    """Records the outcome of each request sent through the wrapped transport."""
+
+    def __init__(self, transport: httpx.BaseTransport, stats: ClientStats):
+        self.transport = transport
+        self.stats = stats
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.stats.start()
+        start = time.perf_counter()
+        try:
+            response = self.transport.handle_request(request)
+        except Exception as e:
+            self.stats.finish(time.perf_counter() - start, error=e)
+            raise
+        self.stats.finish(time.perf_counter() - start, response.status_code)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class _AsyncMeteredTransport(httpx.AsyncBaseTransport):
+    """Async version of _MeteredTransport."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: ClientStats):
+        self.transport = transport
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.stats.start()
+        start = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception as e:
+            self.stats.finish(time.perf_counter() - start, error=e)
+            raise
+        self.stats.finish(time.perf_counter() - start, response.status_code)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ClientRegistry:
+    """Creates OpenAI clients on first use and lends the same client to every agent with the same settings."""
+
+    def __init__(
+            self,
+            max_connections: int = OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections: int = OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry: float = OPENAI_KEEPALIVE_EXPIRY,
+            timeout: float = OPENAI_TIMEOUT
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        """The connection limits of each client."""
+        self.timeout = timeout
+        """The timeout of each request in seconds."""
+
+        self._lock = threading.Lock()
+        self._clients: dict[ClientKey, OpenAI] = {}
+        self._async_clients: dict[asyncio.AbstractEventLoop, dict[ClientKey, AsyncOpenAI]] = {}
+        self._stats: dict[ClientKey, ClientStats] = {}
+        self._pid = os.getpid()
+
+    def get(
+            self,
+            model: str = None,
+            base_url: str = None,
+            api_key: str = None,
+            asynchronous: bool = False
+    ) -> OpenAI | AsyncOpenAI:
+        """
+        Returns the client for the settings, creating it if needed.
+        The base url and API key default to the OPENAI_BASE_URL and OPENAI_API_KEY environment variables.
+        Async clients must be borrowed from the event loop they are used in, each running loop gets its own.
+        """
+        key = ClientKey(
+            base_url or os.environ.get("OPENAI_BASE_URL"),
+            api_key or os.environ.get("OPENAI_API_KEY"),
+            model,
+            asynchronous
+        )
+
+        # Raises a RuntimeError outside of an event loop
+        loop = asyncio.get_running_loop() if asynchronous else None
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections can't be shared with a forked process, so it starts with its own clients
+                self._clients, self._async_clients, self._stats, self._pid = {}, {}, {}, os.getpid()
+
+            if loop is None:
+                clients = self._clients
+            else:
+                # The clients of loops that have been closed can't be used anymore
+                for closed_loop in [other for other in self._async_clients if other.is_closed()]:
+                    del self._async_clients[closed_loop]
+                clients = self._async_clients.setdefault(loop, {})
+
+            client = clients.get(key)
+            if client is None:
+                client = clients[key] = self._create_client(key)
+            return client
+
+    def _create_client(self, key: ClientKey) -> OpenAI | AsyncOpenAI:
+        # The stats of an async client are shared with the clients of the same settings in other event loops
+        stats = self._stats.setdefault(key, ClientStats())
+        timeout = httpx.Timeout(self.timeout, connect=5.0)
+
+        if key.asynchronous:
+            transport = _AsyncMeteredTransport(httpx.AsyncHTTPTransport(limits=self.limits), stats)
+            http_client = httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=True)
+            return AsyncOpenAI(base_url=key.base_url, api_key=key.api_key, http_client=http_client)
+        else:
+            transport = _MeteredTransport(httpx.HTTPTransport(limits=self.limits), stats)
+            http_client = httpx.Client(transport=transport, timeout=timeout, follow_redirects=True)
+            return OpenAI(base_url=key.base_url, api_key=key.api_key, http_client=http_client)
+
+    def stats(self) -> list[dict]:
+        """Returns the usage and health of each client, without their API keys."""
+        with self._lock:
+            items = list(self._stats.items())
+
+        return [
+            {
+                "base_url": key.base_url,
+                "model": key.model,
+                "asynchronous": key.asynchronous,
+                **stats.to_dict()
+            }
+            for key, stats in items
+        ]
+
+    def is_healthy(self) -> bool:
+        """Whether every client's recent requests have been succeeding."""
+        with self._lock:
+            return all(stats.is_healthy for stats in self._stats.values())
+
+    def close(self):
+        """Closes the sync clients and forgets every client, async clients are closed by their event loop."""
+        with self._lock:
+            clients, self._clients, self._async_clients, self._stats = self._clients, {}, {}, {}
+
+        for client in clients.values():
+            client.close()
+
+
+_default_registry: ClientRegistry | None = None
+_default_registry_lock = threading.Lock()
+
+
+def default_client_registry() -> ClientRegistry:
+    """Returns the process-wide client registry configured by the environment."""
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = ClientRegistry()
+        return _default_registry
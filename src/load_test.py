@@ -0,0 +1,158 @@
+"""
+Load tests the game engine against the local stub LLM, so performance changes can be measured without paying for
+completions.
+
+Reports games per second, turn latency percentiles, retries and the prompt cache hit rate for each concurrency level.
+The first failure of each type is logged with its traceback. The games are logged to a temporary directory (or
+--data-dir) in JSONL mode, rather than to the real logs or database.
+
+Usage: python src/load_test.py --games 20 --concurrency 1 4 16 --latency 0.05 --failure-rate 0.01
+"""
+import argparse
+import json
+import logging
+import pathlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Type, Callable, Any
+
+from pydantic import Field
+
+from game_chameleon import ChameleonGame
+import data_collection
+from agent_interfaces import OpenAIAgentInterface, QuietObserverInterface
+from output_formats import OutputFormatModel
+from stub_llm import StubLLM, StubLLMServer
+
+logger = logging.getLogger(__name__)
+
+
+class TimedOpenAIAgentInterface(OpenAIAgentInterface):
+    """An OpenAI interface that records how long each of its turns takes."""
+
+    turn_latencies: List[float] = Field([], exclude=True)
+    """The duration of each formatted response in seconds."""
+
+    def generate_formatted_response(
+            self,
+            output_format: Type[OutputFormatModel],
+            additional_fields: dict = None,
+            max_retries=3,
+            on_partial_output: Callable[[str], Any] = None
+    ) -> OutputFormatModel:
+        start = time.perf_counter()
+        try:
+            return super().generate_formatted_response(output_format, additional_fields, max_retries, on_partial_output)
+        finally:
+            self.turn_latencies.append(time.perf_counter() - start)
+
+
+def percentile(values: list[float], percent: float) -> float | None:
+    """Returns the nearest-rank percentile of the values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def run_game(client) -> ChameleonGame:
+    """Runs a single AI only game against the stub."""
+    game = ChameleonGame.from_human_name(
+        human_interface=QuietObserverInterface,
+        ai_interface=partial(TimedOpenAIAgentInterface, client=client)
+    )
+    game.run_game()
+    return game
+
+
+def run_level(server: StubLLMServer, games: int, concurrency: int) -> dict:
+    """Runs a number of games with a given number running at once, and gathers the results."""
+    stub = server.stub
+    requests, failures, rate_limits = stub.requests, stub.failures, stub.rate_limits
+    client = server.client(max_retries=5)
+
+    start = time.perf_counter()
+    errors: dict[str, int] = {}
+    finished_games = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_game, client) for _ in range(games)]
+        for future in futures:
+            try:
+                finished_games.append(future.result())
+            except Exception as e:
+                error_type = type(e).__name__
+                if error_type not in errors:
+                    logger.error(f"A game failed with {error_type}, later ones are only counted", exc_info=e)
+                errors[error_type] = errors.get(error_type, 0) + 1
+    duration = time.perf_counter() - start
+
+    interfaces = [player.interface for game in finished_games for player in game.players]
+    latencies = [latency for interface in interfaces for latency in interface.turn_latencies]
+    prompt_tokens = sum(interface.prompt_tokens for interface in interfaces)
+    cached_prompt_tokens = sum(interface.cached_prompt_tokens for interface in interfaces)
+
+    return {
+        "concurrency": concurrency,
+        "games": games,
+        "errors": sum(errors.values()),
+        "errors_by_type": errors,
+        "duration": duration,
+        "games_per_second": games / duration,
+        "turns": len(latencies),
+        "turn_latency_p50": percentile(latencies, 50),
+        "turn_latency_p95": percentile(latencies, 95),
+        "turn_latency_p99": percentile(latencies, 99),
+        "format_retries": sum(interface.format_retries for interface in interfaces),
+        "prompt_cache_hit_rate": cached_prompt_tokens / prompt_tokens if prompt_tokens else None,
+        "requests": stub.requests - requests,
+        "request_retries": (stub.failures - failures) + (stub.rate_limits - rate_limits),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the game engine against a local stub LLM.")
+    parser.add_argument("--games", type=int, default=20, help="The number of games to run at each level.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="The concurrency levels.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Median stub reply latency in seconds.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the log-normal latency.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests failing with a 500.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests failing with a 429.")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", type=pathlib.Path, default=None, help="Where to write the results as JSON.")
+    parser.add_argument("--data-dir", type=pathlib.Path, default=None, help="Where to log the games, or a temp dir")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+
+    stub = StubLLM(args.latency, args.latency_sigma, args.failure_rate, args.rate_limit_rate, args.seed)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="load_test_") as temporary_dir, StubLLMServer(stub) as server:
+        # Keeps the load test's games out of the real logs (or database)
+        data_collection.DATA_COLLECTION_MODE = "JSONL"
+        data_collection.DATA_DIR = args.data_dir or pathlib.Path(temporary_dir)
+
+        for concurrency in args.concurrency:
+            result = run_level(server, args.games, concurrency)
+            results.append(result)
+            print(
+                f"concurrency={concurrency:<4} games/s={result['games_per_second']:.2f} "
+                f"p50={result['turn_latency_p50'] or 0:.3f}s p95={result['turn_latency_p95'] or 0:.3f}s "
+                f"p99={result['turn_latency_p99'] or 0:.3f}s format_retries={result['format_retries']} "
+                f"prompt_cache_hit_rate={result['prompt_cache_hit_rate'] or 0:.2f} "
+                f"request_retries={result['request_retries']} errors={result['errors']}"
+            )
+        # Written before the temporary directory is removed
+        data_collection.flush()
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,23 @@
+import sys
+
 from game_chameleon import ChameleonGame
 from player import Player
 
 def main():
-    print("Please Enter your name, or leave blank to run an AI only game")
-    name = input()
+    # A game that was checkpointed can be resumed by passing its id, e.g. after a crash
+    if len(sys.argv) > 1:
+        game = ChameleonGame.resume(sys.argv[1])
+        if not game:
+            print(f"No checkpoint found for game {sys.argv[1]}, is CHECKPOINT_MODE set?")
+            return
+    else:
+        print("Please Enter your name, or leave blank to run an AI only game")
+        name = input()
 
-    game = ChameleonGame.from_human_name(name)
+        game = ChameleonGame.from_human_name(name)
 
     game.run_game()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
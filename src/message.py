@@ -1,18 +1,30 @@
-from typing import Literal, List
+import threading
+from array import array
+from typing import Literal, List, Callable, Any, Iterable, Iterator, Sequence
 from pydantic import BaseModel, computed_field, Field
 
 MessageType = Literal["prompt", "info", "agent", "retry", "error", "format", "verbose", "debug", "system"]
 
 message_number = 0
+# Messages are numbered from several threads, e.g. by players deciding concurrently
+_message_number_lock = threading.Lock()
 
 
 def next_message_number():
     global message_number
-    current_message_number = message_number
-    message_number += 1
+    with _message_number_lock:
+        current_message_number = message_number
+        message_number += 1
     return current_message_number
 
 
+def skip_message_numbers(next_number: int):
+    """Makes sure the next message number is at least next_number, e.g. when a game is resumed in a new process."""
+    global message_number
+    with _message_number_lock:
+        message_number = max(message_number, next_number)
+
+
 class Message(BaseModel):
     """A generic message, these are used to communicate between the game and the players."""
 
@@ -47,6 +59,10 @@ class Message(BaseModel):
         return {"role": self.conversation_role, "content": self.content}
 
 
+class PartialMessage(Message):
+    """A message that is still being generated, shown as it grows. It isn't logged, the complete message follows."""
+
+
 class AgentMessage(Message):
     """A message that has been sent to 1 or more agents."""
 
@@ -70,4 +86,113 @@ class AgentMessage(Message):
             content=message.content,
             agent_ids=agent_ids,
             game_id=game_id
-        )
\ No newline at end of file
+        )
+
+
+class MessageLog:
+    """
+    An append-only log of the messages sent during a game.
+    Each message is stored once, along with who can see it, and every agent's history is a view of the log.
+    """
+
+    def __init__(self):
+        self.entries: List[tuple[Message, frozenset[str] | None, frozenset[str]]] = []
+        """Each message, with the ids of its recipients (None for everyone) and the ids of the agents excluded."""
+        self.listeners: List[Callable[[int], Any]] = []
+        """Called with the index of each message added, in order."""
+        self.lock = threading.RLock()
+        """Held while a message is added and its listeners are called, so nothing can be added while it is held."""
+
+    def append(self, message: Message, recipient_ids: Iterable[str] = None, excluded_ids: Iterable[str] = ()) -> int:
+        """Adds a message for the recipients, or for every agent except the excluded ones. Returns its index."""
+        entry = (message, frozenset(recipient_ids) if recipient_ids is not None else None, frozenset(excluded_ids))
+        # Listeners are called with the lock held, so they see the messages in the order they were added
+        with self.lock:
+            self.entries.append(entry)
+            index = len(self.entries) - 1
+            for listener in self.listeners:
+                listener(index)
+        return index
+
+    def to_records(self, start: int = 0) -> List[dict]:
+        """Returns the log as JSON compatible records, from the message at index start on."""
+        return [
+            {
+                "message": message.model_dump(),
+                "recipient_ids": sorted(recipient_ids) if recipient_ids is not None else None,
+                "excluded_ids": sorted(excluded_ids)
+            }
+            for message, recipient_ids, excluded_ids in self.entries[start:]
+        ]
+
+    @classmethod
+    def from_records(cls, records: List[dict]) -> "MessageLog":
+        """Recreates a log from its records."""
+        log = cls()
+        for record in records:
+            # Checkpoints from before several agents could be excluded have a single excluded_id
+            excluded_ids = record.get("excluded_ids", [record.get("excluded_id")] if record.get("excluded_id") else [])
+            log.append(Message.model_validate(record["message"]), record["recipient_ids"], excluded_ids)
+        return log
+
+
+class MessageView(Sequence[Message]):
+    """
+    The message history of an agent: the indices of the messages in a log that the agent can see.
+    New messages in the log are only checked when the history is read.
+    """
+
+    def __init__(
+            self,
+            log: MessageLog = None,
+            agent_id: str = None,
+            can_receive: Callable[[MessageType], bool] = None
+    ):
+        self.log = log if log is not None else MessageLog()
+        """The log the messages are stored in."""
+        self.agent_id = agent_id
+        """The id of the agent whose history this is."""
+        self.can_receive = can_receive
+        """Whether the agent can see a type of message, None means every type."""
+
+        self._indices = array("l")
+        self._checked = 0
+
+    def is_visible(self, index: int) -> bool:
+        """Whether the message at an index of the log is part of this history."""
+        message, recipient_ids, excluded_ids = self.log.entries[index]
+        if recipient_ids is None:
+            visible = self.agent_id not in excluded_ids
+        else:
+            visible = self.agent_id in recipient_ids
+        return visible and (self.can_receive is None or self.can_receive(message.type))
+
+    def append(self, message: Message):
+        """Adds a message that only this agent can see."""
+        self.log.append(message, [self.agent_id])
+
+    def _update(self):
+        """Indexes the messages added to the log since the last time."""
+        # The view may be read from another thread than the game's, e.g. by a GameHost subscriber
+        with self.log.lock:
+            end = len(self.log.entries)
+            for index in range(self._checked, end):
+                if self.is_visible(index):
+                    self._indices.append(index)
+            self._checked = end
+
+    def __len__(self) -> int:
+        self._update()
+        return len(self._indices)
+
+    def __getitem__(self, item):
+        self._update()
+        entries = self.log.entries
+        if isinstance(item, slice):
+            return [entries[index][0] for index in self._indices[item]]
+        return entries[self._indices[item]][0]
+
+    def __iter__(self) -> Iterator[Message]:
+        self._update()
+        entries = self.log.entries
+        return (entries[index][0] for index in self._indices)
@@ -0,0 +1,262 @@
+"""
+Metrics of the games played by this process, to see where the time of a game goes and to catch regressions.
+
+Agent interfaces record the latency of each LLM call by model and phase (description, guess, vote, format or retry),
+the prompt and completion tokens reported by the API, and the responses that failed validation for each output format.
+Games record their duration and the duration of each round.
+
+Metrics are kept in a process-wide registry, and exported to its sinks at the end of every game. METRICS_SINKS is a
+comma separated list of:
+- prometheus: the Prometheus text exposition, written to METRICS_PROMETHEUS_FILE (e.g. for node_exporter's textfile
+  collector). It can also be served directly with default_metrics().prometheus_text()
+- jsonl: a snapshot of every metric appended to METRICS_JSONL_FILE
+"""
+import json
+import logging
+import math
+import os
+import pathlib
+import threading
+import time
+from typing import Iterable, List
+
+logger = logging.getLogger(__name__)
+
+METRICS_SINKS = [sink.strip() for sink in os.environ.get("METRICS_SINKS", "").lower().split(",") if sink.strip()]
+METRICS_DIR = pathlib.Path(__file__).parent.parent / "data"
+METRICS_PROMETHEUS_FILE = os.environ.get("METRICS_PROMETHEUS_FILE", METRICS_DIR / "metrics.prom")
+METRICS_JSONL_FILE = os.environ.get("METRICS_JSONL_FILE", METRICS_DIR / "metrics.jsonl")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""The upper bounds of the LLM call latency buckets in seconds."""
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+"""The upper bounds of the game and round duration buckets in seconds, games with a human take minutes."""
+
+
+class Metric:
+    """A metric with a value per combination of labels."""
+
+    type: str
+
+    def __init__(self, name: str, help: str, label_names: Iterable[str] = ()):
+        self.name = name
+        """The name of the metric, e.g. chameleon_llm_call_seconds."""
+        self.help = help
+        """A description of the metric."""
+        self.label_names = tuple(label_names)
+        """The names of the labels the values are broken down by."""
+
+        self._values: dict[tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} is labelled by {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[dict]:
+        """Returns the value of each combination of labels, as JSON compatible dicts."""
+        raise NotImplementedError
+
+    def prometheus_lines(self) -> List[str]:
+        """Returns the metric in the Prometheus text exposition format."""
+        raise NotImplementedError
+
+    def _label_text(self, key: tuple[str, ...], extra: dict = None) -> str:
+        labels = dict(zip(self.label_names, key), **(extra or {}))
+        if not labels:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+        return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. a number of tokens."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[dict]:
+        with self._lock:
+            return [{"labels": dict(zip(self.label_names, key)), "value": value} for key, value in self._values.items()]
+
+    def prometheus_lines(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """The distribution of observed values in buckets, e.g. latencies."""
+
+    type = "histogram"
+
+    def __init__(
+            self, name: str, help: str, label_names: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        """The upper bound of each bucket, the last one is infinite."""
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # The count of each bucket, then the sum of the values
+            values = self._values.setdefault(key, [0] * len(self.buckets) + [0.0])
+            values[next(i for i, bound in enumerate(self.buckets) if value <= bound)] += 1
+            values[-1] += value
+
+    def samples(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    "labels": dict(zip(self.label_names, key)),
+                    "buckets": dict(zip(map(_format_bound, self.buckets), _cumulative(values[:-1]))),
+                    "count": sum(values[:-1]),
+                    "sum": values[-1],
+                }
+                for key, values in self._values.items()
+            ]
+
+    def prometheus_lines(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, values in self._values.items():
+                for bound, count in zip(self.buckets, _cumulative(values[:-1])):
+                    lines.append(f"{self.name}_bucket{self._label_text(key, {'le': _format_bound(bound)})} {count}")
+                lines.append(f"{self.name}_sum{self._label_text(key)} {values[-1]}")
+                lines.append(f"{self.name}_count{self._label_text(key)} {sum(values[:-1])}")
+        return lines
+
+
+def _cumulative(counts: List[int]) -> List[int]:
+    total, cumulative = 0, []
+    for count in counts:
+        total += count
+        cumulative.append(total)
+    return cumulative
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+
+class MetricsSink:
+    """Somewhere metrics are exported to. Subclasses implement export."""
+
+    def export(self, registry: "MetricsRegistry"):
+        raise NotImplementedError
+
+
+class PrometheusFileSink(MetricsSink):
+    """Writes the Prometheus text exposition of every metric to a file, replacing it each time."""
+
+    def __init__(self, path: str | os.PathLike = METRICS_PROMETHEUS_FILE):
+        self.path = pathlib.Path(path)
+
+    def export(self, registry: "MetricsRegistry"):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Replaced atomically, so a scrape never reads a half written file
+        temporary_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary_path, "w") as f:
+            f.write(registry.prometheus_text())
+        os.replace(temporary_path, self.path)
+
+
+class JsonlMetricsSink(MetricsSink):
+    """Appends a timestamped snapshot of every metric to a JSONL file."""
+
+    def __init__(self, path: str | os.PathLike = METRICS_JSONL_FILE):
+        self.path = pathlib.Path(path)
+
+    def export(self, registry: "MetricsRegistry"):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        record = {"timestamp": time.time(), "pid": os.getpid(), "metrics": registry.snapshot()}
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class MetricsRegistry:
+    """The metrics of a process, along with the sinks they are exported to."""
+
+    def __init__(self, sinks: List[MetricsSink] = None):
+        self.sinks = sinks or []
+        """Where the metrics are exported to."""
+        self.metrics: List[Metric] = []
+        """Every metric, in the order they are exported."""
+
+        self.llm_call_seconds = self._add(Histogram(
+            "chameleon_llm_call_seconds", "Latency of LLM calls, including rate limiting and retries.",
+            ["model", "phase"], LATENCY_BUCKETS
+        ))
+        self.prompt_tokens = self._add(Counter(
+            "chameleon_llm_prompt_tokens_total", "Prompt tokens reported by the API.", ["model", "phase"]
+        ))
+        self.cached_prompt_tokens = self._add(Counter(
+            "chameleon_llm_cached_prompt_tokens_total", "Prompt tokens served from the provider's prompt cache.",
+            ["model", "phase"]
+        ))
+        self.completion_tokens = self._add(Counter(
+            "chameleon_llm_completion_tokens_total", "Completion tokens reported by the API.", ["model", "phase"]
+        ))
+        self.validation_failures = self._add(Counter(
+            "chameleon_validation_failures_total", "Responses that didn't match their output format.",
+            ["format", "error"]
+        ))
+        self.game_seconds = self._add(Histogram(
+            "chameleon_game_seconds", "Duration of finished games.", ["kind"], DURATION_BUCKETS
+        ))
+        self.round_seconds = self._add(Histogram(
+            "chameleon_round_seconds", "Duration of finished rounds.", ["kind"], DURATION_BUCKETS
+        ))
+
+    def _add(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self) -> dict:
+        """Returns every metric as JSON compatible data, by name."""
+        return {metric.name: {"type": metric.type, "samples": metric.samples()} for metric in self.metrics}
+
+    def prometheus_text(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.prometheus_lines())
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """Exports the metrics to every sink. A sink failing is logged rather than raised, so it never ends a game."""
+        for sink in self.sinks:
+            try:
+                sink.export(self)
+            except Exception:
+                logger.exception(f"Exporting metrics to {type(sink).__name__} failed")
+
+
+SINK_TYPES = {"prometheus": PrometheusFileSink, "jsonl": JsonlMetricsSink}
+"""The sinks that can be configured with METRICS_SINKS."""
+
+_default_metrics: MetricsRegistry | None = None
+_default_metrics_lock = threading.Lock()
+
+
+def default_metrics() -> MetricsRegistry:
+    """Returns the process-wide metrics registry, with the sinks configured by the environment."""
+    global _default_metrics
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            unknown_sinks = set(METRICS_SINKS) - set(SINK_TYPES)
+            if unknown_sinks:
+                raise ValueError(f"Unknown METRICS_SINKS {sorted(unknown_sinks)}, expected some of {list(SINK_TYPES)}")
+            _default_metrics = MetricsRegistry([SINK_TYPES[sink]() for sink in METRICS_SINKS])
+        return _default_metrics
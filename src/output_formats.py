@@ -1,26 +1,73 @@
 import random
-from typing import Annotated, NewType, List, Optional, Type, Literal
+from typing import Annotated, NewType, List, Optional, Type, Literal, ClassVar
 import json
 
-from pydantic import BaseModel, field_validator, Field, model_validator
+from pydantic import BaseModel, field_validator, Field, model_validator, TypeAdapter
+
+from output_repair import normalize_text, resolve_name, partial_json_string
 
 FORMAT_INSTRUCTIONS = """Please reformat your previous response as a JSON instance that conforms to the JSON structure below.
 Here is the output format:
 {schema}
 """
 
+RESPONSE_FORMAT_INSTRUCTIONS = """Respond with a JSON instance that conforms to the JSON structure below.
+Here is the output format:
+{schema}
+"""
+
 
 class OutputFormatModel(BaseModel):
+    streamed_field: ClassVar[str | None] = None
+    """The field shown to the other players while it is being generated, None if the output is only shown once done."""
+    phase: ClassVar[str] = "response"
+    """The phase of the game the output is for, the LLM calls generating it are measured under it."""
+
     @classmethod
     def get_format_instructions(cls) -> str:
         """Returns a string with instructions on how to format the output."""
+        # In the future, we could instead use get_annotations() to get the field descriptions
+        return FORMAT_INSTRUCTIONS.format(schema=json.dumps(cls.get_output_fields()))
+
+    @classmethod
+    def get_response_instructions(cls) -> str:
+        """Returns a string with instructions to respond directly in the output format, without a previous response."""
+        return RESPONSE_FORMAT_INSTRUCTIONS.format(schema=json.dumps(cls.get_output_fields()))
+
+    @classmethod
+    def get_output_fields(cls) -> dict[str, str]:
+        """Returns the descriptions of the fields the agent has to provide, excluded fields are filled by the game."""
         json_format = {}
         for field in cls.model_fields:
             if not cls.model_fields[field].exclude:
                 json_format[field] = cls.model_fields[field].description
 
-        # In the future, we could instead use get_annotations() to get the field descriptions
-        return FORMAT_INSTRUCTIONS.format(schema=json.dumps(json_format))
+        return json_format
+
+    @classmethod
+    def get_json_schema(cls) -> dict:
+        """Returns the JSON schema of the fields the agent has to provide, e.g. for JSON mode or function calling."""
+        properties = {}
+        for field in cls.get_output_fields():
+            field_info = cls.model_fields[field]
+            properties[field] = TypeAdapter(field_info.annotation).json_schema()
+            properties[field]["description"] = field_info.description
+
+        return {"type": "object", "properties": properties, "required": list(properties)}
+
+    @classmethod
+    def repair_fields(cls, fields: dict) -> dict:
+        """Fixes trivial mistakes in the fields before they are validated, by default normalizing text fields."""
+        for field in cls.get_output_fields():
+            if isinstance(fields.get(field), str):
+                fields[field] = normalize_text(fields[field])
+
+        return fields
+
+    @classmethod
+    def partial_output(cls, content: str) -> str | None:
+        """Returns the streamed field of a JSON response that is still being generated, None if it hasn't started."""
+        return partial_json_string(content, cls.streamed_field) if cls.streamed_field else None
 
 
 class AnimalDescriptionFormat(OutputFormatModel):
@@ -28,17 +75,31 @@ class AnimalDescriptionFormat(OutputFormatModel):
     description: str = Field(description="A brief description of the animal")
     """A brief description of the animal"""
 
+    streamed_field: ClassVar[str | None] = "description"
+    phase: ClassVar[str] = "description"
+
     @field_validator('description')
     @classmethod
     def check_starting_character(cls, v) -> str:
-        if not v[0].upper() == 'I':
+        if not v or not v[0].upper() == 'I':
             raise ValueError("Please rewrite your description so that it begins with 'I'")
         return v
 
 
 class ChameleonGuessFormat(OutputFormatModel):
+    animal_names: List[str] = Field([], exclude=True)
+    """The names of the animals that can be chosen as the secret animal"""
     animal: str = Field(description="Name of the animal you think the Herd is in its singular form, e.g. 'animal' not 'animals'")
 
+    phase: ClassVar[str] = "guess"
+
+    @classmethod
+    def repair_fields(cls, fields: dict) -> dict:
+        fields = super().repair_fields(fields)
+        if isinstance(fields.get("animal"), str) and fields.get("animal_names"):
+            fields["animal"] = resolve_name(fields["animal"], fields["animal_names"], "resolve_animal_name")
+        return fields
+
     @field_validator('animal')
     @classmethod
     def is_one_word(cls, v) -> str:
@@ -53,8 +114,18 @@ class HerdVoteFormat(OutputFormatModel):
     vote: str = Field(description="The name of the player you are voting for")
     """The name of the player you are voting for"""
 
+    phase: ClassVar[str] = "vote"
+
+    @classmethod
+    def repair_fields(cls, fields: dict) -> dict:
+        fields = super().repair_fields(fields)
+        if isinstance(fields.get("vote"), str) and fields.get("player_names"):
+            fields["vote"] = resolve_name(fields["vote"], fields["player_names"], "resolve_vote_name")
+        return fields
+
     @model_validator(mode="after")
     def check_player_exists(self) -> "HerdVoteFormat":
-        if self.vote.lower() not in [player.lower() for player in self.player_names]:
+        # Votes must match a name exactly, so that the player can be found. Mismatched case is fixed by repair_fields
+        if self.vote not in self.player_names:
             raise ValueError(f"Player {self.vote} does not exist, please vote for one of {self.player_names}")
         return self
\ No newline at end of file
@@ -0,0 +1,144 @@
+"""
+Local fixes for formatted responses that are almost right, so that they don't cost another round-trip to the model.
+"""
+import json
+import re
+import threading
+from collections import Counter
+from json import JSONDecodeError
+
+CODE_FENCE_PATTERN = re.compile(r"```(?:json|JSON)?\s*(.*?)\s*```", re.DOTALL)
+
+REPAIR_COUNTS = Counter()
+"""The number of times each repair has fixed a response."""
+
+_repair_counts_lock = threading.Lock()
+
+
+def count_repair(repair: str):
+    """Records that a repair has been applied."""
+    with _repair_counts_lock:
+        REPAIR_COUNTS[repair] += 1
+
+
+def repair_counts() -> dict[str, int]:
+    """Returns a snapshot of how often each repair has been applied."""
+    with _repair_counts_lock:
+        return dict(REPAIR_COUNTS)
+
+
+def parse_json_object(content: str) -> dict:
+    """
+    Parses a JSON object from a response, stripping code fences and surrounding text if needed.
+    Raises the original JSONDecodeError if no object can be found.
+    """
+    try:
+        return json.loads(content)
+    except JSONDecodeError as e:
+        error = e
+
+    fenced = CODE_FENCE_PATTERN.search(content)
+    if fenced:
+        try:
+            fields = json.loads(fenced.group(1))
+            count_repair("strip_code_fence")
+            return fields
+        except JSONDecodeError:
+            pass
+
+    fields = extract_json_object(content)
+    if fields is not None:
+        count_repair("extract_json_object")
+        return fields
+
+    raise error
+
+
+def extract_json_object(content: str) -> dict | None:
+    """Returns the first JSON object found in the content, or None if there isn't one."""
+    decoder = json.JSONDecoder()
+    start = content.find("{")
+    while start != -1:
+        try:
+            fields, _ = decoder.raw_decode(content, start)
+            if isinstance(fields, dict):
+                return fields
+        except JSONDecodeError:
+            pass
+        start = content.find("{", start + 1)
+
+    return None
+
+
+def normalize_text(value: str) -> str:
+    """
+    Strips surrounding whitespace, collapses runs of whitespace, and unwraps the value if it is wrapped in a matching
+    pair of quotes. Other quotes are kept, e.g. the apostrophe of "the lions' den '" or those of '"hi" and "bye"'.
+    """
+    normalized = " ".join(value.split())
+    quote = normalized[:1]
+    if len(normalized) >= 2 and quote in "\"'`" and normalized[-1] == quote and quote not in normalized[1:-1]:
+        normalized = normalized[1:-1].strip()
+    if normalized != value:
+        count_repair("normalize_text")
+    return normalized
+
+
+def resolve_name(value: str, names: list[str], repair: str) -> str:
+    """
+    Resolves a value to one of the canonical names, ignoring case, surrounding punctuation and plurals.
+    Returns the value unchanged if it doesn't resolve to exactly one name.
+    """
+    if value in names:
+        return value
+
+    candidate = value.strip(" .,!?:;").lower()
+    lowered = {name.lower(): name for name in names}
+
+    resolved = lowered.get(candidate)
+    if not resolved:
+        # Singular forms, e.g. "Foxes" -> "Fox" or "Dogs" -> "Dog"
+        for suffix in ["es", "s"]:
+            if candidate.endswith(suffix) and candidate[:-len(suffix)] in lowered:
+                resolved = lowered[candidate[:-len(suffix)]]
+                break
+
+    if not resolved:
+        # Sentences mentioning exactly one of the names, e.g. "I vote for Charlie"
+        mentioned = [name for name in names if re.search(rf"\b{re.escape(name.lower())}\b", candidate)]
+        if len(mentioned) == 1:
+            resolved = mentioned[0]
+
+    if resolved:
+        count_repair(repair)
+        return resolved
+
+    return value
+
+
+def partial_json_string(content: str, field: str) -> str | None:
+    """
+    Returns the value of a string field of a JSON object that is still being generated, as far as it has been.
+    Returns None if the value hasn't started yet. An escape sequence cut off at the end is left out until it's complete.
+    """
+    start = re.search(rf'"{re.escape(field)}"\s*:\s*"', content)
+    if not start:
+        return None
+
+    end = i = start.end()
+    while i < len(content) and content[i] != '"':
+        if content[i] == "\\":
+            i += 6 if content[i + 1:i + 2] == "u" else 2
+            if i > len(content):
+                break
+        else:
+            i += 1
+        end = i
+
+    value = content[start.end():end]
+    try:
+        # Not strict, since some models send raw newlines in strings anyway
+        return json.loads(f'"{value}"', strict=False)
+    except JSONDecodeError:
+        # An invalid escape, the value is shown as it is
+        return value
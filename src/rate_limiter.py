@@ -0,0 +1,295 @@
+"""
+A process-wide scheduler for completion requests, so that concurrent games share the provider's rate limits instead
+of all hitting them at once.
+
+Requests wait for room in token buckets of requests and tokens per minute (RATE_LIMIT_REQUESTS_PER_MINUTE and
+RATE_LIMIT_TOKENS_PER_MINUTE, 0 means unlimited). Waiting requests are served by priority, so interactive games with
+a human waiting on them go before background simulations, and a request only overtakes those ahead of it when there is
+room for all of them. Rate limit errors pause every request until the time the provider asked for, and failed requests
+are retried with jittered exponential backoff.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from typing import Callable, Awaitable, Literal, TypeVar
+
+import openai
+
+RATE_LIMIT_REQUESTS_PER_MINUTE = float(os.environ.get("RATE_LIMIT_REQUESTS_PER_MINUTE", 0))
+RATE_LIMIT_TOKENS_PER_MINUTE = float(os.environ.get("RATE_LIMIT_TOKENS_PER_MINUTE", 0))
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", 6))
+RATE_LIMIT_BACKOFF = float(os.environ.get("RATE_LIMIT_BACKOFF", 0.5))
+RATE_LIMIT_MAX_BACKOFF = float(os.environ.get("RATE_LIMIT_MAX_BACKOFF", 60.0))
+
+Priority = Literal["interactive", "normal", "background"]
+PRIORITY_ORDER = {"interactive": 0, "normal": 1, "background": 2}
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+"""The errors worth retrying, APIConnectionError includes timeouts."""
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Allows a number of units per minute, with bursts of up to a minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        """The number of units allowed per minute, 0 means unlimited."""
+        self.available = per_minute
+        """The number of units that can be taken right now."""
+        self._refilled_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self._refilled_at) * self.capacity / 60)
+        self._refilled_at = now
+
+    def has_room(self, amount: float) -> bool:
+        """Whether the amount can be taken right now."""
+        return not self.capacity or amount <= self.available
+
+    def wait_time(self, amount: float) -> float:
+        """Returns how long until the amount can be taken, in seconds."""
+        if not self.capacity:
+            return 0.0
+        # A request larger than the whole bucket only waits for a full bucket, otherwise it could never go
+        amount = min(amount, self.capacity)
+        return max(amount - self.available, 0) * 60 / self.capacity
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.available -= min(amount, self.capacity)
+
+
+class RateLimitScheduler:
+    """Decides when each completion request is sent, and retries the ones that fail."""
+
+    def __init__(
+            self,
+            requests_per_minute: float = RATE_LIMIT_REQUESTS_PER_MINUTE,
+            tokens_per_minute: float = RATE_LIMIT_TOKENS_PER_MINUTE,
+            max_retries: int = RATE_LIMIT_MAX_RETRIES,
+            backoff: float = RATE_LIMIT_BACKOFF,
+            max_backoff: float = RATE_LIMIT_MAX_BACKOFF
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        """The bucket of requests per minute."""
+        self.tokens = TokenBucket(tokens_per_minute)
+        """The bucket of tokens per minute."""
+        self.max_retries = max_retries
+        """The number of times a failed request is retried before its error is raised."""
+        self.backoff = backoff
+        """The delay before the first retry in seconds, doubled for each retry after it."""
+        self.max_backoff = max_backoff
+        """The longest delay between retries in seconds."""
+
+        self.rate_limited = 0
+        """The number of rate limit errors received."""
+        self.retries = 0
+        """The number of requests retried."""
+        self.total_wait = 0.0
+        """The total time requests have waited to be sent, in seconds."""
+
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._waiting: list[tuple[int, int]] = []
+        # The tokens each waiting ticket asks for, and the event loop and event of the tickets waiting asynchronously
+        self._waiting_tokens: dict[tuple[int, int], int] = {}
+        self._async_waiters: dict[tuple[int, int], tuple[asyncio.AbstractEventLoop, asyncio.Event]] = {}
+        self._tickets = itertools.count()
+        self._paused_until = 0.0
+
+    # Sending
+
+    def call(self, create: Callable[[], T], tokens: int, priority: Priority = "normal") -> T:
+        """Sends a request with create once the rate limits allow it, and retries it if it fails."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, priority)
+            try:
+                return create()
+            except RETRYABLE_ERRORS as e:
+                delay = self._retry_delay(e, attempt)
+            time.sleep(delay)
+
+    async def acall(self, create: Callable[[], Awaitable[T]], tokens: int, priority: Priority = "normal") -> T:
+        """Async version of call."""
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(tokens, priority)
+            try:
+                return await create()
+            except RETRYABLE_ERRORS as e:
+                delay = self._retry_delay(e, attempt)
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """Returns how long to wait before retrying a failed request, or raises the error if it is out of retries."""
+        if attempt >= self.max_retries:
+            raise error
+
+        # Full jitter, so that requests that failed together don't all retry together
+        delay = random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+        with self._lock:
+            self.retries += 1
+            if isinstance(error, openai.RateLimitError):
+                self.rate_limited += 1
+                retry_after = self.retry_after(error)
+                if retry_after is not None:
+                    delay = retry_after + random.uniform(0, self.backoff)
+                # The limit is shared by every request, so they all hold off
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._notify_all()
+
+        return delay
+
+    @staticmethod
+    def retry_after(error: openai.APIStatusError) -> float | None:
+        """Returns how long the provider asked to wait before retrying in seconds, if it did."""
+        headers = error.response.headers
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+        except ValueError:
+            # Retry-After can also be an HTTP date, which isn't worth parsing here
+            pass
+        return None
+
+    # Waiting
+
+    def acquire(self, tokens: int, priority: Priority = "normal"):
+        """Blocks until the request can be sent, serving waiting requests by priority and then in order."""
+        with self._condition:
+            if self._take_right_away(tokens):
+                return
+            ticket = self._enqueue(priority, tokens)
+            start = time.monotonic()
+            while (wait := self._try_acquire(ticket, tokens)) > 0:
+                self._condition.wait(wait)
+            self.total_wait += time.monotonic() - start
+
+    async def aacquire(self, tokens: int, priority: Priority = "normal"):
+        """Async version of acquire, the event loop is woken by an event instead of waiting on the condition."""
+        with self._lock:
+            if self._take_right_away(tokens):
+                return
+            ticket = self._enqueue(priority, tokens)
+            woken = asyncio.Event()
+            self._async_waiters[ticket] = (asyncio.get_running_loop(), woken)
+        start = time.monotonic()
+        try:
+            while True:
+                with self._lock:
+                    woken.clear()
+                    wait = self._try_acquire(ticket, tokens)
+                    if wait <= 0:
+                        self.total_wait += time.monotonic() - start
+                        return
+                try:
+                    await asyncio.wait_for(woken.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            with self._lock:
+                self._remove(ticket)
+            raise
+
+    def _take_right_away(self, tokens: int) -> bool:
+        """
+        Takes from the buckets if no request is waiting and there is room, so the request doesn't have to queue.
+        Must be called with the lock held.
+        """
+        now = time.monotonic()
+        if self._waiting or now < self._paused_until:
+            return False
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        if not self.requests.has_room(1) or not self.tokens.has_room(tokens):
+            return False
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        return True
+
+    def _enqueue(self, priority: Priority, tokens: int) -> tuple[int, int]:
+        """Adds a request to the waiting line. Must be called with the lock held."""
+        ticket = (PRIORITY_ORDER[priority], next(self._tickets))
+        heapq.heappush(self._waiting, ticket)
+        self._waiting_tokens[ticket] = tokens
+        return ticket
+
+    def _try_acquire(self, ticket: tuple[int, int], tokens: int) -> float:
+        """
+        Takes from the buckets if there is room for the request, and for the requests ahead of it if it isn't first in
+        line, and returns 0. Otherwise returns how long to wait before trying again, unless woken up sooner by a request
+        leaving the line. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        if self._waiting[0] == ticket:
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+        else:
+            # Overtaking the requests ahead must not delay them
+            ahead = [other for other in self._waiting if other < ticket]
+            requests_needed = len(ahead) + 1
+            tokens_needed = sum(self._waiting_tokens[other] for other in ahead) + tokens
+            if self.requests.has_room(requests_needed) and self.tokens.has_room(tokens_needed):
+                wait = 0.0
+            else:
+                # Without a wait, there will never be room for it and the requests ahead together, so it goes after
+                # them and is woken up as they leave
+                wait = max(self.requests.wait_time(requests_needed), self.tokens.wait_time(tokens_needed)) or 60.0
+        if wait > 0:
+            return wait
+
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self._remove(ticket)
+        return 0.0
+
+    def _remove(self, ticket: tuple[int, int]):
+        """Takes a request out of the waiting line and wakes up the others. Must be called with the lock held."""
+        self._waiting.remove(ticket)
+        heapq.heapify(self._waiting)
+        del self._waiting_tokens[ticket]
+        self._async_waiters.pop(ticket, None)
+        self._notify_all()
+
+    def _notify_all(self):
+        """Wakes up every waiting request, sync or async. Must be called with the lock held."""
+        self._condition.notify_all()
+        for loop, woken in self._async_waiters.values():
+            # The waiter may be on another thread's event loop, which may have been closed since
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(woken.set)
+
+    def stats(self) -> dict:
+        """Returns the number of waiting requests and the scheduler's counters."""
+        with self._lock:
+            return {
+                "waiting": len(self._waiting),
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+                "total_wait": self.total_wait,
+            }
+
+
+_default_scheduler: RateLimitScheduler | None = None
+_default_scheduler_lock = threading.Lock()
+
+
+def default_rate_limiter() -> RateLimitScheduler:
+    """Returns the process-wide scheduler configured by the environment."""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RateLimitScheduler()
+        return _default_scheduler
@@ -0,0 +1,398 @@
+"""
+Replays logged games from the messages written by data_collection.save, on either the JSONL or MongoDB backend.
+
+Messages of a game are streamed in message_number order, and the state of each round (roles, descriptions, guess,
+votes and scores) is reconstructed from them, so unfinished games can be replayed too.
+JSONL logs are indexed in a SQLite database, so a game or round can be read without scanning the whole log, across
+every segment the log has been rotated into.
+
+Usage: python src/replay.py GAME_ID [--round N]
+"""
+import argparse
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+from typing import Iterator, List, Dict
+
+from pydantic import BaseModel
+
+from player import Role
+from message import AgentMessage
+from data_collection import DATA_COLLECTION_MODE, DATA_DIR, DB_NAME, get_mongo_client
+from segmented_log import LogPosition, SegmentedLog, get_segmented_log
+
+REPLAY_INDEX_PATH = os.environ.get("REPLAY_INDEX_PATH", DATA_DIR / "replay_index.sqlite")
+
+# The game messages that the round state is reconstructed from
+ROUND_START_PATTERN = re.compile(r"^The secret animal is (?P<animal>.+)\.$")
+CHAMELEON_PATTERN = re.compile(r"^(?P<name>.+) is the Chameleon!$")
+GUESS_PATTERN = re.compile(r"^The Chameleon was (?P<name>.+), and they guessed the secret animal was (?P<guess>.+)\.$")
+VOTE_PATTERN = re.compile(r"^(?P<voter>.+) voted for (?P<voted_for>.+)$")
+SCORE_HEADER = "Current Game Score:\n"
+VOTES_HEADER = "All players have voted!"
+
+REPLAY_INDEX_VERSION = 1
+"""Bumped when the index tables change, older indexes are rebuilt from scratch."""
+
+
+class RoundState(BaseModel):
+    """The state of a round, reconstructed from the logged messages."""
+
+    round_index: int
+    """The index of the round in the game, starting at 0."""
+    herd_animal: str
+    """The secret animal of the round."""
+    chameleon_id: str | None = None
+    """The id of the Chameleon."""
+    roles: Dict[str, Role] = {}
+    """The role of each player, by player id."""
+    player_names: Dict[str, str] = {}
+    """The name of each player, by player id."""
+    animal_descriptions: List[dict] = []
+    """The animal description of each player, in the same shape as ChameleonGame.all_animal_descriptions."""
+    chameleon_guess: str | None = None
+    """The animal the Chameleon guessed."""
+    herd_vote_tally: List[dict] = []
+    """The votes of the Herd, in the same shape as ChameleonGame.herd_vote_tallies."""
+    scores: Dict[str, int] = {}
+    """The points of each player at the end of the round, by player id."""
+    first_message_number: int
+    """The number of the first message of the round."""
+    last_message_number: int
+    """The number of the last message of the round."""
+
+    @property
+    def is_complete(self) -> bool:
+        """Whether the round has been resolved."""
+        return bool(self.scores)
+
+    @classmethod
+    def from_messages(cls, round_index: int, messages: List[AgentMessage], player_ids: List[str]) -> "RoundState":
+        """Reconstructs the state of a round from its messages, starting with the announcement of the secret animal."""
+        herd_animal = ROUND_START_PATTERN.match(messages[0].content).group("animal")
+        state = cls(
+            round_index=round_index,
+            herd_animal=herd_animal,
+            first_message_number=messages[0].message_number,
+            last_message_number=messages[-1].message_number
+        )
+        ids_by_name = {}
+        chameleon_name = None
+        votes_announced = False
+
+        for message in messages:
+            content = message.content
+
+            if message.type == "debug" and CHAMELEON_PATTERN.match(content):
+                chameleon_name = CHAMELEON_PATTERN.match(content).group("name")
+
+            elif message.type != "info":
+                continue
+
+            elif content == VOTES_HEADER:
+                votes_announced = True
+
+            elif content.startswith(SCORE_HEADER):
+                for line in content[len(SCORE_HEADER):].splitlines():
+                    name, _, points = line.rpartition(": ")
+                    if name in ids_by_name:
+                        state.scores[ids_by_name[name]] = int(points)
+
+            elif GUESS_PATTERN.match(content):
+                state.chameleon_guess = GUESS_PATTERN.match(content).group("guess")
+
+            elif votes_announced and VOTE_PATTERN.match(content):
+                vote = VOTE_PATTERN.match(content)
+                if vote.group("voter") in ids_by_name and vote.group("voted_for") in ids_by_name:
+                    state.herd_vote_tally.append({
+                        "voter_id": ids_by_name[vote.group("voter")],
+                        "voted_for_id": ids_by_name[vote.group("voted_for")]
+                    })
+
+            else:
+                # Descriptions are sent to every player except the one describing themselves
+                missing_players = [player_id for player_id in player_ids if player_id not in message.agent_ids]
+                if len(missing_players) == 1 and ": " in content:
+                    name, description = content.split(": ", 1)
+                    player_id = missing_players[0]
+                    ids_by_name[name] = player_id
+                    state.player_names[player_id] = name
+                    state.animal_descriptions.append({"player_id": player_id, "description": description})
+
+        state.chameleon_id = ids_by_name.get(chameleon_name)
+        state.roles = {
+            player_id: "chameleon" if player_id == state.chameleon_id else "herd" for player_id in state.player_names
+        }
+
+        return state
+
+
+class JsonlLogSource:
+    """Reads logged games from the JSONL files, through an index of where each game's messages and rounds are."""
+
+    def __init__(self, data_dir: str | os.PathLike = DATA_DIR, index_path: str | os.PathLike = REPLAY_INDEX_PATH):
+        self.data_dir = pathlib.Path(data_dir)
+        """The directory containing the JSONL files."""
+        self.index_path = pathlib.Path(index_path)
+        """The SQLite database that indexes the JSONL files."""
+
+        self._lock = threading.Lock()
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != REPLAY_INDEX_VERSION:
+            self._connection.executescript("""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS positions;
+                DROP TABLE IF EXISTS messages;
+                DROP TABLE IF EXISTS rounds;
+                DROP TABLE IF EXISTS records;
+            """)
+            self._connection.execute(f"PRAGMA user_version = {REPLAY_INDEX_VERSION}")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS positions (collection TEXT PRIMARY KEY, segment INTEGER, offset INTEGER);
+            CREATE TABLE IF NOT EXISTS messages (game_id TEXT, message_number INTEGER, segment INTEGER, offset INTEGER);
+            CREATE INDEX IF NOT EXISTS messages_by_game ON messages (game_id, message_number);
+            CREATE TABLE IF NOT EXISTS rounds (game_id TEXT, round_index INTEGER, message_number INTEGER);
+            CREATE INDEX IF NOT EXISTS rounds_by_game ON rounds (game_id, round_index);
+            CREATE TABLE IF NOT EXISTS records (collection TEXT, game_id TEXT, segment INTEGER, offset INTEGER);
+            CREATE INDEX IF NOT EXISTS records_by_game ON records (collection, game_id);
+        """)
+
+    def update_index(self):
+        """Indexes the records appended to the JSONL files since the last update."""
+        with self._lock, self._connection:
+            for collection in ["messages", "players", "games"]:
+                self._index_file(collection)
+
+    def _index_file(self, collection: str):
+        row = self._connection.execute(
+            "SELECT segment, offset FROM positions WHERE collection = ?", (collection,)
+        ).fetchone()
+        position = LogPosition(*row) if row else LogPosition(0, 0)
+        round_counts = {}
+
+        # A line still being written isn't read, it will be indexed by the next update
+        for position, line in self._log(collection).iter_lines(position):
+            record = json.loads(line)
+            game_id = record.get("game_id")
+
+            if collection == "messages":
+                self._connection.execute(
+                    "INSERT INTO messages VALUES (?, ?, ?, ?)", (game_id, record["message_number"], *position)
+                )
+                if record["type"] == "debug" and ROUND_START_PATTERN.match(record["content"]):
+                    if game_id not in round_counts:
+                        round_counts[game_id] = self._connection.execute(
+                            "SELECT COUNT(*) FROM rounds WHERE game_id = ?", (game_id,)
+                        ).fetchone()[0]
+                    self._connection.execute(
+                        "INSERT INTO rounds VALUES (?, ?, ?)",
+                        (game_id, round_counts[game_id], record["message_number"])
+                    )
+                    round_counts[game_id] += 1
+            else:
+                self._connection.execute("INSERT INTO records VALUES (?, ?, ?, ?)", (collection, game_id, *position))
+
+            # Indexing carries on from the end of the last line
+            position = LogPosition(position.segment, position.offset + len(line))
+
+        self._connection.execute("INSERT OR REPLACE INTO positions VALUES (?, ?, ?)", (collection, *position))
+
+    def _log(self, collection: str) -> SegmentedLog:
+        return get_segmented_log(self.data_dir, collection)
+
+    def iter_messages(self, game_id: str, start: int = None, stop: int = None) -> Iterator[dict]:
+        """Yields the message records of a game in message_number order, optionally within [start, stop)."""
+        self.update_index()
+        query = "SELECT segment, offset FROM messages WHERE game_id = ?"
+        parameters = [game_id]
+        if start is not None:
+            query += " AND message_number >= ?"
+            parameters.append(start)
+        if stop is not None:
+            query += " AND message_number < ?"
+            parameters.append(stop)
+
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY message_number", parameters)
+            positions = [LogPosition(*row) for row in rows]
+        yield from self._read_lines("messages", positions)
+
+    def round_starts(self, game_id: str) -> List[int]:
+        """Returns the message_number of the first message of each round of a game."""
+        self.update_index()
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT message_number FROM rounds WHERE game_id = ? ORDER BY round_index", (game_id,)
+            )
+            return [row[0] for row in rows]
+
+    def game_record(self, game_id: str) -> dict | None:
+        """Returns the record of a finished game, or None if the game hasn't finished."""
+        return next(self._records("games", game_id), None)
+
+    def player_records(self, game_id: str) -> List[dict]:
+        """Returns the records of the players of a finished game."""
+        return list(self._records("players", game_id))
+
+    def game_ids(self) -> List[str]:
+        """Returns the ids of all the logged games."""
+        self.update_index()
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT DISTINCT game_id FROM messages")]
+
+    def _records(self, collection: str, game_id: str) -> Iterator[dict]:
+        self.update_index()
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT segment, offset FROM records WHERE collection = ? AND game_id = ? ORDER BY segment, offset",
+                (collection, game_id)
+            )
+            positions = [LogPosition(*row) for row in rows]
+        yield from self._read_lines(collection, positions)
+
+    def _read_lines(self, collection: str, positions: List[LogPosition]) -> Iterator[dict]:
+        for line in self._log(collection).read_lines(positions):
+            yield json.loads(line)
+
+
+class MongoLogSource:
+    """Reads logged games from MongoDB."""
+
+    def __init__(self, db=None):
+        self.db = db if db is not None else get_mongo_client()[DB_NAME]
+        """The database the games are logged to."""
+
+    def ensure_indexes(self):
+        """Creates the indexes that make reading a single game or round fast."""
+        self.db["messages"].create_index([("game_id", 1), ("message_number", 1)])
+        self.db["players"].create_index("game_id")
+        self.db["games"].create_index("game_id")
+
+    def iter_messages(self, game_id: str, start: int = None, stop: int = None) -> Iterator[dict]:
+        """Yields the message records of a game in message_number order, optionally within [start, stop)."""
+        query = {"game_id": game_id}
+        message_number = {}
+        if start is not None:
+            message_number["$gte"] = start
+        if stop is not None:
+            message_number["$lt"] = stop
+        if message_number:
+            query["message_number"] = message_number
+
+        yield from self.db["messages"].find(query, {"_id": False}).sort("message_number", 1)
+
+    def round_starts(self, game_id: str) -> List[int]:
+        """Returns the message_number of the first message of each round of a game."""
+        query = {"game_id": game_id, "type": "debug", "content": {"$regex": ROUND_START_PATTERN.pattern}}
+        records = self.db["messages"].find(query, {"message_number": True}).sort("message_number", 1)
+        return [record["message_number"] for record in records]
+
+    def game_record(self, game_id: str) -> dict | None:
+        """Returns the record of a finished game, or None if the game hasn't finished."""
+        return self.db["games"].find_one({"game_id": game_id}, {"_id": False})
+
+    def player_records(self, game_id: str) -> List[dict]:
+        """Returns the records of the players of a finished game."""
+        return list(self.db["players"].find({"game_id": game_id}, {"_id": False}))
+
+    def game_ids(self) -> List[str]:
+        """Returns the ids of all the logged games."""
+        return self.db["messages"].distinct("game_id")
+
+
+LogSource = JsonlLogSource | MongoLogSource
+
+
+def default_log_source() -> LogSource:
+    """Returns the log source matching the current data collection mode."""
+    if DATA_COLLECTION_MODE.upper() == "MONGODB":
+        return MongoLogSource()
+    return JsonlLogSource()
+
+
+class GameReplay:
+    """Replays a single logged game."""
+
+    def __init__(self, game_id: str, source: LogSource = None):
+        self.game_id = game_id
+        """The id of the game being replayed."""
+        self.source = source or default_log_source()
+        """Where the game's logs are read from."""
+        self._round_starts = self.source.round_starts(game_id)
+        self._player_ids = None
+
+    @property
+    def number_of_rounds(self) -> int:
+        """The number of rounds that were started."""
+        return len(self._round_starts)
+
+    @property
+    def player_ids(self) -> List[str]:
+        """The ids of the players in the game, excluding observers."""
+        if self._player_ids is None:
+            player_ids = set()
+            for message in self.source.iter_messages(self.game_id, stop=self._round_stop(0)):
+                player_ids.update(message["agent_ids"])
+            self._player_ids = sorted(player_id for player_id in player_ids if not player_id.endswith("-observer"))
+        return self._player_ids
+
+    def messages(self, round_index: int = None) -> Iterator[AgentMessage]:
+        """Yields the messages of the game in order, or only those of a round."""
+        if round_index is None:
+            records = self.source.iter_messages(self.game_id)
+        else:
+            records = self.source.iter_messages(
+                self.game_id, self._round_starts[round_index], self._round_stop(round_index)
+            )
+
+        for record in records:
+            yield AgentMessage.model_validate(record)
+
+    def round(self, round_index: int) -> RoundState:
+        """Reconstructs the state of a round, only reading the messages of that round."""
+        if round_index < 0:
+            round_index += self.number_of_rounds
+        return RoundState.from_messages(round_index, list(self.messages(round_index)), self.player_ids)
+
+    def rounds(self) -> Iterator[RoundState]:
+        """Reconstructs the state of every round in order."""
+        for round_index in range(self.number_of_rounds):
+            yield self.round(round_index)
+
+    def winner_id(self) -> str | None:
+        """The id of the winner, or None if the game hasn't finished."""
+        record = self.source.game_record(self.game_id)
+        return record.get("winner_id") if record else None
+
+    def _round_stop(self, round_index: int) -> int | None:
+        """Returns the message_number of the first message after a round, None for the last round."""
+        if round_index + 1 < len(self._round_starts):
+            return self._round_starts[round_index + 1]
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a logged game of Chameleon.")
+    parser.add_argument("game_id", help="The id of the game to replay.")
+    parser.add_argument("--round", type=int, default=None, help="Only show this round, starting at 1.")
+    parser.add_argument("--state", action="store_true", help="Show the reconstructed state instead of the messages.")
+    args = parser.parse_args()
+
+    replay = GameReplay(args.game_id)
+    round_indexes = [args.round - 1] if args.round else range(replay.number_of_rounds)
+
+    if args.state:
+        for round_index in round_indexes:
+            print(replay.round(round_index).model_dump_json(indent=2))
+    else:
+        messages = replay.messages(args.round - 1) if args.round else replay.messages()
+        for message in messages:
+            print(f"[{message.message_number}] ({message.type}) {message.content}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+An append-only JSONL log split into segments, so a log can grow indefinitely without a single huge file.
+
+Records are appended to the active segment, which stays at the log's original path (e.g. data/messages.jsonl). Once it
+reaches DATA_COLLECTION_SEGMENT_BYTES, or is older than DATA_COLLECTION_SEGMENT_SECONDS, it is closed: moved into the
+log's directory (e.g. data/messages/000003.jsonl.gz), compressed with gzip, and listed in the directory's manifest.json
+along with the game ids and message_number ranges it contains.
+
+The active segment and the lock file are kept open for the life of the log. Processes append to the active segment
+under a shared lock, relying on appends being atomic, and only closing it takes the exclusive lock.
+
+Readers address records by position, a segment number and a byte offset into the uncompressed segment, and iterate
+across the closed segments and the active one as if they were a single file.
+"""
+import gzip
+import json
+import os
+import pathlib
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, NamedTuple, IO, List
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where only the threads of a single process are kept from rotating at the same time
+    fcntl = None
+
+DATA_COLLECTION_SEGMENT_BYTES = int(os.environ.get("DATA_COLLECTION_SEGMENT_BYTES", 64 * 1024 * 1024))
+DATA_COLLECTION_SEGMENT_SECONDS = float(os.environ.get("DATA_COLLECTION_SEGMENT_SECONDS", 0))
+
+MANIFEST_FILE = "manifest.json"
+
+
+class LogPosition(NamedTuple):
+    """Where a record starts in a segmented log."""
+    segment: int
+    """The number of the segment, the active segment comes after every closed one."""
+    offset: int
+    """The byte offset of the record in the uncompressed segment."""
+
+
+class SegmentedLog:
+    """A JSONL log of one collection, rotated into compressed segments."""
+
+    def __init__(
+            self,
+            directory: str | os.PathLike,
+            collection: str,
+            max_bytes: int = DATA_COLLECTION_SEGMENT_BYTES,
+            max_seconds: float = DATA_COLLECTION_SEGMENT_SECONDS
+    ):
+        self.directory = pathlib.Path(directory)
+        """The directory the log is in."""
+        self.collection = collection
+        """The name of the collection logged, e.g. messages."""
+        self.max_bytes = max_bytes
+        """The size at which the active segment is closed, 0 means segments aren't closed by size."""
+        self.max_seconds = max_seconds
+        """The age at which the active segment is closed, 0 means segments aren't closed by age."""
+
+        self._lock = threading.Lock()
+        self._active_since: float | None = None
+        # Opened on first use, and again in a forked process since descriptors inherited from the parent share its locks
+        self._pid: int | None = None
+        self._lock_fd: int | None = None
+        self._active_fd: int | None = None
+
+    @property
+    def active_path(self) -> pathlib.Path:
+        return self.directory / f"{self.collection}.jsonl"
+
+    @property
+    def segments_dir(self) -> pathlib.Path:
+        return self.directory / self.collection
+
+    @property
+    def manifest_path(self) -> pathlib.Path:
+        return self.segments_dir / MANIFEST_FILE
+
+    # Writing
+
+    def append(self, data: str):
+        """Appends complete lines to the active segment, closing it first if it is due."""
+        data = data.encode()
+        with self._locked(shared=True):
+            if not self._rotation_due(self._active_size()):
+                self._write(data)
+                return
+
+        with self._locked():
+            # Another process may have closed the segment in between
+            size = self._active_size()
+            if self._rotation_due(size):
+                if size:
+                    self._rotate()
+                else:
+                    # The age of the first segment is counted from its first record
+                    self._save_manifest(self.manifest())
+            self._write(data)
+
+    def rotate(self):
+        """Closes the active segment, if it has any records."""
+        with self._locked():
+            if self._active_size():
+                self._rotate()
+
+    def _active_size(self) -> int:
+        """Returns the size of the active segment, (re)opening it if it isn't open or has been closed since."""
+        if self._active_fd is not None:
+            stat = os.fstat(self._active_fd)
+            if stat.st_nlink:
+                return stat.st_size
+            # Closed by another process, whose rotation has already moved the records written to it
+            self._close_active()
+        self._active_fd = os.open(self.active_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return os.fstat(self._active_fd).st_size
+
+    def _close_active(self):
+        os.close(self._active_fd)
+        self._active_fd = None
+
+    def _write(self, data: bytes):
+        """Appends to the active segment, with a single write unless the disk is full."""
+        if self._active_fd is None:
+            self._active_size()
+        while data:
+            data = data[os.write(self._active_fd, data):]
+
+    def _rotation_due(self, size: int) -> bool:
+        """Whether the active segment is due to be closed, or its manifest to be started if it is still empty."""
+        if not size:
+            return bool(self.max_seconds) and not self.manifest_path.exists()
+        if self.max_bytes and size >= self.max_bytes:
+            return True
+        if self.max_seconds:
+            # Another process may have rotated since, so the manifest is only read when the cached time says it's due
+            if self._active_since is None or time.time() - self._active_since >= self.max_seconds:
+                self._active_since = self.manifest()["active_since"]
+            return time.time() - self._active_since >= self.max_seconds
+        return False
+
+    def _rotate(self):
+        """Moves the active segment into the segments directory, compresses it and adds it to the manifest."""
+        manifest = self.manifest()
+        self._close_pending(manifest)
+
+        number = len(manifest["segments"])
+        opened_at = manifest["active_since"]
+        # New records go to a new active segment from here on
+        os.replace(self.active_path, self._segment_path(number, compressed=False))
+        if self._active_fd is not None:
+            self._close_active()
+        manifest["active_since"] = self._active_since = time.time()
+        self._close_pending(manifest, opened_at)
+
+    def _close_pending(self, manifest: dict, opened_at: float = None):
+        """Compresses a segment that was moved but not yet added to the manifest, e.g. because of a crash."""
+        number = len(manifest["segments"])
+        path = self._segment_path(number, compressed=False)
+        if not path.exists():
+            return
+
+        entry = self._describe_segment(path, number)
+        entry["opened_at"], entry["closed_at"] = opened_at, time.time()
+
+        compressed_path = self._segment_path(number)
+        temporary_path = compressed_path.with_suffix(".tmp")
+        with open(path, "rb") as source, gzip.open(temporary_path, "wb") as destination:
+            shutil.copyfileobj(source, destination)
+        os.replace(temporary_path, compressed_path)
+        entry["compressed_bytes"] = os.path.getsize(compressed_path)
+
+        manifest["segments"].append(entry)
+        self._save_manifest(manifest)
+        path.unlink()
+
+    def _describe_segment(self, path: pathlib.Path, number: int) -> dict:
+        """Returns the manifest entry of a segment, with the message_number range of each game in it."""
+        records = 0
+        games: dict[str, list[int] | None] = {}
+        with open(path, "rb") as f:
+            for line in f:
+                record = json.loads(line)
+                records += 1
+                game_id, message_number = record.get("game_id"), record.get("message_number")
+                if message_number is None:
+                    games.setdefault(game_id, None)
+                elif games.get(game_id) is None:
+                    games[game_id] = [message_number, message_number]
+                else:
+                    games[game_id] = [min(games[game_id][0], message_number), max(games[game_id][1], message_number)]
+
+        return {
+            "segment": number,
+            "file": self._segment_path(number).name,
+            "records": records,
+            "bytes": os.path.getsize(path),
+            "games": games,
+        }
+
+    def _segment_path(self, number: int, compressed: bool = True) -> pathlib.Path:
+        return self.segments_dir / (f"{number:06d}.jsonl.gz" if compressed else f"{number:06d}.jsonl")
+
+    # Manifest
+
+    def manifest(self) -> dict:
+        """
+        Returns the manifest of the closed segments, in order. Each segment lists the games it has records of, with
+        the range of their message_numbers for messages, along with its number of records and size.
+        """
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"active_since": time.time(), "segments": []}
+
+    def _save_manifest(self, manifest: dict):
+        temporary_path = self.manifest_path.with_suffix(".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temporary_path, self.manifest_path)
+
+    def _active_segment(self) -> int:
+        """Returns the number of the active segment, which comes after a segment left uncompressed by a crash."""
+        closed_segments = len(self.manifest()["segments"])
+        return closed_segments + self._segment_path(closed_segments, compressed=False).exists()
+
+    def segments_with_game(self, game_id: str) -> List[int]:
+        """Returns the numbers of the segments that may have records of a game, including the active segment."""
+        segments = self.manifest()["segments"]
+        return [segment["segment"] for segment in segments if game_id in segment["games"]] + [len(segments)]
+
+    # Reading
+
+    def iter_lines(self, start: LogPosition = LogPosition(0, 0)) -> Iterator[tuple[LogPosition, bytes]]:
+        """
+        Yields each complete line from the start position onwards, across segments, along with its position.
+        A line still being written at the end of the active segment is left for the next read.
+        """
+        with self._locked(shared=True):
+            # Opened together, so the active segment can't be closed in between and read twice or skipped
+            active_segment = self._active_segment()
+            active_file = open(self.active_path, "rb") if self.active_path.exists() else None
+
+        try:
+            for number in range(start.segment, active_segment + 1):
+                offset = start.offset if number == start.segment else 0
+                if number == active_segment:
+                    if active_file is None:
+                        break
+                    f = active_file
+                else:
+                    f = self.open_segment(number)
+
+                with f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        yield LogPosition(number, offset), line
+                        offset += len(line)
+        finally:
+            if active_file is not None:
+                active_file.close()
+
+    def open_segment(self, number: int) -> IO[bytes]:
+        """Opens a segment for reading its uncompressed lines, whether it has been closed or not."""
+        for path in [self._segment_path(number), self._segment_path(number, compressed=False)]:
+            if path.exists():
+                return gzip.open(path, "rb") if path.suffix == ".gz" else open(path, "rb")
+
+        if number == self._active_segment() and self.active_path.exists():
+            return open(self.active_path, "rb")
+        raise FileNotFoundError(f"Segment {number} of {self.collection} doesn't exist")
+
+    def read_lines(self, positions: List[LogPosition]) -> Iterator[bytes]:
+        """Yields the lines at each position, keeping a segment open while consecutive positions are in it."""
+        f, current_segment = None, None
+        try:
+            for position in positions:
+                if position.segment != current_segment:
+                    if f is not None:
+                        f.close()
+                    f, current_segment = self.open_segment(position.segment), position.segment
+                f.seek(position.offset)
+                yield f.readline()
+        finally:
+            if f is not None:
+                f.close()
+
+    @contextmanager
+    def _locked(self, shared: bool = False):
+        # Held across processes, so that a segment is never closed while another process is appending to it
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid, self._lock_fd, self._active_fd = os.getpid(), None, None
+            if self._lock_fd is None:
+                self.segments_dir.mkdir(parents=True, exist_ok=True)
+                self._lock_fd = os.open(self.segments_dir / ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+
+            if fcntl is None:
+                yield
+                return
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+
+_logs: dict[tuple[pathlib.Path, str], SegmentedLog] = {}
+_logs_lock = threading.Lock()
+
+
+def get_segmented_log(directory: str | os.PathLike, collection: str) -> SegmentedLog:
+    """Returns the log of a collection in a directory, shared by the whole process."""
+    key = (pathlib.Path(directory), collection)
+    with _logs_lock:
+        if key not in _logs:
+            _logs[key] = SegmentedLog(*key)
+        return _logs[key]
@@ -0,0 +1,148 @@
+"""
+Runs AI only games of Chameleon headlessly across a pool of worker processes and writes a summary of the results.
+
+Usage: python src/simulate.py --games 100 --workers 8 --output data/simulation_summary.json
+"""
+import argparse
+import json
+import os
+import pathlib
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from pydantic import BaseModel
+
+from game_chameleon import ChameleonGame
+from agent_interfaces import OpenAIAgentInterface, QuietObserverInterface
+from data_collection import flush
+
+DEFAULT_OUTPUT = pathlib.Path(__file__).parent.parent / "data" / "simulation_summary.json"
+
+
+class GameResult(BaseModel):
+    """The outcome of a single simulated game."""
+
+    game_id: str | None = None
+    """The id of the game."""
+    winner_id: str | None = None
+    """The id of the player who won the game."""
+    winner_name: str | None = None
+    """The name of the player who won the game."""
+    rounds: int = 0
+    """The number of rounds played."""
+    chameleon_guess_rate: float | None = None
+    """The fraction of rounds in which the Chameleon guessed the secret animal."""
+    chameleon_escape_rate: float | None = None
+    """The fraction of rounds in which the Herd failed to accuse the Chameleon."""
+    retries: int = 0
+    """The number of times AI players had to be asked to fix the format of a response."""
+    duration: float = 0
+    """The number of seconds the game took."""
+    error: str | None = None
+    """The error that stopped the game, if any."""
+
+    @classmethod
+    def from_game(cls, game: ChameleonGame, duration: float) -> "GameResult":
+        """Gathers the results of a finished game."""
+        finished_rounds = [round_record for round_record in game.rounds if round_record.herd_votes]
+        rounds = len(finished_rounds)
+        correct_guesses = sum(
+            round_record.chameleon_guess.lower() == round_record.herd_animal.lower() for round_record in finished_rounds
+        )
+        escapes = sum(
+            game.count_chameleon_votes(round_record.herd_votes) != round_record.chameleon_id
+            for round_record in finished_rounds
+        )
+        winner = game.player_from_id(game.winner_id)
+
+        return cls(
+            game_id=game.game_id,
+            winner_id=game.winner_id,
+            winner_name=winner.name if winner else None,
+            rounds=rounds,
+            chameleon_guess_rate=correct_guesses / rounds if rounds else None,
+            chameleon_escape_rate=escapes / rounds if rounds else None,
+            retries=sum(player.interface.format_retries for player in game.players),
+            duration=duration
+        )
+
+
+def simulate_game(game_number: int, model_name: str = None, seed: int = None) -> GameResult:
+    """Runs a single AI only game to completion."""
+    # Forked workers inherit the parent's random state, so every game must reseed or they would all be identical
+    random.seed(seed + game_number if seed is not None else None)
+
+    ai_interface = OpenAIAgentInterface
+    if model_name:
+        ai_interface = partial(OpenAIAgentInterface, model_name=model_name)
+
+    start = time.monotonic()
+    game = None
+    try:
+        game = ChameleonGame.from_human_name(human_interface=QuietObserverInterface, ai_interface=ai_interface)
+        game.run_game()
+        return GameResult.from_game(game, time.monotonic() - start)
+    except Exception as e:
+        return GameResult(
+            game_id=game.game_id if game else None,
+            duration=time.monotonic() - start,
+            error=f"{type(e).__name__}: {e}"
+        )
+    finally:
+        flush()
+
+
+def summarize(results: list[GameResult], duration: float) -> dict:
+    """Aggregates the results of all the simulated games."""
+    completed = [result for result in results if not result.error]
+    rounds = sum(result.rounds for result in completed)
+
+    def weighted_rate(field: str) -> float | None:
+        # Weighted by rounds, so that long games count for more than short ones
+        if not rounds:
+            return None
+        return sum(getattr(result, field) * result.rounds for result in completed if result.rounds) / rounds
+
+    return {
+        "games": len(results),
+        "completed": len(completed),
+        "errors": len(results) - len(completed),
+        "rounds": rounds,
+        "average_rounds": rounds / len(completed) if completed else None,
+        "chameleon_guess_rate": weighted_rate("chameleon_guess_rate"),
+        "chameleon_escape_rate": weighted_rate("chameleon_escape_rate"),
+        "retries": sum(result.retries for result in results),
+        "duration": duration,
+        "games_per_second": len(results) / duration if duration else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run AI only games of Chameleon headlessly.")
+    parser.add_argument("--games", type=int, default=10, help="The number of games to run.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="The number of worker processes.")
+    parser.add_argument("--output", type=pathlib.Path, default=DEFAULT_OUTPUT, help="Where to write the summary.")
+    parser.add_argument("--model", default=None, help="The model used by the AI players.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed games for reproducible setups.")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        run = partial(simulate_game, model_name=args.model, seed=args.seed)
+        results = list(executor.map(run, range(args.games)))
+    duration = time.monotonic() - start
+
+    summary = summarize(results, duration)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"summary": summary, "games": [result.model_dump() for result in results]}, f, indent=2)
+
+    print(json.dumps(summary, indent=2))
+    print(f"Summary written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
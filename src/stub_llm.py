@@ -0,0 +1,342 @@
+"""
+A local stand-in for the OpenAI chat completions API, used to run and benchmark games without a network.
+
+Replies are valid for every prompt the game sends: "I" descriptions, one word animal guesses, votes for one of the
+listed players and JSON for the format step, JSON mode and function calls. Latency and failure rates are configurable.
+Streamed requests are answered with server-sent events, a few characters per chunk.
+
+Usage: python src/stub_llm.py --port 8000 --latency 0.5
+Then point the OpenAI client at it with OPENAI_BASE_URL=http://127.0.0.1:8000/v1 and any OPENAI_API_KEY.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from openai import OpenAI, AsyncOpenAI
+
+from game_chameleon import AVAILABLE_ANIMALS
+
+DESCRIPTIONS = ["I have fur", "I like to eat", "I sleep a lot", "I can be found in the wild", "I have four legs",
+                "I make a distinctive sound", "I am about the size you would expect", "I am very curious"]
+
+# Snippets of the game's prompts used to recognise what is being asked
+DESCRIBE_PROMPT = "It's your turn to describe yourself"
+GUESS_PROMPT = "What animal do you think the other players are pretending to be?"
+VOTE_PROMPT = "It's your turn to vote"
+FORMAT_PROMPT = "Here is the output format:"
+
+MAX_CACHED_PREFIXES = 100_000
+
+STREAM_CHUNK_SIZE = 4
+"""The number of characters in each chunk of a streamed reply, about a token."""
+
+
+class StubLLM:
+    """Generates replies to chat completion requests, with simulated latency and failures."""
+
+    def __init__(
+            self,
+            latency: float = 0.0,
+            latency_sigma: float = 0.5,
+            failure_rate: float = 0.0,
+            rate_limit_rate: float = 0.0,
+            seed: int = None,
+            chunk_interval: float = 0.0
+    ):
+        self.latency = latency
+        """The median latency of a reply in seconds, latencies are log-normally distributed."""
+        self.latency_sigma = latency_sigma
+        """The spread of the latency distribution, 0 means every reply takes exactly the median latency."""
+        self.failure_rate = failure_rate
+        """The fraction of requests that fail with a server error."""
+        self.rate_limit_rate = rate_limit_rate
+        """The fraction of requests that are rejected with a 429 rate limit error."""
+        self.chunk_interval = chunk_interval
+        """The time between the chunks of a streamed reply in seconds, on top of the latency before the first one."""
+
+        self.requests = 0
+        """The number of requests received."""
+        self.failures = 0
+        """The number of requests that were failed on purpose."""
+        self.rate_limits = 0
+        """The number of requests that were rate limited on purpose."""
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cached_prefixes = set()
+
+    def sample_latency(self) -> float:
+        """Returns a latency drawn from the configured distribution."""
+        if self.latency <= 0:
+            return 0.0
+        with self._lock:
+            return self.latency * math.exp(self._random.gauss(0, self.latency_sigma))
+
+    def sample_error(self) -> int | None:
+        """Returns an HTTP error status to fail the request with, or None if it should succeed."""
+        with self._lock:
+            self.requests += 1
+            roll = self._random.random()
+            if roll < self.rate_limit_rate:
+                self.rate_limits += 1
+                return 429
+            elif roll < self.rate_limit_rate + self.failure_rate:
+                self.failures += 1
+                return 500
+            return None
+
+    def reply(self, messages: list[dict], request: dict = None) -> str:
+        """Returns the content of a reply to the message history."""
+        contents = [message["content"] for message in messages]
+        last = contents[-1]
+
+        # Format and retry messages ask for JSON, the fields are found in the latest format instructions
+        format_instructions = next((c for c in reversed(contents) if FORMAT_PROMPT in c), None)
+        wants_json = request and (request.get("response_format", {}).get("type") == "json_object" or "tools" in request)
+        if format_instructions and (wants_json or FORMAT_PROMPT in last or "Please try again" in last):
+            schema = json.loads(format_instructions.split(FORMAT_PROMPT, 1)[1].strip())
+            return json.dumps({field: self._answer(field, contents) for field in schema})
+
+        prompt = next((c for c in reversed(contents) if DESCRIBE_PROMPT in c or GUESS_PROMPT in c or VOTE_PROMPT in c), "")
+        if GUESS_PROMPT in prompt:
+            return self._answer("animal", contents)
+        elif VOTE_PROMPT in prompt:
+            return self._answer("vote", contents)
+        else:
+            return self._answer("description", contents)
+
+    def _answer(self, field: str, contents: list[str]) -> str:
+        with self._lock:
+            if field == "animal":
+                return self._random.choice(AVAILABLE_ANIMALS)
+            elif field == "vote":
+                vote_prompt = next((c for c in reversed(contents) if VOTE_PROMPT in c), "")
+                names = re.findall(r"^ - (.+?):", vote_prompt, flags=re.MULTILINE)
+                return self._random.choice(names) if names else ""
+            else:
+                return self._random.choice(DESCRIPTIONS)
+
+    def cached_tokens(self, messages: list[dict]) -> int:
+        """
+        Simulates a provider's prompt cache, returning the tokens of the longest prefix of whole messages seen before.
+        """
+        cached_tokens = 0
+        prefix_tokens = 0
+        prefix_hash = hashlib.sha256()
+        prefix_hashes = []
+
+        with self._lock:
+            for message in messages:
+                prefix_hash.update(json.dumps(message, sort_keys=True).encode())
+                prefix_tokens += len(message["content"] or "") // 4
+                digest = prefix_hash.copy().digest()
+                prefix_hashes.append(digest)
+                if digest in self._cached_prefixes:
+                    cached_tokens = prefix_tokens
+
+            if len(self._cached_prefixes) > MAX_CACHED_PREFIXES:
+                self._cached_prefixes.clear()
+            self._cached_prefixes.update(prefix_hashes)
+
+        return cached_tokens
+
+    def completion(self, request: dict) -> dict:
+        """Returns a chat completion response body for a request body."""
+        content = self.reply(request["messages"], request)
+        prompt_tokens = sum(len(message["content"] or "") for message in request["messages"]) // 4
+        completion_tokens = len(content) // 4
+
+        message = {"role": "assistant", "content": content}
+        if "tools" in request:
+            # Function calls return the JSON as arguments of the forced tool call
+            function_name = request["tools"][0]["function"]["name"]
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call-stub-{self.requests}",
+                "type": "function",
+                "function": {"name": function_name, "arguments": content}
+            }]}
+
+        return {
+            "id": f"chatcmpl-stub-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if "tools" in request else "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": self.cached_tokens(request["messages"])}
+            }
+        }
+
+
+    def completion_chunks(self, request: dict) -> list[dict]:
+        """Returns the chunks of a streamed chat completion for a request body, with the usage last if asked for."""
+        completion = self.completion(request)
+        message = completion["choices"][0]["message"]
+        tool_call = message.get("tool_calls", [None])[0]
+        content = tool_call["function"]["arguments"] if tool_call else message["content"]
+
+        def chunk(delta: dict, finish_reason: str = None, usage: dict = None) -> dict:
+            return {
+                "id": completion["id"],
+                "object": "chat.completion.chunk",
+                "created": completion["created"],
+                "model": completion["model"],
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if usage is None else [],
+                "usage": usage
+            }
+
+        deltas = []
+        for start in range(0, len(content), STREAM_CHUNK_SIZE):
+            part = content[start:start + STREAM_CHUNK_SIZE]
+            if tool_call:
+                function = {"arguments": part} if start else {"name": tool_call["function"]["name"], "arguments": part}
+                deltas.append({"tool_calls": [
+                    {"index": 0, "id": tool_call["id"], "type": "function", "function": function}
+                ]})
+            else:
+                deltas.append({"role": "assistant", "content": part} if not start else {"content": part})
+
+        chunks = [chunk(delta) for delta in deltas]
+        chunks.append(chunk({}, completion["choices"][0]["finish_reason"]))
+        if request.get("stream_options", {}).get("include_usage"):
+            chunks.append(chunk({}, usage=completion["usage"]))
+        return chunks
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """An OpenAI compatible HTTP server that answers with a StubLLM, running on a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, stub: StubLLM = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), StubLLMRequestHandler)
+        self.stub = stub or StubLLM()
+        """The stub generating the replies."""
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """The base url to give to an OpenAI client."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def client(self, **kwargs) -> OpenAI:
+        """Returns an OpenAI client that talks to the stub."""
+        return OpenAI(base_url=self.base_url, api_key="stub", **kwargs)
+
+    def async_client(self, **kwargs) -> AsyncOpenAI:
+        """Returns an AsyncOpenAI client that talks to the stub."""
+        return AsyncOpenAI(base_url=self.base_url, api_key="stub", **kwargs)
+
+    def start(self) -> "StubLLMServer":
+        """Starts serving on a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name="stub-llm-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "StubLLMServer":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class StubLLMRequestHandler(BaseHTTPRequestHandler):
+    server: StubLLMServer
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, with Nagle's algorithm every response would stall on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        stub = self.server.stub
+        time.sleep(stub.sample_latency())
+
+        error = stub.sample_error()
+        if error == 429:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                            headers={"retry-after": "0"})
+        elif error:
+            self._send_json(error, {"error": {"message": "Simulated server error", "type": "server_error"}})
+        else:
+            request = json.loads(body)
+            if request.get("stream"):
+                self._send_events(stub.completion_chunks(request), stub.chunk_interval)
+            else:
+                self._send_json(200, stub.completion(request))
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, chunks: list[dict], interval: float):
+        """Sends the chunks as server-sent events, one at a time, ending with [DONE]."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        # The length isn't known upfront, so the end of the stream is the end of the connection
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i, chunk in enumerate(chunks):
+            if i and interval:
+                time.sleep(interval)
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        # Request logs would drown out everything else during load tests
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the OpenAI chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Median reply latency in seconds.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the log-normal latency.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests failing with a 500.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests failing with a 429.")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--chunk-interval", type=float, default=0.0, help="Seconds between the chunks of a stream.")
+    args = parser.parse_args()
+
+    stub = StubLLM(
+        args.latency, args.latency_sigma, args.failure_rate, args.rate_limit_rate, args.seed, args.chunk_interval
+    )
+    server = StubLLMServer(stub, args.host, args.port)
+    print(f"Stub LLM serving on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
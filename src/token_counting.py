@@ -0,0 +1,40 @@
+"""
+Token counting for prompts, used to keep them within budget before they are sent.
+tiktoken is used for exact counts when it is installed, otherwise counts are estimated from the length of the text.
+"""
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CHARACTERS_PER_TOKEN = 4
+"""The average number of characters per token, used when tiktoken is not installed."""
+TOKENS_PER_MESSAGE = 4
+"""The tokens the chat format adds around each message."""
+TOKENS_PER_PROMPT = 3
+"""The tokens the chat format adds to prime the reply."""
+
+
+@lru_cache(maxsize=None)
+def _encoding(model_name: str):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model_name: str = "gpt-3.5-turbo") -> int:
+    """Returns the number of tokens in the text."""
+    if tiktoken:
+        return len(_encoding(model_name).encode(text))
+    return -(-len(text) // CHARACTERS_PER_TOKEN)
+
+
+def count_message_tokens(messages: list[dict], model_name: str = "gpt-3.5-turbo") -> int:
+    """Returns the number of tokens in a list of chat messages."""
+    tokens = TOKENS_PER_PROMPT
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE + count_tokens(message["content"] or "", model_name)
+    return tokens
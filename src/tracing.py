@@ -0,0 +1,218 @@
+"""
+Tracing and profiling of individual games, to find out why a game was slow.
+
+With TRACING_ENABLED, every game records spans nested as game > round > phase > player turn > LLM call, validation or
+save, and writes them to TRACING_DIR/<game_id>.json when it ends. The file is in the Chrome trace event format, and
+can be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing. Spans are drawn on the game's track, except
+for the decisions AI players make concurrently, which each get a track of their own.
+
+With PROFILING_ENABLED, run_game runs under cProfile and the stats are written to PROFILING_DIR/<game_id>.pstats,
+to be read with pstats or snakeviz. Only the thread running the game is profiled.
+"""
+import contextvars
+import cProfile
+import json
+import os
+import pathlib
+import pstats
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
+from typing import List, ContextManager, Callable
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "false").lower() == "true"
+TRACING_DIR = os.environ.get("TRACING_DIR", pathlib.Path(__file__).parent.parent / "data" / "traces")
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_DIR = os.environ.get("PROFILING_DIR", pathlib.Path(__file__).parent.parent / "data" / "profiles")
+
+LEVELS = ["game", "round", "phase"]
+"""The spans that last across steps of the game, from the outermost in."""
+
+GAME_TRACK = "game"
+
+_track: contextvars.ContextVar[str] = contextvars.ContextVar("track", default=GAME_TRACK)
+
+
+def _now() -> int:
+    # Wall clock microseconds, so the spans of a game resumed in another process line up with the earlier ones
+    return time.time_ns() // 1000
+
+
+class Tracer:
+    """Records the spans of a game as Chrome trace events."""
+
+    def __init__(self, game_id: str):
+        self.game_id = game_id
+        """The id of the game traced."""
+        self.events: List[dict] = []
+        """The trace events recorded so far."""
+
+        self._pid = os.getpid()
+        self._tracks: dict[str, int] = {}
+        self._open: dict[str, tuple[str, int, dict]] = {}
+        self._exported = 0
+        self._lock = threading.Lock()
+        # The spans open on the game's track, and the spans that start or end once they are closed
+        self._depth = 0
+        self._deferred: List[tuple[Callable, tuple]] = []
+
+        self._add_event({"name": "process_name", "ph": "M", "args": {"name": f"game {game_id}"}}, GAME_TRACK)
+
+    def begin(self, level: str, name: str, **args):
+        """
+        Starts a span that lasts across steps, e.g. a round. Open spans at its level or below are ended first.
+        When called within a span on the game's track, e.g. a player turn moving the game to the next phase, the span
+        starts once that one has ended, so that spans stay nested.
+        """
+        self._at_top_level(self._begin, level, name, args)
+
+    def end(self, level: str):
+        """Ends the open span at a level along with the open spans below it, deferred like begin."""
+        self._at_top_level(self._end, level)
+
+    def _at_top_level(self, method: Callable, *args):
+        if self._depth:
+            self._deferred.append((method, args))
+        else:
+            method(*args, _now())
+
+    def _begin(self, level: str, name: str, args: dict, now: int):
+        self._end(level, now)
+        with self._lock:
+            self._open[level] = (name, now, args)
+
+    def _end(self, level: str, now: int):
+        for open_level in reversed(LEVELS[LEVELS.index(level):]):
+            with self._lock:
+                span = self._open.pop(open_level, None)
+            if span:
+                name, start, args = span
+                self._add_span(name, open_level, start, now, GAME_TRACK, args)
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        """Records a span around a block, on the track of the current context."""
+        track = _track.get()
+        on_game_track = track == GAME_TRACK
+        self._depth += on_game_track
+        start = _now()
+        try:
+            yield
+        finally:
+            end = _now()
+            self._add_span(name, category, start, end, track, args)
+            if on_game_track:
+                self._depth -= 1
+                if not self._depth:
+                    deferred, self._deferred = self._deferred, []
+                    for method, method_args in deferred:
+                        method(*method_args, end)
+
+    def _add_span(self, name: str, category: str, start: int, end: int, track: str, args: dict):
+        event = {"name": name, "cat": category, "ph": "X", "ts": start, "dur": end - start, "args": args}
+        self._add_event(event, track)
+
+    def _add_event(self, event: dict, track: str):
+        with self._lock:
+            if track not in self._tracks:
+                self._tracks[track] = len(self._tracks)
+                self.events.append({
+                    "name": "thread_name", "ph": "M", "pid": self._pid, "tid": self._tracks[track],
+                    "args": {"name": track}
+                })
+            self.events.append({**event, "pid": self._pid, "tid": self._tracks[track]})
+
+    def export(self, directory: str | os.PathLike = TRACING_DIR) -> pathlib.Path:
+        """
+        Writes the trace to <directory>/<game_id>.json, and returns its path.
+        The events of earlier parts of the game, e.g. before it was resumed in this process, are kept.
+        """
+        path = pathlib.Path(directory) / f"{self.game_id}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(path) as f:
+                earlier_events = json.load(f)["traceEvents"]
+        except FileNotFoundError:
+            earlier_events = []
+
+        with self._lock:
+            events = earlier_events + self.events[self._exported:]
+            self._exported = len(self.events)
+        temporary_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary_path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.replace(temporary_path, path)
+        return path
+
+
+# The tracers of the games being played, by game id. Games hold on to their tracer, so it is dropped along with them
+_tracers: weakref.WeakValueDictionary[str, Tracer] = weakref.WeakValueDictionary()
+
+
+def start_tracing(game_id: str) -> Tracer | None:
+    """Returns a new tracer for a game if tracing is enabled, None otherwise. The game has to keep a reference to it."""
+    if not TRACING_ENABLED:
+        return None
+    tracer = Tracer(game_id)
+    _tracers[game_id] = tracer
+    return tracer
+
+
+def get_tracer(game_id: str | None) -> Tracer | None:
+    """Returns the tracer of a game, None if it isn't traced."""
+    return _tracers.get(game_id) if game_id else None
+
+
+def span(game_id: str | None, name: str, category: str, **args) -> ContextManager:
+    """Records a span around a block in the trace of a game, does nothing if the game isn't traced."""
+    tracer = get_tracer(game_id)
+    return tracer.span(name, category, **args) if tracer else nullcontext()
+
+
+def begin(game_id: str, level: str, name: str, **args):
+    """Starts a span that lasts across steps in the trace of a game, see Tracer.begin."""
+    tracer = get_tracer(game_id)
+    if tracer:
+        tracer.begin(level, name, **args)
+
+
+def end(game_id: str, level: str):
+    """Ends a span that lasts across steps in the trace of a game, see Tracer.end."""
+    tracer = get_tracer(game_id)
+    if tracer:
+        tracer.end(level)
+
+
+@contextmanager
+def track(name: str):
+    """Records the spans of a block on a track of their own, e.g. for work running alongside the rest of the game."""
+    token = _track.set(name)
+    try:
+        yield
+    finally:
+        _track.reset(token)
+
+
+@contextmanager
+def profiled(game_id: str, directory: str | os.PathLike = PROFILING_DIR):
+    """
+    Profiles a block with cProfile if profiling is enabled, and adds the stats to <directory>/<game_id>.pstats.
+    Stats from earlier runs of the same game, e.g. one per page run in the Streamlit app, are added up.
+    """
+    if not PROFILING_ENABLED:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        path = pathlib.Path(directory) / f"{game_id}.pstats"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        stats = pstats.Stats(profile)
+        if path.exists():
+            stats.add(str(path))
+        stats.dump_stats(path)